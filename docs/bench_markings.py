@@ -0,0 +1,217 @@
+"""Benchmark of marking definition enforcement through per-user aliases
+against query time filters (``Client(..., query_markings=True)``).
+
+For each number of users, a repository is filled with organisations of ten
+users, one tlp+ marking definition per organisation (naming its users) and
+a few indicators per organisation (tlp+, TLP GREEN and unmarked). Every
+user then searches the indicators twice: the first (cold) pass resolves
+their access and, in alias mode, creates their alias; the second (warm)
+pass is served from the client's caches. ``new aliases`` counts the marking
+definition aliases created (ie: cluster state updates). Each mode checks
+that every user gets the same hits as in the other.
+
+Usage (from anywhere; the checkout that the script is in is imported ahead
+of any installed ``git4intel``)::
+
+    python docs/bench_markings.py [--uri memory] [--users 10 100 1000]
+
+With ``--uri`` set to a cluster, use an empty test cluster: the repository
+is filled for each number of users in turn and left in place.
+
+Measured against the in-process store (``--uri memory``, one run each)::
+
+     users   mode  cold (s)  cold reqs  warm (s)  warm reqs  new aliases
+        10  alias      0.92        143      0.00         10           10
+        10  query      0.98        103      0.00         10            0
+       100  alias     31.06       1403      1.23        100          100
+       100  query     31.93       1003      1.14        100            0
+      1000  alias    746.04      14003     53.32       1000         1000
+      1000  query    752.26      10003     53.49       1000            0
+
+Every run gave identical hits in both modes. Query mode saves four
+requests per user on the cold pass (those that check and create the
+user's alias) and leaves no aliases behind; the times are dominated by
+the in-process store evaluating every query against every document, so
+they say little about a cluster. 10,000 users has not been
+measured: the in-process store would take many hours, and a cluster run
+is still to be done.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import uuid
+
+import stix2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import git4intel  # noqa: E402
+from git4intel.memory import MemoryStore  # noqa: E402
+
+modes = ('alias', 'query')
+
+
+def org_objects(pii_marking_ref, org_num, users_per_org=10,
+                indicators_per_org=3):
+    """Objects for one organisation.
+
+    Returns:
+        :obj:`tuple`: The objects (:obj:`list` of :obj:`dict`) and the ids of
+        the users (:obj:`list` of :obj:`str`).
+    """
+    objs = []
+    org = stix2.v21.Identity(name='Org %d' % org_num,
+                             identity_class='organization',
+                             object_marking_refs=[pii_marking_ref])
+    objs.append(org)
+    user_ids = []
+    for i in range(users_per_org):
+        user = stix2.v21.Identity(name='User %d.%d' % (org_num, i),
+                                  identity_class='individual',
+                                  object_marking_refs=[pii_marking_ref])
+        objs.append(user)
+        objs.append(stix2.v21.Relationship(
+            created_by_ref=user.id,
+            source_ref=user.id,
+            target_ref=org.id,
+            relationship_type='member-of',
+            object_marking_refs=[pii_marking_ref]))
+        user_ids.append(user.id)
+    objs = [json.loads(obj.serialize()) for obj in objs]
+
+    # Built by hand as not every stix2 release takes custom marking types
+    tlp_plus = {"type": "marking-definition",
+                "spec_version": "2.1",
+                "id": 'marking-definition--' + str(uuid.uuid4()),
+                "created": "2020-01-01T00:00:00.000Z",
+                "created_by_ref": org['id'],
+                "name": 'Org %d only' % org_num,
+                "definition_type": "tlp-plus",
+                "definition": {"tlp_marking_def_ref": stix2.TLP_AMBER.id,
+                               "distribution_refs": user_ids}}
+    objs.append(tlp_plus)
+    for i in range(indicators_per_org):
+        for markings in ([tlp_plus['id']], [stix2.TLP_GREEN.id], None):
+            ind = stix2.v21.Indicator(
+                created_by_ref=org['id'],
+                name='Indicator %d.%d' % (org_num, i),
+                pattern="[ipv4-addr:value = '10.0.%d.%d']" % (org_num % 256,
+                                                              i),
+                pattern_type='stix',
+                valid_from='2020-01-01T00:00:00Z',
+                object_marking_refs=markings)
+            objs.append(json.loads(ind.serialize()))
+    return objs, user_ids
+
+
+def client(uri, store, mode):
+    kwargs = {"query_markings": mode == 'query'}
+    if store is not None:
+        kwargs['store'] = store
+    return git4intel.Client(uri, **kwargs)
+
+
+def fill(uri, store, num_users):
+    """Set up a repository with (about) ``num_users`` users.
+
+    Returns:
+        :obj:`list` of :obj:`str`: User ids.
+    """
+    g4i = client(uri, store, 'alias')
+    user_ids = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        g4i.store_core_data()
+        for org_num in range(max(num_users // 10, 1)):
+            objs, org_users = org_objects(g4i.pii_marking['id'], org_num)
+            g4i.index_objects(user_id=g4i.identity['id'], objects=objs)
+            user_ids += org_users
+        g4i.indices.refresh(index='_all')
+    return user_ids[:num_users]
+
+
+def request_count(g4i):
+    return getattr(g4i.transport, 'request_count', None)
+
+
+def run_pass(g4i, user_ids):
+    """Search the indicators as each user.
+
+    Returns:
+        :obj:`tuple`: Seconds, requests sent (``None`` if the transport does
+        not count them) and the hit ids of each user.
+    """
+    hits = {}
+    start_requests = request_count(g4i)
+    start = time.time()
+    for user_id in user_ids:
+        res = g4i.search(user_id=user_id,
+                         index='indicator',
+                         body={"query": {"match_all": {}}},
+                         _source=False)
+        hits[user_id] = sorted(hit['_id'] for hit in res['hits']['hits'])
+    elapsed = time.time() - start
+    if start_requests is None:
+        return elapsed, None, hits
+    return elapsed, request_count(g4i) - start_requests, hits
+
+
+def md_alias_count(g4i):
+    return len([info for info in g4i.cat.aliases(format='json')
+                if info['alias'].count('--') == 2])
+
+
+def bench(uri, num_users):
+    """Run both modes for a number of users.
+
+    Returns:
+        :obj:`list` of :obj:`dict`: One row per mode.
+    """
+    store = MemoryStore() if uri == 'memory' else None
+    user_ids = fill(uri, store, num_users)
+    rows = []
+    results = {}
+    for mode in modes:
+        g4i = client(uri, store, mode)
+        start_aliases = md_alias_count(g4i)
+        cold, cold_requests, results[mode] = run_pass(g4i, user_ids)
+        warm, warm_requests, warm_hits = run_pass(g4i, user_ids)
+        rows.append({"users": len(user_ids),
+                     "mode": mode,
+                     "cold": cold,
+                     "cold_requests": cold_requests,
+                     "warm": warm,
+                     "warm_requests": warm_requests,
+                     "aliases": md_alias_count(g4i) - start_aliases,
+                     "consistent": warm_hits == results[mode]})
+    for row in rows:
+        row['identical'] = results['alias'] == results['query']
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--uri', default='memory',
+                        help="elasticsearch endpoint ('memory' for the "
+                             "in-process store)")
+    parser.add_argument('--users', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    header = ('users', 'mode', 'cold (s)', 'cold reqs', 'warm (s)',
+              'warm reqs', 'new aliases', 'identical')
+    print('%6s %6s %9s %10s %9s %10s %12s %10s' % header)
+    for num_users in args.users:
+        for row in bench(args.uri, num_users):
+            print('%6d %6s %9.2f %10s %9.2f %10s %12d %10s' % (
+                row['users'], row['mode'], row['cold'],
+                row['cold_requests'], row['warm'], row['warm_requests'],
+                row['aliases'], row['identical'] and row['consistent']))
+
+
+if __name__ == '__main__':
+    main()
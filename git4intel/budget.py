@@ -0,0 +1,122 @@
+"""Resource budgets for molecule expansion (``Client.get_molecule()`` and
+``Client.get_molecules()``).
+
+A budget caps the number of expansion rounds, the number of ids in a
+molecule, the wall time and the number of elasticsearch requests spent on
+an expansion. Once a limit is reached the expansion stops and returns the
+molecule as found so far, with a report of which limit stopped it and which
+schema components were satisfied.
+
+Attributes:
+    budget_limits (:obj:`tuple` of :obj:`str`): Names of the limits, as
+        reported when one of them stops an expansion.
+"""
+import time
+
+budget_limits = ('max_rounds', 'max_ids', 'max_time', 'max_requests')
+
+
+class Budget(object):
+    """Limits for one expansion (shared by every molecule expanded with it).
+    Any limit left as ``None`` is not applied.
+
+    Args:
+        max_rounds (:obj:`int`, optional): Maximum number of rounds.
+        max_ids (:obj:`int`, optional): Stop expanding a molecule once it
+            has at least this many ids (the last round can take it over).
+        max_time (:obj:`float`, optional): Maximum wall time in seconds.
+            Requests are sent with the time left as their timeout.
+        max_requests (:obj:`int`, optional): Maximum number of
+            elasticsearch search requests (the lookups of the user's marking
+            definition alias are not counted).
+
+    Attributes:
+        rounds (:obj:`int`): Rounds run so far.
+        requests (:obj:`int`): Elasticsearch requests sent so far.
+        exhausted (:obj:`str`): Name of the first limit that stopped a
+            molecule (see ``budget_limits``), or ``None``.
+    """
+
+    def __init__(self, max_rounds=None, max_ids=None, max_time=None,
+                 max_requests=None):
+        self.max_rounds = max_rounds
+        self.max_ids = max_ids
+        self.max_time = max_time
+        self.max_requests = max_requests
+        self.rounds = 0
+        self.requests = 0
+        self.exhausted = None
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    def remaining_time(self):
+        """Seconds left of ``max_time``.
+
+        Returns:
+            :obj:`float`: Seconds (``None`` if there is no time limit).
+        """
+        if self.max_time is None:
+            return None
+        return max(self.max_time - self.elapsed, 0)
+
+    def check(self, rounds=None, requests=0, ids=0):
+        """Check whether another round fits in the budget.
+
+        Args:
+            rounds (:obj:`int`, optional): Rounds run so far (defaults to
+                ``rounds``; for expansions that run each molecule on its
+                own).
+            requests (:obj:`int`, optional): Elasticsearch requests that the
+                round will send.
+            ids (:obj:`int`, optional): Number of ids in the molecule.
+
+        Returns:
+            :obj:`str`: Name of the limit that the round would break (see
+            ``budget_limits``), or ``None`` if it can be run.
+        """
+        if rounds is None:
+            rounds = self.rounds
+        if self.max_rounds is not None and rounds >= self.max_rounds:
+            return 'max_rounds'
+        if self.max_time is not None and self.elapsed >= self.max_time:
+            return 'max_time'
+        if (self.max_requests is not None and
+                self.requests + requests > self.max_requests):
+            return 'max_requests'
+        if self.max_ids is not None and ids >= self.max_ids:
+            return 'max_ids'
+        return None
+
+    def stop(self, limit):
+        """Record a limit that stopped a molecule.
+
+        Args:
+            limit (:obj:`str`): Name of the limit (see ``budget_limits``).
+        """
+        if self.exhausted is None:
+            self.exhausted = limit
+
+    def spend(self, requests=0):
+        """Record a round.
+
+        Args:
+            requests (:obj:`int`, optional): Elasticsearch requests that the
+                round sent.
+        """
+        self.rounds += 1
+        self.requests += requests
+
+    def report(self):
+        """What the expansion used.
+
+        Returns:
+            :obj:`dict`: ``rounds``, ``requests``, ``time`` (seconds) and
+            ``exhausted`` (as per the attributes).
+        """
+        return {"rounds": self.rounds,
+                "requests": self.requests,
+                "time": self.elapsed,
+                "exhausted": self.exhausted}
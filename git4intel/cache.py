@@ -0,0 +1,367 @@
+"""Small in-process caches used by the client to save elasticsearch round
+trips.
+
+Attributes:
+    DEFAULT_KNOWN_IDS_SIZE (:obj:`int`): Default number of (index, id) pairs
+        held by a ``KnownIds`` cache.
+"""
+from elasticsearch import helpers
+import collections
+import threading
+
+
+DEFAULT_KNOWN_IDS_SIZE = 1000000
+
+
+class KnownIds(object):
+    """Bounded LRU set of (index, id) pairs known to exist in elasticsearch.
+
+    Pairs are keyed on the stix object type alias (eg: ``('indicator',
+    '<uuid>')``) as used by ``Client.index()`` rather than the timestamped
+    index name. Only positive answers are held: an unknown pair still has to
+    be checked against the cluster, so a cache miss is never wrong, only
+    slower. Any object providing ``__contains__()``, ``add()``, ``discard()`` and
+    ``clear()`` (eg: a bloom filter that is confirmed by the cluster) can be
+    used in its place by the client - see ``Client.known_ids``.
+
+    Args:
+        max_size (:obj:`int`, optional): Maximum number of pairs to hold
+            before the least recently used are dropped.
+
+    Attributes:
+        hits (:obj:`int`): Number of lookups answered by the cache.
+        misses (:obj:`int`): Number of lookups that had to go to the cluster.
+    """
+
+    def __init__(self, max_size=DEFAULT_KNOWN_IDS_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._ids:
+                self._ids.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._ids[key] = True
+            self._ids.move_to_end(key)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._ids.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def stats(self):
+        """Hit/miss counters for the cache.
+
+        Returns:
+            :obj:`dict`: ``size``, ``hits``, ``misses`` and ``hit_ratio``.
+        """
+        lookups = self.hits + self.misses
+        return {"size": len(self._ids),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+    def warm(self, client, index, user_id=None, size=5000):
+        """Fill the cache with every document id in an index (or alias or
+        list of indices) using a single ``_source``-less scan.
+
+        Args:
+            client (:obj:`Client`): git4intel client to scan with.
+            index (:obj:`str` or :obj:`list` of :obj:`str`): Index names,
+                aliases or patterns to load.
+            user_id (:obj:`str`, optional): Identity to run the scan as.
+                Defaults to the client's system identity.
+            size (:obj:`int`, optional): Scroll page size.
+
+        Returns:
+            :obj:`int`: Number of pairs loaded.
+        """
+        if user_id is None:
+            user_id = client.identity['id']
+        count = 0
+        for hit in helpers.scan(client,
+                                query={"query": {"match_all": {}}},
+                                index=index,
+                                size=size,
+                                _source=False,
+                                user_id=user_id,
+                                _md=False,
+                                revoked=True):
+            # Concrete indices are timestamped (<type>--<yymmdd>)
+            self.add((hit['_index'].split('--')[0], hit['_id']))
+            count += 1
+        return count
+
+    def lookup(self, client, keys):
+        """Resolve a batch of (index, id) pairs, going to the cluster with a
+        single ``mget`` for the pairs the cache does not already know.
+
+        Args:
+            client (:obj:`Client`): git4intel client to check with.
+            keys (:obj:`list` of :obj:`tuple`): (index, id) pairs.
+
+        Returns:
+            :obj:`set`: The pairs from ``keys`` that exist.
+        """
+        found = set()
+        unknown = []
+        for key in collections.OrderedDict.fromkeys(keys):
+            if key in self:
+                found.add(key)
+            else:
+                unknown.append(key)
+        if not unknown:
+            return found
+        docs = [{"_index": index, "_id": doc_id} for index, doc_id in unknown]
+        res = client.mget(body={"docs": docs}, _source=False)
+        for key, doc in zip(unknown, res['docs']):
+            if doc.get('found', False):
+                self.add(key)
+                found.add(key)
+        return found
+
+
+class AttackIds(object):
+    """In-memory resolver of Mitre Att&ck external ids (eg: ``T1059``) to the
+    stix2 ids of the objects that carry them.
+
+    The map is built on first use from a single scan over every object with
+    an ``external_references.external_id`` and is kept until
+    ``invalidate()`` is called (eg: when ``data_primer()`` re-runs). Ids that
+    are not in the map are looked up together in one ``msearch`` and the
+    answer (including an empty one) is remembered.
+
+    Attributes:
+        hits (:obj:`int`): Number of ids answered from memory.
+        misses (:obj:`int`): Number of ids that had to go to the cluster.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop the map so that it is rebuilt on the next lookup."""
+        with self._lock:
+            self._ids = None
+
+    def stats(self):
+        """Hit/miss counters for the resolver.
+
+        Returns:
+            :obj:`dict`: ``size``, ``hits`` and ``misses``.
+        """
+        return {"size": len(self._ids) if self._ids is not None else 0,
+                "hits": self.hits,
+                "misses": self.misses}
+
+    def build(self, client, user_id=None, size=5000):
+        """(Re)build the map with a single scan.
+
+        Args:
+            client (:obj:`Client`): git4intel client to scan with.
+            user_id (:obj:`str`, optional): Identity to run the scan as.
+                Defaults to the client's system identity.
+            size (:obj:`int`, optional): Scroll page size.
+
+        Returns:
+            :obj:`int`: Number of external ids loaded.
+        """
+        if user_id is None:
+            user_id = client.identity['id']
+        ids = {}
+        q = {"query": {"nested": {
+            "path": "external_references",
+            "query": {"exists": {
+                "field": "external_references.external_id"}}}}}
+        for hit in helpers.scan(client,
+                                query=q,
+                                index='intel',
+                                size=size,
+                                _source=['id',
+                                         'external_references.external_id'],
+                                user_id=user_id,
+                                _md=False,
+                                revoked=True):
+            for ext_ref in hit['_source'].get('external_references', []):
+                try:
+                    ext_id = ext_ref['external_id']
+                except KeyError:
+                    continue
+                if hit['_source']['id'] not in ids.setdefault(ext_id, []):
+                    ids[ext_id].append(hit['_source']['id'])
+        with self._lock:
+            self._ids = ids
+        return len(ids)
+
+    def resolve(self, client, external_ids):
+        """Resolve a batch of Att&ck external ids.
+
+        Args:
+            client (:obj:`Client`): git4intel client to look up with.
+            external_ids (:obj:`list` of :obj:`str`): Att&ck ids (upper
+                case, as stored).
+
+        Returns:
+            :obj:`dict`: Stix2 object ids (:obj:`list` of :obj:`str`) for
+            each of ``external_ids``.
+        """
+        if self._ids is None:
+            self.build(client)
+        ids = self._ids
+        resolved = {}
+        unresolved = []
+        for ext_id in collections.OrderedDict.fromkeys(external_ids):
+            if ext_id in ids:
+                self.hits += 1
+                resolved[ext_id] = ids[ext_id]
+            else:
+                self.misses += 1
+                unresolved.append(ext_id)
+        if not unresolved:
+            return resolved
+
+        body = []
+        for ext_id in unresolved:
+            body.append({"index": "intel"})
+            body.append({"query": {"nested": {
+                "path": "external_references",
+                "query": {"bool": {"must": {"match": {
+                    "external_references.external_id": ext_id}}}}}},
+                "_source": ["id"],
+                "size": 10000})
+        res = client.msearch(body=body)
+        for ext_id, response in zip(unresolved, res['responses']):
+            stix_ids = []
+            for hit in response.get('hits', {}).get('hits', []):
+                stix_ids.append(hit['_source']['id'])
+            resolved[ext_id] = stix_ids
+            if 'error' not in response:
+                ids[ext_id] = stix_ids
+        return resolved
+
+
+class MarkingAliases(object):
+    """In-process map of (user id, index alias) pairs to the marking
+    definition alias that ``Client.get_id_markings()`` last resolved for
+    them.
+
+    Alias names carry their hourly time slice (see ``md_time_index()``) so
+    an entry is only used while the name that it holds is still the name
+    for the current slice: entries expire with the slice without any
+    timers. Once warm, resolving a user's alias costs no round trip to the
+    cluster. The map is safe to share between threads (and between clients
+    of the same cluster - see ``Client.md_aliases``).
+
+    The resolved ``MarkingFilter`` of each user is held alongside (for the
+    slice that it was resolved in), as is a lock per user that rebuilds
+    hold so that concurrent requests for the same user wait for one
+    rebuild rather than each running their own.
+
+    Attributes:
+        hits (:obj:`int`): Number of lookups answered by the cache.
+        misses (:obj:`int`): Number of lookups that had to go to the cluster.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._aliases = {}
+        self._filters = {}
+        self._rebuilds = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._aliases)
+
+    def get(self, user_id, index_alias, md_alias_name):
+        """Check whether an alias is known to exist.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id.
+            index_alias (:obj:`str`): Index name used in the query.
+            md_alias_name (:obj:`str`): Alias name for the current slice.
+
+        Returns:
+            :obj:`bool`: ``True`` if the alias was resolved in this slice.
+        """
+        with self._lock:
+            if self._aliases.get((user_id, index_alias)) == md_alias_name:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, user_id, index_alias, md_alias_name):
+        with self._lock:
+            self._aliases[(user_id, index_alias)] = md_alias_name
+
+    def get_filter(self, user_id, time_slice):
+        """Get a user's marking filter if it was resolved in a slice.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id.
+            time_slice (:obj:`str`): Current hourly time slice.
+
+        Returns:
+            :obj:`MarkingFilter`: The filter, or ``None``.
+        """
+        with self._lock:
+            cached = self._filters.get(user_id)
+        if cached is None or cached[0] != time_slice:
+            return None
+        return cached[1]
+
+    def add_filter(self, user_id, time_slice, md_filter):
+        with self._lock:
+            self._filters[user_id] = (time_slice, md_filter)
+
+    def rebuild_lock(self, user_id):
+        """Lock to hold while rebuilding a user's aliases.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id.
+
+        Returns:
+            :obj:`threading.Lock`: The user's lock.
+        """
+        with self._lock:
+            return self._rebuilds.setdefault(user_id, threading.Lock())
+
+    def invalidate(self):
+        """Drop every alias so that they are checked against the cluster
+        again (eg: when a marking definition changes which users can see
+        what)."""
+        with self._lock:
+            self._aliases.clear()
+            self._filters.clear()
+
+    def stats(self):
+        """Hit/miss counters for the cache.
+
+        Returns:
+            :obj:`dict`: ``size``, ``hits`` and ``misses``.
+        """
+        return {"size": len(self._aliases),
+                "hits": self.hits,
+                "misses": self.misses}
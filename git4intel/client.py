@@ -3,7 +3,13 @@
 Attributes:
     sdo_indices (:obj:`list` of :obj:`str`): Global list of actively supported
         STIX Domain Objects (SDOs) that each have it's own elasticsearch index.
+    ref_fields_ttl (:obj:`int`): Seconds to cache the list of reference
+        fields used to build molecule queries.
+    edge_lookup_size (:obj:`int`): Maximum number of edges to fetch for a
+        molecule expansion round; bigger rounds search the reference fields
+        instead.
 """
+from concurrent.futures import ThreadPoolExecutor
 from elasticsearch import Elasticsearch, exceptions, helpers
 import stix2
 from taxii2client import Collection
@@ -15,10 +21,9 @@ from stix2.v21 import CustomMarking
 from stix2.properties import ListProperty, ReferenceProperty
 from pprint import pprint
 import time
+import collections
 import requests
 from datetime import datetime
-import os
-import yaml
 
 try:
     import importlib.resources as pkg_resources
@@ -27,9 +32,41 @@ except ImportError:
     import importlib_resources as pkg_resources
 
 from . import schemas
+from .budget import Budget
+from .cache import AttackIds, KnownIds, MarkingAliases
+from .edges import _iter_refs, edge_actions, edges_index, edges_mapping
+from .graph import GraphSnapshot
+from .markings import (
+    MarkingFilter,
+    access_lists_index,
+    access_lists_mapping
+)
+from .matchers import CompiledSchema, field_kind, schema_fields, source_values
+from .dump import (
+    BundleWriter,
+    FilesWriter,
+    ShardWriter,
+    iter_dump_objects,
+    scan_slices
+)
+from .ingest import (
+    Manifest,
+    parse_files,
+    parse_osquery_pack,
+    parse_sigma_rules,
+    parse_table
+)
+from .memory import MemoryTransport
+from .molecules import (
+    molecule_doc,
+    molecule_id,
+    molecules_index,
+    molecules_mapping
+)
 
 
 from .utils import (
+    chunk_list,
     compare_mappings,
     dir_recurse,
     get_deterministic_uuid,
@@ -41,7 +78,9 @@ from .utils import (
     get_system_org,
     get_system_to_org,
     hits_from_res,
+    iter_bundle_objects,
     md_time_index,
+    md_time_slice,
     new_obj_version,
     stix_to_elk,
     todays_index
@@ -69,6 +108,10 @@ sdo_indices = [
     'vulnerability',
 ]
 
+ref_fields_ttl = 60
+
+edge_lookup_size = 10000
+
 
 @CustomMarking('x-tlpplus-marking', [
     ('tlp_marking_def_ref', ReferenceProperty(
@@ -98,17 +141,100 @@ class Client(Elasticsearch):
     - stix_ver (:obj:`str`): Currently hard-coded (but provided for
       anticipation of future requirement) stix version number for the
       repository.
+    - known_ids (:obj:`KnownIds`): Cache of (index, id) pairs known to exist,
+      consulted by ``index()`` before going to elasticsearch. Call
+      ``known_ids.warm()`` to preload it and ``known_ids.stats()`` to see how
+      many round trips it saved.
+    - attack_ids (:obj:`AttackIds`): Memoized Mitre Att&ck external id
+      resolver used by ``extract_known_atps()``; invalidated by
+      ``data_primer()``.
+    - md_aliases (:obj:`MarkingAliases`): Cache of the marking definition
+      aliases resolved by ``get_id_markings()`` in the current hourly slice,
+      so that warm searches skip the alias existence check; invalidated by
+      ``update_md()`` (and so ``set_tlpplus()``).
+    - access_lists (:obj:`bool`): Whether the marking definition aliases
+      filter on per-user access list documents (``terms`` lookups) rather
+      than on one clause per marking definition (see
+      ``git4intel.markings``).
+    - query_markings (:obj:`bool`): Whether marking definitions are enforced
+      by adding the user's resolved filter (``get_marking_filter()``) to
+      each query rather than through their marking definition aliases.
+    - schema_hits (:obj:`bool`): Whether objects are tagged with the molecule
+      schema components that they satisfy as they are written (see
+      ``tag_schema_hits()``).
+    - search_workers (:obj:`int`): Default number of concurrent requests that
+      ``multi_search()`` (and so each molecule expansion round) splits its
+      searches over; ``None`` for a single ``msearch`` request.
 
     Args:
-        uri (:obj:`str`): Endpoint for elasticsearch.
+        uri (:obj:`str`): Endpoint for elasticsearch. Use ``'memory'`` to run
+            against an in-process store instead of a cluster (see
+            ``git4intel.memory``).
+        known_ids (:obj:`KnownIds`, optional): Existence cache to use in place
+            of the default (bounded LRU) ``KnownIds``.
+        md_aliases (:obj:`MarkingAliases`, optional): Marking definition
+            alias cache to use in place of a new one (eg: to share one
+            between the clients of several threads).
+        access_lists (:obj:`bool`, optional): ``True`` to write each user's
+            resolved access to the access list index and filter their
+            aliases with ``terms`` lookups against it. Objects must have
+            been indexed with the ``keyword`` copies of ``id`` and
+            ``object_marking_refs`` (ie: ``store_core_data()`` has updated
+            the mappings).
+        query_markings (:obj:`bool`, optional): ``True`` to enforce marking
+            definitions in ``search()`` and ``multi_search()`` (and so
+            ``get_molecule()``) with a ``filter`` clause per query built
+            from the user's cached access, so that no marking definition
+            aliases are created or used. Results are as per the aliases;
+            as a get through a filtered alias ignores the filter,
+            ``get_objects()`` gets from the indices directly.
+        schema_hits (:obj:`bool`, optional): ``True`` to percolate objects
+            against the molecule schemas as they are written and tag them
+            with the components that they satisfy, which molecule expansion
+            then filters on. Only set this for repositories whose objects
+            have all been tagged (see ``tag_schema_hits()``).
+        search_workers (:obj:`int`, optional): Default number of concurrent
+            requests for ``multi_search()``.
+        **kwargs: As per elasticsearch ``Elasticsearch()`` arguments (eg:
+            ``transport_class``, or ``store`` to share a ``MemoryStore``
+            between in-process clients).
     """
 
-    def __init__(self, uri):
+    def __init__(self, uri, known_ids=None, md_aliases=None,
+                 access_lists=False, query_markings=False, schema_hits=False,
+                 search_workers=None, **kwargs):
         self.stix_ver = '21'
+        if known_ids is None:
+            known_ids = KnownIds()
+        self.known_ids = known_ids
+        if md_aliases is None:
+            md_aliases = MarkingAliases()
+        self.md_aliases = md_aliases
+        self.access_lists = access_lists
+        self.query_markings = query_markings
+        self.__access_lists = None
+        self.schema_hits = schema_hits
+        self.search_workers = search_workers
+        self.attack_ids = AttackIds()
+        self.__ref_fields = None
+        self.__ref_fields_time = 0
+        self.__edges = None
+        self.__molecules = None
+        self.__schemas = None
+        self.__compiled = {}
+        self.graph_snapshot = None
         self.identity = get_system_id(id_only=True)
         self.org = get_system_org(system_id=self.identity['id'], org_only=True)
         self.pii_marking = get_pii_marking(self.identity['id'])[0]
-        Elasticsearch.__init__(self, uri)
+        if uri == 'memory':
+            kwargs.setdefault('transport_class', MemoryTransport)
+        Elasticsearch.__init__(self, uri, **kwargs)
+        self.__set_os_group_id()
+
+    def __set_os_group_id(self):
+        """Look up the current OS data markings grouping (or work out its
+        deterministic id if it has not been created yet).
+        """
         try:
             res = self.search(user_id=self.identity['id'],
                               index='grouping',
@@ -166,6 +292,99 @@ class Client(Elasticsearch):
             :obj:`dict`: JSON serializable dictionary per
             ``elasticsearch.search()``.
         """
+        kwargs = self.__search_kwargs(user_id, schema, _md, revoked, kwargs)
+        kwargs['body'] = dict(kwargs['body'])
+        self.__exclude_schema_hits(kwargs['body'], kwargs)
+        return super().search(**kwargs)
+
+    def multi_search(self, user_id, searches, _md=None, revoked=None,
+                     workers=None, **kwargs):
+        """Run several searches, each per ``search()``, in a single
+        elasticsearch ``msearch()`` request (or, with ``workers``, in up to
+        that many ``msearch()`` requests sent at the same time so that
+        the slowest search rather than the whole batch sets the latency).
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            searches (:obj:`list` of :obj:`dict`): Keyword arguments for each
+                search as per ``search()`` (``body``, ``schema``, ``index``,
+                ``size`` etc.). Any other keys (eg: ``_source``, ``sort``) are
+                added to the search body.
+            _md (:obj:`bool`, optional): As per ``search()``.
+            revoked (:obj:`bool`, optional): As per ``search()``.
+            workers (:obj:`int`, optional): Number of concurrent requests.
+                Defaults to the client's ``search_workers``.
+            **kwargs: As per elasticsearch ``msearch()`` arguments.
+
+        Returns:
+            :obj:`list` of :obj:`dict`: One elasticsearch response per search,
+            in the same order as ``searches``.
+        """
+        lines = []
+        for search in searches:
+            search = dict(search)
+            if 'body' in search:
+                search['body'] = dict(search['body'])
+            schema = search.pop('schema', None)
+            search = self.__search_kwargs(user_id, schema, _md, revoked,
+                                          search)
+            header = {"index": search.pop('index')}
+            search_body = search.pop('body')
+            search_body.update(search)
+            self.__exclude_schema_hits(search_body)
+            lines.append([header, search_body])
+        if not lines:
+            return []
+        groups = self.__search_groups(len(lines), workers)
+        if len(groups) == 1:
+            body = [line for pair in lines for line in pair]
+            return super().msearch(body=body, **kwargs)['responses']
+
+        def msearch(group):
+            body = [line for pair in lines[group[0]:group[1]]
+                    for line in pair]
+            return Elasticsearch.msearch(self, body=body,
+                                         **kwargs)['responses']
+
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            results = list(pool.map(msearch, groups))
+        return [res for responses in results for res in responses]
+
+    def __search_groups(self, count, workers=None):
+        """Supporting function to split a number of searches in to
+        contiguous groups, one per ``msearch()`` request.
+
+        Args:
+            count (:obj:`int`): Number of searches.
+            workers (:obj:`int`, optional): As per ``multi_search()``.
+
+        Returns:
+            :obj:`list` of :obj:`tuple`: ``(start, end)`` of each group.
+        """
+        if workers is None:
+            workers = self.search_workers
+        workers = max(min(workers or 1, count), 1)
+        size = -(-count // workers)
+        return [(start, min(start + size, count))
+                for start in range(0, count, size)]
+
+    def __search_kwargs(self, user_id, schema, _md, revoked, kwargs):
+        """Supporting function to add the marking definition alias, revoked
+        and schema filters to a set of ``search()`` keyword arguments.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            schema (:obj:`str` name or :obj:`dict` object): As per
+                ``search()``.
+            _md (:obj:`bool`): As per ``search()``.
+            revoked (:obj:`bool`): As per ``search()``.
+            kwargs (:obj:`dict`): Keyword arguments (updated in place).
+
+        Returns:
+            :obj:`dict`: The updated keyword arguments.
+        """
         _filter = {}
         if _md is None:
             _md = True
@@ -175,10 +394,16 @@ class Client(Elasticsearch):
             kwargs['index'] = 'intel'
         if 'size' not in kwargs:
             kwargs['size'] = 10000
+        if 'body' not in kwargs:
+            # Newer helpers (eg: scan()) pass the query as a keyword argument
+            kwargs['body'] = {"query": kwargs.pop('query', {"match_all": {}})}
 
         # if not schema and not _md:
         #     return super().search(**kwargs)
-        if _md:
+        md_filter = None
+        if _md and self.query_markings:
+            md_filter = self.get_marking_filter(user_id=user_id)
+        elif _md:
             md_alias = self.get_id_markings(user_id=user_id,
                                             index_alias=kwargs['index'])
             kwargs['index'] = md_alias
@@ -190,26 +415,58 @@ class Client(Elasticsearch):
                                     {"bool": {"must_not": {"match": {
                                         "revoked": True}}}}]}}
         if schema:
-            _schema_should = []
             if isinstance(schema, dict):
                 _schema_should = schema
             else:
                 if schema == 'all':
-                    schemas = self.get_all_schemas()
+                    schemas = list(self.compile_schemas().values())
                 else:
                     if isinstance(schema, str):
                         schema = [schema]
-                    schemas = []
-                    for _schema in schema:
-                        schemas.append(self.get_schema(_schema))
-                for _schema in schemas:
-                    _schema_should += (_schema['core']['bool']['should'] +
-                                       _schema['ext']['bool']['should'])
-                _schema_should = {"bool": {"should": _schema_should}}
+                    schemas = [self.get_compiled_schema(_schema)
+                               for _schema in schema]
+                _schema_should = {"bool": {"should": [
+                    _schema.to_query() for _schema in schemas if _schema]}}
             _filter = {"bool": {"must": [_schema_should, _filter]}}
+        if md_filter is not None:
+            if _filter:
+                _filter = {"bool": {"must": [md_filter.to_query(), _filter]}}
+            else:
+                _filter = md_filter.to_query()
         kwargs['body']['query'] = {"bool": {"must": kwargs['body']['query'],
                                             "filter": _filter}}
-        return super().search(**kwargs)
+        return kwargs
+
+    def __exclude_schema_hits(self, body, params=None):
+        """Supporting function to leave the schema hit tags (see
+        ``tag_schema_hits()``) out of the ``_source`` of the hits, unless
+        they are asked for by name.
+
+        Args:
+            body (:obj:`dict`): Search body (updated in place).
+            params (:obj:`dict`, optional): ``search()`` keyword arguments,
+                whose ``_source`` parameters take precedence over the body
+                (updated in place).
+        """
+        params = params if params is not None else {}
+        if '_source' in params or '_source_includes' in params:
+            return
+        if '_source_excludes' in params:
+            excludes = params['_source_excludes']
+            if isinstance(excludes, str):
+                excludes = excludes.split(',')
+            params['_source_excludes'] = (list(excludes) +
+                                          ['x_g4i_schema_hits'])
+            return
+        source = body.get('_source', True)
+        if source is True:
+            source = {}
+        elif not isinstance(source, dict):
+            return
+        if 'x_g4i_schema_hits' in source.get('includes', []):
+            return
+        body['_source'] = dict(source, excludes=(
+            list(source.get('excludes', [])) + ['x_g4i_schema_hits']))
 
     def index(self, user_id, up_version=True, **kwargs):
         """Wrapper for the elasticsearch ``search()`` method. Overloads the
@@ -242,12 +499,21 @@ class Client(Elasticsearch):
             kwargs['id'] = doc_id
         if 'refresh' not in kwargs:
             kwargs['refresh'] = False
-        if not self.exists(index=kwargs['index'],
-                           id=kwargs['id'],
-                           _source=False,
-                           ignore=[400, 404]):
+        if not self.id_exists(index=kwargs['index'], doc_id=kwargs['id']):
+            if self.schema_hits and kwargs['body'].get(
+                    'id', '').split('--')[0] == kwargs['index']:
+                kwargs['body'] = self.__tag_schema_hits([kwargs['body']])[0]
             res = super().index(**kwargs)
             if res['result'] == 'created':
+                self.known_ids.add((kwargs['index'], kwargs['id']))
+                if kwargs['body'].get('id', '').split('--')[0] == \
+                        kwargs['index']:
+                    if self.has_edges():
+                        helpers.bulk(self, edge_actions(kwargs['body']),
+                                     refresh=kwargs['refresh'])
+                    if self.graph_snapshot is not None:
+                        self.graph_snapshot.add(kwargs['body'])
+                    self.__stale_molecules(self.__touched(kwargs['body']))
                 return kwargs['id']
             return False
 
@@ -264,10 +530,40 @@ class Client(Elasticsearch):
         if res['result'] != 'updated' and res['result'] != 'noop':
             print('Failed to revoke updated object.')
             return False
+        self.__drop_edges([index_name + '--' + doc_id])
+        if self.graph_snapshot is not None:
+            self.graph_snapshot.remove([index_name + '--' + doc_id])
+        self.__stale_molecules(set([index_name + '--' + doc_id]))
         return [new_objs[1]['id']]
 
-    def index_objects(self, user_id, objects, up_version=True, refresh=False):
+    def id_exists(self, index, doc_id):
+        """Existence check for a document that consults ``known_ids`` first
+        and only goes to elasticsearch when the answer is unknown.
+
+        Args:
+            index (:obj:`str`): Index (stix object type alias) name.
+            doc_id (:obj:`str`): Document id (the uuid part of the stix id).
+
+        Returns:
+            :obj:`bool`: ``True`` if the document exists.
+        """
+        key = (index, doc_id)
+        if key in self.known_ids:
+            return True
+        if not self.exists(index=index,
+                           id=doc_id,
+                           _source=False,
+                           ignore=[400, 404]):
+            return False
+        self.known_ids.add(key)
+        return True
+
+    def index_objects(self, user_id, objects, up_version=True, refresh=False,
+                      chunk_size=500, max_chunk_bytes=10485760,
+                      thread_count=None):
         """Wrapper for the ``index()`` method to handle a list of objects.
+        Lists are sent through ``bulk_index()``; a single object goes
+        straight to ``index()``.
 
         Args:
             user_id (:obj:`str`): STIX2 identity object reference id for the
@@ -278,24 +574,724 @@ class Client(Elasticsearch):
                 determine if stix up-versioning should be applied.
             refresh (:obj:`bool`, optional): Pass through to core elasticsearch
                 index() function to determine the refresh policy.
+            chunk_size (:obj:`int`, optional): Pass through to
+                ``bulk_index()``.
+            max_chunk_bytes (:obj:`int`, optional): Pass through to
+                ``bulk_index()``.
+            thread_count (:obj:`int`, optional): Pass through to
+                ``bulk_index()``.
+
+        Returns:
+            :obj:`list`: As per ``index()`` for each successfully indexed
+            object.
         """
         if isinstance(objects, list):
-            last_obj = objects.pop(0)
-            id_list = []
-            for obj in objects:
-                res = self.index(user_id=user_id, up_version=up_version,
-                                 body=obj, refresh=False)
-                if res:
-                    id_list.append(res)
-            # Honour refresh on the last object
-            res = self.index(user_id=user_id, up_version=up_version,
-                             body=last_obj, refresh=refresh)
-            if res:
-                id_list.append(res)
+            id_list, failed = self.bulk_index(user_id=user_id,
+                                              objects=objects,
+                                              up_version=up_version,
+                                              refresh=refresh,
+                                              chunk_size=chunk_size,
+                                              max_chunk_bytes=max_chunk_bytes,
+                                              thread_count=thread_count)
+            for obj_id, error in failed:
+                print('Failed to index ' + obj_id + ': ' + str(error))
             return id_list
         return self.index(user_id=user_id, up_version=up_version,
                           body=objects, refresh=refresh)
 
+    def bulk_index(self, user_id, objects, up_version=True, refresh=False,
+                   chunk_size=500, max_chunk_bytes=10485760,
+                   thread_count=None):
+        """Bulk equivalent of ``index()`` for an iterable of stix2 objects.
+
+        Objects are taken ``chunk_size`` at a time and checked for existence
+        with a single ``mget`` per chunk. New objects become ``create``
+        actions; existing objects are up-versioned (new version, the
+        ``derived-from`` relationship and the revocation of the old version)
+        if ``up_version`` is set and skipped otherwise. All actions are sent
+        through ``helpers.streaming_bulk`` (or ``helpers.parallel_bulk`` if
+        ``thread_count`` is set). Old versions are revoked in a second pass,
+        once every create has been sent, and only where both of the new
+        version's creates succeeded. Edges, the graph snapshot and the
+        molecule store only follow the writes that succeeded.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            objects (:obj:`list` of :obj:`dict`): List (or any iterable) of
+                JSON serializable stix2 object dictionaries.
+            up_version (:obj:`bool`, optional): Determines if stix
+                up-versioning should be applied to objects that already
+                exist.
+            refresh (:obj:`bool`, optional): Refresh the written indices once
+                all actions have been sent.
+            chunk_size (:obj:`int`, optional): Number of objects per existence
+                check and number of actions per bulk request.
+            max_chunk_bytes (:obj:`int`, optional): Maximum size of a bulk
+                request in bytes.
+            thread_count (:obj:`int`, optional): Number of threads to send
+                bulk requests with. Defaults to ``None`` (single, streaming
+                connection).
+
+        Returns:
+            :obj:`tuple`: ``(id_list, failed)`` where ``id_list`` is as per
+            ``index()`` for each successfully indexed object and ``failed``
+            is a list of ``(stix_id, error)`` tuples for the objects that
+            could not be indexed.
+        """
+        pending = collections.deque()
+        outcomes = {}
+        written = set()
+        revoked = []
+        touched = set()
+        edges = self.has_edges()
+        molecules = self.has_molecules()
+
+        def actions():
+            seen = set()
+            count = 0
+            for chunk in chunk_list(objects, chunk_size):
+                keys = [tuple(obj['id'].split('--')) for obj in chunk]
+                found = self.known_ids.lookup(self, keys)
+                plans = []
+                for obj, key in zip(chunk, keys):
+                    # Also treat repeats within the same run as existing
+                    exists = key in found or obj['id'] in seen
+                    seen.add(obj['id'])
+                    if not exists:
+                        plans.append((obj, key, None))
+                    elif up_version:
+                        plans.append((obj, key, new_obj_version(
+                            user_id=user_id, stix_object=dict(obj))))
+                    else:
+                        plans.append((None, key, None))
+                if self.schema_hits:
+                    # One percolate request for every object of the chunk
+                    tagged = iter(self.__tag_schema_hits(
+                        [new_obj for obj, key, new_objs in plans
+                         if obj is not None
+                         for new_obj in (new_objs or [obj])]))
+                    for i, (obj, key, new_objs) in enumerate(plans):
+                        if obj is None:
+                            continue
+                        if new_objs:
+                            plans[i] = (obj, key, [next(tagged)
+                                                   for new_obj in new_objs])
+                        else:
+                            plans[i] = (next(tagged), key, None)
+                for obj, key, new_objs in plans:
+                    index_name, doc_id = key
+                    count += 1
+                    if obj is None:
+                        continue
+                    if new_objs is None:
+                        outcomes[count] = [obj['id'], doc_id, 1, None,
+                                           [key], None]
+                        written.add(index_name)
+                        pending.append((count, obj))
+                        yield {"_op_type": "create",
+                               "_index": index_name,
+                               "_id": doc_id,
+                               "_source": obj}
+                        continue
+                    outcomes[count] = [obj['id'], [new_objs[1]['id']], 2,
+                                       None, [], key]
+                    for new_obj in new_objs:
+                        new_id_parts = new_obj['id'].split('--')
+                        outcomes[count][4].append(tuple(new_id_parts))
+                        written.add(new_id_parts[0])
+                        pending.append((count, new_obj))
+                        yield {"_op_type": "create",
+                               "_index": new_id_parts[0],
+                               "_id": new_id_parts[1],
+                               "_source": new_obj}
+
+        def send(actions):
+            if thread_count:
+                return helpers.parallel_bulk(self, actions,
+                                             thread_count=thread_count,
+                                             chunk_size=chunk_size,
+                                             max_chunk_bytes=max_chunk_bytes,
+                                             raise_on_error=False,
+                                             raise_on_exception=False)
+            return helpers.streaming_bulk(self, actions,
+                                          chunk_size=chunk_size,
+                                          max_chunk_bytes=max_chunk_bytes,
+                                          raise_on_error=False,
+                                          raise_on_exception=False)
+
+        def item_error(item):
+            return next(iter(item.values())).get('error', item)
+
+        # Results by count so that id_list keeps the order of the objects
+        done = {}
+        failed = []
+        revokes = []
+        edge_queue = []
+        for ok, item in send(actions()):
+            key, target = pending.popleft()
+            if ok:
+                # Edges and nodes only for the objects that were created
+                if self.graph_snapshot is not None:
+                    self.graph_snapshot.add(target)
+                if molecules:
+                    touched.update(self.__touched(target))
+                if edges:
+                    edge_queue.extend(edge_actions(target))
+                    if len(edge_queue) >= chunk_size:
+                        self.__put_edges(edge_queue)
+                        edge_queue = []
+            obj_id, res, remaining, error, new_keys, old_key = outcomes[key]
+            if not ok and error is None:
+                error = item_error(item)
+            remaining -= 1
+            if remaining:
+                outcomes[key] = [obj_id, res, remaining, error, new_keys,
+                                 old_key]
+                continue
+            if error is not None:
+                failed.append((obj_id, error))
+                del outcomes[key]
+                continue
+            for new_key in new_keys:
+                self.known_ids.add(new_key)
+            if old_key is None:
+                done[key] = res
+                del outcomes[key]
+            else:
+                # New version in place, the old one can now be revoked
+                revokes.append(key)
+        self.__put_edges(edge_queue)
+
+        def revoke_actions():
+            for key in revokes:
+                index_name, doc_id = outcomes[key][5]
+                yield {"_op_type": "update",
+                       "_index": index_name,
+                       "_id": doc_id,
+                       "doc": {"revoked": True}}
+
+        for key, (ok, item) in zip(revokes, send(revoke_actions())):
+            obj_id, res, remaining, error, new_keys, old_key = outcomes[key]
+            if ok:
+                revoked.append('--'.join(old_key))
+                done[key] = res
+            else:
+                failed.append((obj_id, item_error(item)))
+            del outcomes[key]
+        id_list = [done[key] for key in sorted(done)]
+        self.__drop_edges(revoked)
+        if self.graph_snapshot is not None:
+            self.graph_snapshot.remove(revoked)
+        self.__stale_molecules(touched | set(revoked))
+        if edges and written:
+            written.add(edges_index)
+        if refresh and written:
+            self.indices.refresh(index=sorted(written))
+        return id_list, failed
+
+    def revoke_objects(self, user_id, stix_ids, refresh=False):
+        """Mark a list of objects as revoked in a single bulk request.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            stix_ids (:obj:`list` of :obj:`str`): Stix2 object ids to revoke.
+            refresh (:obj:`bool`, optional): Pass through to the bulk request
+                to determine the refresh policy.
+
+        Returns:
+            :obj:`bool`: ``True`` for success; ``False`` if any object could
+            not be revoked.
+        """
+        actions = []
+        for stix_id in stix_ids:
+            obj_id_parts = stix_id.split('--')
+            actions.append({"_op_type": "update",
+                            "_index": obj_id_parts[0],
+                            "_id": obj_id_parts[1],
+                            "doc": {"revoked": True}})
+        if not actions:
+            return True
+        revoked = []
+        errors = False
+        for stix_id, (ok, item) in zip(stix_ids, helpers.streaming_bulk(
+                self, actions, refresh=refresh, raise_on_error=False,
+                raise_on_exception=False)):
+            if ok:
+                revoked.append(stix_id)
+            else:
+                print('Failed to revoke object: ' + str(item))
+                errors = True
+        # Objects that are still live keep their edges and molecules
+        self.__drop_edges(revoked, refresh=refresh)
+        if self.graph_snapshot is not None:
+            self.graph_snapshot.remove(revoked)
+        self.__stale_molecules(set(revoked))
+        return not errors
+
+    def load_graph(self, size=5000):
+        """Load an in-memory snapshot of the repository graph (see
+        ``git4intel.graph``) for ``get_molecule()`` and ``get_molecules()``
+        to expand molecules with, going to elasticsearch only for the final
+        objects. The client keeps it up to date with its own writes; call
+        again to pick up writes made by other clients, or set
+        ``graph_snapshot`` to ``None`` to go back to searching
+        elasticsearch.
+
+        Args:
+            size (:obj:`int`, optional): Scroll page size.
+
+        Returns:
+            :obj:`dict`: Size of the snapshot (see ``GraphSnapshot.stats()``).
+        """
+        graph = GraphSnapshot()
+        stats = graph.build(self, size=size)
+        self.graph_snapshot = graph
+        return stats
+
+    def has_edges(self):
+        """Check whether the repository has an edge index (see
+        ``git4intel.edges``) to walk the graph with. Repositories set up
+        before the edge index was introduced fall back to searching the
+        reference fields until ``rebuild_edges()`` is run.
+
+        Returns:
+            :obj:`bool`: ``True`` if the edge index exists.
+        """
+        if self.__edges is None:
+            self.__edges = bool(self.indices.exists(index=edges_index))
+        return self.__edges
+
+    def rebuild_edges(self, chunk_size=500):
+        """(Re)build the edge index from every current (not revoked)
+        object in the repository.
+
+        Args:
+            chunk_size (:obj:`int`, optional): Number of actions per bulk
+                request.
+
+        Returns:
+            :obj:`int`: Number of edges written.
+        """
+        self.indices.delete(index=edges_index, ignore=[404])
+        self.indices.create(index=edges_index, body=edges_mapping)
+        self.__edges = True
+
+        def actions():
+            for hit in helpers.scan(self,
+                                    query={"query": {"match_all": {}}},
+                                    index='intel',
+                                    user_id=self.identity['id'],
+                                    _md=False):
+                for action in edge_actions(hit['_source']):
+                    yield action
+
+        count, errors = helpers.bulk(self, actions(), chunk_size=chunk_size,
+                                     raise_on_error=False,
+                                     raise_on_exception=False)
+        for error in errors:
+            print('Failed to index edge: ' + str(error))
+        self.indices.refresh(index=edges_index)
+        return count
+
+    def get_edges(self, stix_ids, relationships=False, direction=None,
+                  size=10000):
+        """Get the edges (see ``git4intel.edges``) of a list of objects
+        with a keyword lookup on the edge index.
+
+        Args:
+            stix_ids (:obj:`list` of :obj:`str`): STIX2 object reference ids.
+            relationships (:obj:`bool`, optional): ``True`` to only get the
+                edges made by relationship objects.
+            direction (:obj:`str`, optional): ``'in'`` or ``'out'`` to only
+                get edges in that direction.
+            size (:obj:`int`, optional): Page size; if there are more edges
+                than this they are scrolled.
+
+        Returns:
+            :obj:`list` of :obj:`dict`: Edge documents.
+        """
+        _filter = [{"terms": {"stix_id": sorted(set(stix_ids))}}]
+        if relationships:
+            _filter.append({"exists": {"field": "relationship_type"}})
+        if direction:
+            _filter.append({"term": {"direction": direction}})
+        q = {"query": {"bool": {"filter": _filter}}}
+        res = self.real_search(index=edges_index, body=q, size=size)
+        hits = res['hits']['hits']
+        if res['hits']['total']['value'] > len(hits):
+            hits = helpers.scan(self, query=q, index=edges_index, size=size,
+                                user_id=self.identity['id'], _md=False)
+        return [hit['_source'] for hit in hits]
+
+    def __put_edges(self, actions):
+        """Supporting function to write edge actions (see
+        ``git4intel.edges``) with a single bulk request.
+
+        Args:
+            actions (:obj:`list` of :obj:`dict`): Edge index actions.
+        """
+        if not actions:
+            return
+        success, errors = helpers.bulk(self, actions,
+                                       raise_on_error=False,
+                                       raise_on_exception=False)
+        for error in errors:
+            print('Failed to index edge: ' + str(error))
+
+    def __drop_edges(self, stix_ids, refresh=False):
+        """Supporting function to remove the edges made by objects that
+        are no longer current (revoked or up-versioned).
+
+        Args:
+            stix_ids (:obj:`list` of :obj:`str`): STIX2 object reference ids.
+            refresh (:obj:`bool`, optional): Refresh the edge index
+                afterwards.
+        """
+        if not stix_ids or not self.has_edges():
+            return
+        self.delete_by_query(index=edges_index,
+                             body={"query": {"terms": {
+                                 "rel_ref": sorted(set(stix_ids))}}},
+                             refresh=bool(refresh),
+                             conflicts='proceed')
+
+    def has_molecules(self):
+        """Check whether the repository has a materialized molecule store
+        (see ``git4intel.molecules``).
+
+        Returns:
+            :obj:`bool`: ``True`` if the molecule index exists.
+        """
+        if self.__molecules is None:
+            self.__molecules = bool(self.indices.exists(index=molecules_index))
+        return self.__molecules
+
+    def materialize_molecules(self, seeds, schema_name, refresh=False,
+                              chunk_size=500):
+        """Resolve molecules and save them in the molecule store (see
+        ``git4intel.molecules``) for ``get_materialized_molecules()``. Once
+        saved, the client flags the molecules affected by its writes and
+        revocations as stale and they are recomputed when next read.
+
+        Args:
+            seeds (:obj:`list` of :obj:`str`): STIX2 object reference ids,
+                one per molecule.
+            schema_name (:obj:`str`): Name of the molecule schema.
+            refresh (:obj:`bool`, optional): Refresh the molecule index
+                afterwards.
+            chunk_size (:obj:`int`, optional): Number of molecules to
+                resolve (as per ``get_molecules()``) and save at a time.
+
+        Returns:
+            :obj:`int`: Number of molecules saved (``False`` if the schema
+            does not exist).
+        """
+        docs = self.__materialize(seeds=seeds, schema_name=schema_name,
+                                  refresh=refresh, chunk_size=chunk_size)
+        if docs is False:
+            return False
+        return len(docs)
+
+    def __materialize(self, seeds, schema_name, refresh=False,
+                      chunk_size=500):
+        """Supporting function to resolve and save molecules.
+
+        Args:
+            seeds (:obj:`list` of :obj:`str`): As per
+                ``materialize_molecules()``.
+            schema_name (:obj:`str`): Name of the molecule schema.
+            refresh (:obj:`bool`, optional): Refresh the molecule index
+                afterwards.
+            chunk_size (:obj:`int`, optional): As per
+                ``materialize_molecules()``.
+
+        Returns:
+            :obj:`dict`: Molecule documents saved, by seed (``False`` if the
+            schema does not exist).
+        """
+        if not self.get_compiled_schema(schema_name):
+            return False
+        if not self.has_molecules():
+            self.indices.create(index=molecules_index,
+                                body=molecules_mapping, ignore=400)
+            self.__molecules = True
+        created = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        docs = {}
+        seeds = list(collections.OrderedDict.fromkeys(seeds))
+        for chunk in chunk_list(seeds, chunk_size):
+            report = {}
+            molecules = self.get_molecules(user_id=self.identity['id'],
+                                           seeds=chunk,
+                                           schema_name=schema_name,
+                                           _md=False,
+                                           report=report)
+            actions = []
+            for seed in chunk:
+                ids = molecules[seed]
+                core = report['molecules'][seed]['core']
+                docs[seed] = molecule_doc(seed, schema_name, ids,
+                                          bool(ids) and all(core), created)
+                actions.append({"_op_type": "index",
+                                "_index": molecules_index,
+                                "_id": molecule_id(seed, schema_name),
+                                "_source": docs[seed]})
+            success, errors = helpers.bulk(self, actions,
+                                           raise_on_error=False,
+                                           raise_on_exception=False)
+            for error in errors:
+                print('Failed to save molecule: ' + str(error))
+        if refresh:
+            self.indices.refresh(index=molecules_index)
+        return docs
+
+    def get_materialized_molecules(self, user_id, schema_name, seeds=None,
+                                   objs=None, query=None, _md=None):
+        """Read molecules from the molecule store (see
+        ``materialize_molecules()``) with a single search, recomputing only
+        those that are stale. Seeds that have not been materialized yet are
+        resolved and saved first.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            schema_name (:obj:`str`): Name of the molecule schema.
+            seeds (:obj:`list` of :obj:`str`, optional): STIX2 object
+                reference ids of the seeds. Defaults to every materialized
+                molecule of the schema.
+            objs (:obj:`bool`, optional): ``True`` to return full objects
+                (fetched through the user's marking definitions as per
+                ``_md``); ``False`` to return id references only (faster).
+            query (:obj:`dict`, optional): As per ``get_molecule()``.
+            _md (:obj:`bool`, optional): As per ``get_molecule()``; the
+                molecule ids are limited to those that the user can see.
+
+        Returns:
+            :obj:`dict`: For each seed, the molecule as per
+            ``get_molecules()``.
+        """
+        if _md is None:
+            _md = True
+        if not isinstance(schema_name, str):
+            return False
+
+        docs = {}
+        if self.has_molecules():
+            _filter = [{"term": {"schema": schema_name}}]
+            if seeds is not None:
+                seeds = list(collections.OrderedDict.fromkeys(seeds))
+                _filter.append({"terms": {"seed_ref": seeds}})
+            q = {"query": {"bool": {"filter": _filter}}}
+            res = self.real_search(index=molecules_index, body=q, size=10000)
+            hits = res['hits']['hits']
+            if res['hits']['total']['value'] > len(hits):
+                hits = helpers.scan(self, query=q, index=molecules_index,
+                                    user_id=self.identity['id'], _md=False)
+            for hit in hits:
+                docs[hit['_source']['seed_ref']] = hit['_source']
+        if seeds is None:
+            seeds = list(docs)
+        outdated = [seed for seed in seeds
+                    if seed not in docs or docs[seed]['stale']]
+        if outdated:
+            fresh = self.__materialize(seeds=outdated,
+                                       schema_name=schema_name)
+            if fresh is False:
+                return False
+            docs.update(fresh)
+
+        # Molecules are resolved without marking definitions, so only give
+        # back the members that the user can see
+        visible = None
+        if _md:
+            visible = self.__visible_ids(
+                        user_id=user_id,
+                        stix_ids=set(ref for seed in seeds
+                                     if docs[seed]['found']
+                                     for ref in docs[seed]['member_refs']))
+        molecules = collections.OrderedDict()
+        for seed in seeds:
+            doc = docs[seed]
+            member_refs = doc['member_refs']
+            found = doc['found']
+            if found and visible is not None:
+                member_refs = [ref for ref in member_refs if ref in visible]
+                if len(member_refs) < len(doc['member_refs']):
+                    # Found only if something other than the seed is left
+                    found = bool(set(member_refs) - set([seed]))
+            molecules[seed] = member_refs if found else False
+        if not objs:
+            return dict(molecules)
+        return self.__molecule_objs(user_id=user_id,
+                                    molecules=molecules,
+                                    schema_name=schema_name,
+                                    query=query,
+                                    _md=_md)
+
+    def __visible_ids(self, user_id, stix_ids):
+        """Supporting function to check which of a set of ids a user can
+        see, with an id only search through their marking definitions.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            stix_ids (:obj:`set` of :obj:`str`): STIX2 object reference ids.
+
+        Returns:
+            :obj:`set` of :obj:`str`: The ids that the user can see.
+        """
+        if not stix_ids:
+            return set()
+        q = {"query": {"terms": {"id": sorted(set(_id.split('--')[1]
+                                                  for _id in stix_ids))}},
+             "_source": ['id']}
+        res = self.search(user_id=user_id, body=q, size=10000)
+        hits = res['hits']['hits']
+        if res['hits']['total']['value'] > len(hits):
+            hits = helpers.scan(self, query=q, index='intel',
+                                user_id=user_id)
+        return set(hit['_source']['id'] for hit in hits) & set(stix_ids)
+
+    def __touched(self, obj):
+        """Supporting function to get the ids that a write of an object can
+        change the molecules of: its own and those that it references.
+
+        Args:
+            obj (:obj:`dict`): JSON serializable stix2 object dictionary.
+
+        Returns:
+            :obj:`set` of :obj:`str`: STIX2 object reference ids.
+        """
+        touched = set([obj['id']])
+        touched.update(ref for field, ref in _iter_refs(obj))
+        return touched
+
+    def __stale_molecules(self, stix_ids):
+        """Supporting function to flag the materialized molecules that hold
+        any of a set of ids (see ``git4intel.molecules``) as stale.
+
+        Args:
+            stix_ids (:obj:`set` of :obj:`str`): STIX2 object reference ids
+                of the objects written or revoked and of the objects that
+                they reference.
+        """
+        if not stix_ids or not self.has_molecules():
+            return
+        doc_ids = set()
+        for chunk in chunk_list(sorted(stix_ids), 10000):
+            q = {"query": {"bool": {"filter": [
+                    {"terms": {"member_refs": chunk}},
+                    {"term": {"stale": False}}]}},
+                 "_source": False}
+            for hit in helpers.scan(self, query=q, index=molecules_index,
+                                    user_id=self.identity['id'], _md=False):
+                doc_ids.add(hit['_id'])
+        if not doc_ids:
+            return
+        actions = [{"_op_type": "update",
+                    "_index": molecules_index,
+                    "_id": doc_id,
+                    "doc": {"stale": True}} for doc_id in sorted(doc_ids)]
+        success, errors = helpers.bulk(self, actions,
+                                       raise_on_error=False,
+                                       raise_on_exception=False)
+        for error in errors:
+            print('Failed to flag molecule: ' + str(error))
+
+    def tag_schema_hits(self, chunk_size=500):
+        """(Re)tag every current (not revoked) object in the repository with
+        the molecule schema components that it satisfies
+        (``x_g4i_schema_hits``, eg: ``incident.core.0``), percolating
+        ``chunk_size`` objects per request against ``stix-perc``. Run this
+        before setting ``schema_hits`` on a client and again whenever the
+        schemas change. The tags are internal: ``search()``,
+        ``get_objects()`` and ``data_dump()`` leave them out of the objects
+        that they return.
+
+        Args:
+            chunk_size (:obj:`int`, optional): Number of objects per
+                percolate and bulk request.
+
+        Returns:
+            :obj:`int`: Number of objects tagged.
+        """
+        def actions():
+            hits = helpers.scan(self,
+                                query={"query": {"match_all": {}}},
+                                index='intel',
+                                user_id=self.identity['id'],
+                                _md=False)
+            for chunk in chunk_list(hits, chunk_size):
+                tagged = self.__tag_schema_hits([hit['_source']
+                                                 for hit in chunk])
+                for hit, obj in zip(chunk, tagged):
+                    yield {"_op_type": "update",
+                           "_index": hit['_index'],
+                           "_id": hit['_id'],
+                           "doc": {"x_g4i_schema_hits":
+                                   obj['x_g4i_schema_hits']}}
+
+        count, errors = helpers.bulk(self, actions(), chunk_size=chunk_size,
+                                     raise_on_error=False,
+                                     raise_on_exception=False)
+        for error in errors:
+            print('Failed to tag object: ' + str(error))
+        self.indices.refresh(index='intel')
+        return count
+
+    def __tag_schema_hits(self, objs):
+        """Supporting function to tag objects with the molecule schema
+        components that they satisfy, with one multi-document percolate
+        request (per schema part) against ``stix-perc``. The percolator
+        gives the schemas whose ``core``/``ext`` queries match each object
+        and the compiled schema (see ``get_compiled_schema()``) gives the
+        components within them.
+
+        Args:
+            objs (:obj:`list` of :obj:`dict`): JSON serializable stix2 object
+                dictionaries.
+
+        Returns:
+            :obj:`list` of :obj:`dict`: Copies of the objects with
+            ``x_g4i_schema_hits`` set.
+        """
+        documents = [dict((key, value) for key, value in obj.items()
+                          if key != 'x_g4i_schema_hits') for obj in objs]
+        if not documents:
+            return []
+        parts = ('core', 'ext')
+        body = []
+        for part in parts:
+            body.append({"index": "stix-perc"})
+            body.append({"query": {"percolate": {"field": part,
+                                                 "documents": documents}},
+                         "_source": ['name'],
+                         "size": 10000})
+        responses = super().msearch(body=body)['responses']
+        schema_hits = [set() for document in documents]
+        for part, res in zip(parts, responses):
+            if 'error' in res:
+                print(res['error'])
+                continue
+            for hit in res['hits']['hits']:
+                schema_name = hit['_source']['name']
+                compiled = self.get_compiled_schema(schema_name)
+                if not compiled:
+                    continue
+                slots = hit.get('fields', {}).get(
+                    '_percolator_document_slot', [0])
+                for slot in slots:
+                    values = source_values(documents[slot], compiled.kinds)
+                    for count, component in enumerate(getattr(compiled,
+                                                              part)):
+                        if component.test(values):
+                            schema_hits[slot].add(
+                                schema_name + '.' + part + '.' + str(count))
+        for document, tags in zip(documents, schema_hits):
+            document['x_g4i_schema_hits'] = sorted(tags)
+        return documents
+
     def __load_schemas(self):
         mappings = self.indices.get_mapping(index="_all")
         master_map = {}
@@ -325,11 +1321,8 @@ class Client(Elasticsearch):
             'mappings': {'properties': master_map}}
 
         self.indices.create(index="stix-perc", body=master_map, ignore=400)
-        for schema_name in pkg_resources.contents(schemas):
-            if not schema_name[-5:] == '.json':
-                continue
+        for schema_name, schema in self.__packaged_schemas():
             print('Loading: ' + schema_name)
-            schema = json.loads(pkg_resources.read_text(schemas, schema_name))
             if 'id' in schema:
                 _id = schema['id']
             else:
@@ -337,21 +1330,167 @@ class Client(Elasticsearch):
                                              seed=schema['name'])
             self.index(user_id=self.identity['id'], index='stix-perc',
                        id=_id.split('--')[1], body=schema, refresh='wait_for')
+        # Picked up again from stix-perc on next use
+        self.__schemas = None
+        self.__compiled = {}
         return
 
-    def get_schema(self, schema_name):
-        _id = get_deterministic_uuid(prefix='percolator--', seed=schema_name)
-        schema = self.get_object(user_id=self.identity['id'], obj_id=_id, _md=False)
-        return schema
+    def __packaged_schemas(self):
+        """Supporting function to read the molecule schemas packaged with
+        git4intel (``git4intel/schemas``).
 
-    def get_all_schemas(self):
-        q = {"query": {"match_all": {}}}
-        res = self.search(user=self.identity['id'], index='stix-perc', body=q)
+        Returns:
+            :obj:`list` of :obj:`tuple`: Resource file name and molecule
+            schema (:obj:`dict`) for each schema.
+        """
         schema_list = []
-        for obj in hits_from_res(res):
-            schema_list.append(obj)
+        for schema_name in sorted(pkg_resources.contents(schemas)):
+            if not schema_name[-5:] == '.json':
+                continue
+            schema_list.append((schema_name, json.loads(
+                pkg_resources.read_text(schemas, schema_name))))
         return schema_list
 
+    def __get_schemas(self, force_refresh=False):
+        """Supporting function to get the in-process cache of molecule
+        schemas by name, loading it with a single search of ``stix-perc`` on
+        first use (or from the packaged schemas if none have been loaded in
+        to the repository yet).
+
+        Args:
+            force_refresh (:obj:`bool`, optional): Reload the cache.
+
+        Returns:
+            :obj:`dict`: Molecule schemas (:obj:`dict`) by name.
+        """
+        if self.__schemas is not None and not force_refresh:
+            return self.__schemas
+        schema_cache = {}
+        q = {"query": {"match_all": {}}}
+        try:
+            res = self.search(user_id=self.identity['id'], index='stix-perc',
+                              body=q, _md=False)
+            for obj in hits_from_res(res):
+                schema_cache[obj['name']] = obj
+        except exceptions.NotFoundError:
+            pass
+        if not schema_cache:
+            for schema_name, schema in self.__packaged_schemas():
+                schema_cache[schema['name']] = schema
+        self.__schemas = schema_cache
+        self.__compiled = {}
+        return schema_cache
+
+    def get_schema(self, schema_name, force_refresh=False):
+        """Get a molecule schema by name. Served from an in-process cache
+        that is loaded once and dropped whenever the schemas are (re)loaded
+        by this client.
+
+        Args:
+            schema_name (:obj:`str`): Name of the molecule schema.
+            force_refresh (:obj:`bool`, optional): Reload the cache first
+                (eg: to pick up schemas loaded by another client).
+
+        Returns:
+            :obj:`dict`: Molecule schema (``False`` if there is no such
+            schema).
+        """
+        schema_cache = self.__get_schemas(force_refresh=force_refresh)
+        if schema_name in schema_cache:
+            return schema_cache[schema_name]
+        # Not seen yet: may have been loaded since the cache was
+        _id = get_deterministic_uuid(prefix='percolator--', seed=schema_name)
+        schema = self.get_object(user_id=self.identity['id'], obj_id=_id,
+                                 _md=False)
+        if schema:
+            schema_cache[schema_name] = schema
+        return schema
+
+    def get_all_schemas(self, force_refresh=False):
+        """Get every molecule schema, from the same cache as
+        ``get_schema()``.
+
+        Args:
+            force_refresh (:obj:`bool`, optional): Reload the cache first.
+
+        Returns:
+            :obj:`list` of :obj:`dict`: Molecule schemas.
+        """
+        return list(self.__get_schemas(force_refresh=force_refresh).values())
+
+    def get_compiled_schema(self, schema_name):
+        """Get a molecule schema compiled in to matchers (see
+        ``git4intel.matchers``) that give efficient ``term``/``prefix``
+        filters for elasticsearch and can be evaluated against objects that
+        have already been fetched. Compiled once per client and recompiled
+        after the schemas are (re)loaded.
+
+        Args:
+            schema_name (:obj:`str`): Name of the molecule schema.
+
+        Returns:
+            :obj:`CompiledSchema`: Compiled schema (``False`` if the schema
+            does not exist or cannot be compiled).
+        """
+        try:
+            return self.__compiled[schema_name]
+        except KeyError:
+            pass
+        schema = self.get_schema(schema_name)
+        if not schema:
+            return False
+        return self.__compile_schemas([schema])[schema_name]
+
+    def compile_schemas(self):
+        """Compile every molecule schema in the repository (see
+        ``get_compiled_schema()``).
+
+        Returns:
+            :obj:`dict`: Compiled schemas (:obj:`CompiledSchema`) by name.
+        """
+        schema_list = self.get_all_schemas()
+        missing = [schema for schema in schema_list
+                   if schema.get('name') not in self.__compiled]
+        if missing:
+            self.__compile_schemas(missing)
+        return dict((schema.get('name'), self.__compiled[schema.get('name')])
+                    for schema in schema_list)
+
+    def __compile_schemas(self, schema_list):
+        """Supporting function to compile a list of molecule schemas with
+        one field mapping lookup, caching the results by name.
+
+        Args:
+            schema_list (:obj:`list` of :obj:`dict`): Molecule schemas.
+
+        Returns:
+            :obj:`dict`: Compiled schemas (:obj:`CompiledSchema`, or
+            ``False`` if they cannot be compiled) by name.
+        """
+        fields = set()
+        for schema in schema_list:
+            fields.update(schema_fields(schema))
+        mapping_types = {}
+        if fields:
+            res = self.indices.get_field_mapping(index='intel',
+                                                 fields=sorted(fields))
+            for index_mapping in res.values():
+                for field, mapping in index_mapping['mappings'].items():
+                    leaf = mapping['mapping'][field.split('.')[-1]]
+                    mapping_types[field] = leaf.get('type')
+        kinds = dict((field, field_kind(field, mapping_types.get(field)))
+                     for field in fields)
+        compiled = {}
+        for schema in schema_list:
+            try:
+                compiled[schema['name']] = CompiledSchema(schema, kinds)
+            except (KeyError, ValueError) as e:
+                print('Cannot compile schema ' + str(schema.get('name')) +
+                      ': ' + str(e))
+                compiled[schema.get('name')] = False
+        self.__compiled.update(compiled)
+        return compiled
+
     def store_core_data(self):
         """Should be run once for setup of the necessary CTI core data to turn
         elasticsearch in to a CTI repository.
@@ -416,6 +1555,12 @@ class Client(Elasticsearch):
             filters will be created by get_id_markings() when the user runs
             their first query.
 
+        The aliases of every named user are listed together (with their
+        filters) and updated with a single ``update_aliases`` request. With
+        ``access_lists`` set the users' access list documents are updated
+        instead (in a single bulk request) and the aliases are left as they
+        are.
+
         Args:
             md_obj (:obj:`dict`): TLP+ object to be applied.
 
@@ -428,25 +1573,90 @@ class Client(Elasticsearch):
         if not md_obj['definition_type'] == 'tlp-plus':
             return False
 
-        aliases_info = self.cat.aliases(format='json')
-
-        done_aliases = []
-        md_add = {"match": {"object_marking_refs": md_obj['id']}}
-        for user_id in md_obj['definition']['distribution_refs']:
-            for alias_info in aliases_info:
-                if not re.match(r'.+--' + re.escape(user_id.split('--')[1]) + r'--+',
-                                alias_info['alias']):
+        # Distribution lists can name orgs as well as users, so every
+        #   cached alias has to be checked again
+        self.md_aliases.invalidate()
+        user_ids = sorted(set(md_obj['definition']['distribution_refs']))
+        if self.access_lists:
+            return self.__update_access_lists(user_ids=user_ids,
+                                              md_id=md_obj['id'])
+
+        # Aliases of the named users by name, with their filters (url
+        #   patterns are chunked to keep request lines short)
+        aliases = {}
+        for chunk in chunk_list(user_ids, 50):
+            res = self.indices.get_alias(
+                name=['*--' + user_id.split('--')[1] + '--*'
+                      for user_id in chunk],
+                ignore=404)
+            for index_name, info in res.items():
+                if not isinstance(info, dict) or 'aliases' not in info:
+                    continue
+                for name, meta in info['aliases'].items():
+                    aliases.setdefault(name, {})[index_name] = \
+                        meta.get('filter')
+
+        md_add = {"match": {"object_marking_refs":
+                            md_obj['id'].split('--')[1]}}
+        actions = []
+        for name, filters in sorted(aliases.items()):
+            new_filters = {}
+            for index_name, _filter in sorted(filters.items()):
+                try:
+                    should = _filter['bool']['should']
+                except (KeyError, TypeError):
+                    continue
+                if md_add in should:
                     continue
-                if alias_info['alias'] not in done_aliases:
-
-                    res = self.indices.get_alias(name=alias_info['alias'])
-                    for key in res:
-                        _filter = res[key]['aliases'][alias_info['alias']]
-                        new_filter = _filter['filter']['bool']['should'].append(md_add)
-                        self.indices.put_alias(index=key,
-                                               name=alias_info['alias'],
-                                               body=new_filter)
-                done_aliases.append(alias_info['alias'])
+                new_filter = {"bool": dict(_filter['bool'],
+                                           should=should + [md_add])}
+                key = json.dumps(new_filter, sort_keys=True)
+                new_filters.setdefault(key, (new_filter, []))[1].append(
+                    index_name)
+            for new_filter, indices in new_filters.values():
+                actions.append({"add": {"indices": indices,
+                                        "alias": name,
+                                        "filter": new_filter}})
+        if actions:
+            self.indices.update_aliases(body={"actions": actions})
+        return True
+
+    def __update_access_lists(self, user_ids, md_id):
+        """Add a marking definition to the access list documents (see
+        ``git4intel.markings``) of the users that have one.
+
+        Args:
+            user_ids (:obj:`list` of :obj:`str`): STIX2 identity object
+                reference ids.
+            md_id (:obj:`str`): STIX2 marking definition reference id.
+
+        Returns:
+            :obj:`bool`: ``True`` (users without a document pick the
+            marking definition up when their access is next resolved).
+        """
+        res = self.mget(index=access_lists_index, body={"ids": user_ids},
+                        ignore=404)
+        actions = []
+        for doc in res.get('docs', []):
+            if not doc.get('found', False):
+                continue
+            source = doc['_source']
+            if md_id in source['marking_refs']:
+                continue
+            md_filter = MarkingFilter(
+                marking_refs=source['marking_refs'] + [md_id],
+                pii_refs=source['pii_refs'],
+                pii_marking_ref=self.pii_marking['id'])
+            actions.append({"_op_type": "index",
+                            "_index": access_lists_index,
+                            "_id": doc['_id'],
+                            "_source": md_filter.access_doc()})
+        if actions:
+            success, errors = helpers.bulk(self, actions,
+                                           raise_on_error=False,
+                                           raise_on_exception=False)
+            for error in errors:
+                print('Failed to update access list: ' + str(error))
         return True
 
     def set_tlpplus(self, user_id, md_name, tlp_marking_def_ref,
@@ -492,10 +1702,8 @@ class Client(Elasticsearch):
         distribution_refs = sorted(set(distribution_refs))
         md_id = get_deterministic_uuid(prefix='marking-definition--',
                                        seed=str(distribution_refs))
-        if self.exists(index='marking-definition',
-                       id=md_id.split('--')[1],
-                       _source=False,
-                       ignore=[400, 404]):
+        if self.id_exists(index='marking-definition',
+                          doc_id=md_id.split('--')[1]):
             return md_id,
         tlp_plus = TLPPlusMarking(tlp_marking_def_ref=tlp_marking_def_ref,
                                   distribution_refs=ref_list)
@@ -525,10 +1733,30 @@ class Client(Elasticsearch):
                 user running the function.
             stix_id (:obj:`str`): marking definition id reference to be added.
         """
+        return self.set_new_osdms(user_id=user_id, stix_ids=[stix_id])
+
+    def set_new_osdms(self, user_id, stix_ids):
+        """As per ``set_new_osdm()`` for a list of marking definition id
+        references, applied to the grouping in a single up-version.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            stix_ids (:obj:`list` of :obj:`str`): marking definition id
+                references to be added.
+
+        Returns:
+            :obj:`str`: New grouping id; ``True`` if all of the references
+            were already in the grouping.
+        """
         os_group = self.get_object(user_id=user_id, obj_id=self.os_group_id)
-        if stix_id in os_group['object_refs']:
+        new_ids = [stix_id for stix_id in stix_ids
+                   if stix_id not in os_group['object_refs']]
+        if not new_ids:
             return True
-        os_group['object_refs'].append(stix_id)
+        for stix_id in new_ids:
+            if stix_id not in os_group['object_refs']:
+                os_group['object_refs'].append(stix_id)
 
         res = self.index(user_id=user_id, body=os_group, refresh='wait_for')
         self.os_group_id = res[0]
@@ -562,15 +1790,22 @@ class Client(Elasticsearch):
             willing to be sacrificed over accuracy in these cases, enable
             ``force_refresh``.
 
+        A rebuild resolves the user's access once (``get_marking_filter()``)
+        and rolls all of the user's aliases over to the new time slice in a
+        single ``update_aliases`` request, leaving alone any alias that
+        already has the filter. Concurrent rebuilds for the same user are
+        coalesced into one.
+
         Args:
             user_id (:obj:`str`): STIX2 identity object reference id for the
                 user running the function.
             index_alias (:obj:`str`): The index string being used in the query
                 (that will have the alias filter).
-            force_refresh (:obj:`bool`): Even if an existing filter is found,
-                refresh it anyway (useful if you suspect that a new marking
-                definition has been applied that might be applicable to the
-                user - but much slower as index alises have to be rebuilt).
+            force_refresh (:obj:`bool`): Even if an existing filter is found
+                (in ``md_aliases`` or the cluster), refresh it anyway (useful
+                if you suspect that a new marking definition has been applied
+                that might be applicable to the user - but much slower as
+                index alises have to be rebuilt).
 
         Returns:
             :obj:`str`: User and time specific alias to be used as the new
@@ -580,21 +1815,49 @@ class Client(Elasticsearch):
                                                      old_alias=index_alias)
         md_alias_name = md_alias_root + '--' + md_alias_date
         if not force_refresh:
+            if self.md_aliases.get(user_id, index_alias, md_alias_name):
+                return md_alias_name
             if self.indices.exists_alias(name=md_alias_name):
+                self.md_aliases.add(user_id, index_alias, md_alias_name)
                 return md_alias_name
 
-        self.indices.delete_alias(index='_all',
-                                  name=[md_alias_root + '*'],
-                                  ignore=[400, 404])
-        os_list = self.get_object(user_id=self.identity['id'],
-                                  obj_id=self.os_group_id,
-                                  _md=False)['object_refs']
-        valid_refs = [{"bool": {"must_not": {"exists": {
-                                            "field": "object_marking_refs"}}}}]
-        for os_id in os_list:
-            valid_refs.append({"match": {
-                                "object_marking_refs": os_id.split('--')[1]}})
+        # Concurrent requests for the user wait for one rebuild
+        with self.md_aliases.rebuild_lock(user_id):
+            if (not force_refresh and
+                    self.md_aliases.get(user_id, index_alias, md_alias_name)):
+                return md_alias_name
+            md_filter = self.get_marking_filter(user_id=user_id,
+                                                force_refresh=force_refresh)
+            self.__put_md_aliases(user_id=user_id,
+                                  index_alias=index_alias,
+                                  md_filter=md_filter,
+                                  time_slice=md_alias_date)
+        return md_alias_name
+
+    def get_marking_filter(self, user_id, force_refresh=False):
+        """Resolve what a user is allowed to see as per the marking
+        definitions of the data (as applied by ``get_id_markings()``).
+        Resolutions are kept in ``md_aliases`` for the hourly time slice.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            force_refresh (:obj:`bool`): Resolve again even if the user has
+                already been resolved in this time slice.
 
+        Returns:
+            :obj:`MarkingFilter`: The user's access.
+        """
+        time_slice = md_time_slice()
+        if not force_refresh:
+            md_filter = self.md_aliases.get_filter(user_id, time_slice)
+            if md_filter is not None:
+                return md_filter
+
+        marking_refs = list(self.get_object(user_id=self.identity['id'],
+                                            obj_id=self.os_group_id,
+                                            _md=False)['object_refs'])
+        pii_refs = []
         user_id_split = user_id.split('--')[1]
 
         # Get orgs that are in the user network from which they may inherit
@@ -617,12 +1880,7 @@ class Client(Elasticsearch):
                 if org['type'] == 'organization':
                     org_should.append({"match": {"definition.distribution_refs":
                                        org_id.split('--')[1]}})
-                valid_refs.append(
-                    {"bool": {"must": [
-                        {"match": {"id": org_id.split('--')[1]}},
-                        {"match": {"object_marking_refs":
-                                   self.pii_marking['id'].split('--')[1]}}
-                    ]}})
+                pii_refs.append(org_id)
         q = {"query": {"bool": {"should": org_should}}}
         res = self.search(user_id=user_id,
                           index='marking-definition',
@@ -631,17 +1889,105 @@ class Client(Elasticsearch):
                           _md=False)
         if res:
             for hit in hits_from_res(res):
-                valid_refs.append({"match": {"object_marking_refs":
-                                  hit['id'].split('--')[1]}})
-        body = {"filter": {"bool": {"should": valid_refs}}}
-        alias_info = self.cat.aliases(name=index_alias, format='json')
-        alias_mapping = []
-        for info in alias_info:
-            alias_mapping.append(info['index'])
-        self.indices.put_alias(index=alias_mapping,
-                               name=md_alias_name,
-                               body=body)
-        return md_alias_name
+                marking_refs.append(hit['id'])
+        md_filter = MarkingFilter(marking_refs=marking_refs,
+                                  pii_refs=pii_refs,
+                                  pii_marking_ref=self.pii_marking['id'])
+        self.md_aliases.add_filter(user_id, time_slice, md_filter)
+        return md_filter
+
+    def __put_md_aliases(self, user_id, index_alias, md_filter, time_slice):
+        """Point a user's marking definition aliases at the current time
+        slice with a single ``update_aliases`` request.
+
+        Every index that the user already has an alias for (from any slice)
+        is rolled over along with ``index_alias``, so that the rest of their
+        aliases do not each need a rebuild in this slice, and the aliases of
+        older slices are removed. Aliases that already have the filter on the
+        right indices are left as they are.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id.
+            index_alias (:obj:`str`): Index name used in the query.
+            md_filter (:obj:`MarkingFilter`): The user's access.
+            time_slice (:obj:`str`): Current hourly time slice.
+        """
+        user_id_split = user_id.split('--')[1]
+        existing = {}
+        res = self.indices.get_alias(name='*--' + user_id_split + '--*',
+                                     ignore=404)
+        for index_name, info in res.items():
+            if not isinstance(info, dict) or 'aliases' not in info:
+                continue
+            for name, meta in info['aliases'].items():
+                existing.setdefault(name, {})[index_name] = meta.get('filter')
+
+        targets = set([index_alias])
+        for name in existing:
+            targets.add(name.split('--')[0])
+        members = {}
+        res = self.indices.get_alias(name=sorted(targets), ignore=404)
+        for index_name, info in res.items():
+            if not isinstance(info, dict) or 'aliases' not in info:
+                continue
+            for name in info['aliases']:
+                if name in targets:
+                    members.setdefault(name, []).append(index_name)
+
+        if self.access_lists:
+            self.__put_access_list(user_id=user_id, md_filter=md_filter)
+            _filter = md_filter.to_lookup_query(user_id)
+        else:
+            _filter = md_filter.to_query()
+        actions = []
+        resolved = []
+        for target in sorted(targets):
+            name = target + '--' + user_id_split + '--' + time_slice
+            current = existing.pop(name, {})
+            indices = members.get(target)
+            if not indices:
+                if target != index_alias:
+                    # Index alias no longer exists
+                    continue
+                indices = [index_alias]
+            indices = sorted(indices)
+            if [current.get(index_name) for index_name in indices] != \
+                    [_filter] * len(indices):
+                actions.append({"add": {"indices": indices,
+                                        "alias": name,
+                                        "filter": _filter}})
+            old_indices = sorted(set(current) - set(indices))
+            if old_indices:
+                actions.append({"remove": {"indices": old_indices,
+                                           "alias": name}})
+            resolved.append((target, name))
+        for name, current in sorted(existing.items()):
+            actions.append({"remove": {"indices": sorted(current),
+                                       "alias": name}})
+        if actions:
+            self.indices.update_aliases(body={"actions": actions})
+        for target, name in resolved:
+            self.md_aliases.add(user_id, target, name)
+
+    def __put_access_list(self, user_id, md_filter):
+        """Write a user's access list document (see
+        ``git4intel.markings``), creating the index if needed.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id.
+            md_filter (:obj:`MarkingFilter`): The user's access.
+        """
+        if self.__access_lists is None:
+            self.__access_lists = bool(
+                self.indices.exists(index=access_lists_index))
+        if not self.__access_lists:
+            self.indices.create(index=access_lists_index,
+                                body=access_lists_mapping, ignore=400)
+            self.__access_lists = True
+        # Terms lookups get the document in real time, so no refresh
+        super().index(index=access_lists_index,
+                      id=user_id,
+                      body=md_filter.access_doc())
 
     def get_free_text(self, user_id, phrase, schema=None):
         """EXAMPLE IMPLEMENTATION OF g4i. Takes a string query and conducts a
@@ -811,13 +2157,13 @@ class Client(Elasticsearch):
             if _index == 'percolator':
                 _index = 'stix-perc'
                 _id = id_parts[1]
-            if _md:
+            if _md and not self.query_markings:
                 md_alias = self.get_id_markings(user_id=user_id,
                                                 index_alias=_index)
                 _index = md_alias
             g['docs'].append({"_index": _index, "_id": _id})
 
-        res = self.mget(body=g)
+        res = self.mget(body=g, _source_excludes=['x_g4i_schema_hits'])
         try:
             for doc in res['docs']:
                 docs.append(doc['_source'])
@@ -826,7 +2172,9 @@ class Client(Elasticsearch):
         return docs
 
     def get_molecule(self, user_id, stix_ids, schema_name, objs=None,
-                     query=None, pivot=False, _md=None):
+                     query=None, pivot=False, _md=None, max_rounds=None,
+                     max_ids=None, max_time=None, max_requests=None,
+                     report=None):
         """From a seed id and using a molecule schema, return all objects that
         comply with that schema.
 
@@ -839,8 +2187,15 @@ class Client(Elasticsearch):
         if no hits are found on any component, but if it finds some hits then
         it will re-run to see if it can fill the gaps (ie: the id refs it finds
         in run 1 may be applicable to schema components that were skipped
-        earlier). Currently set to re-run twice before giving up. This will be
-        the hook for partial matches for further analysis.
+        earlier). It stops as soon as a run finds no new ids. This will be
+        the hook for partial matches for further analysis. Use
+        ``get_molecules()`` to get the molecules for many seeds at once.
+
+        The expansion can be capped with ``max_rounds``, ``max_ids``,
+        ``max_time`` and ``max_requests`` (see ``git4intel.budget``), eg: to
+        bound the latency of an interactive view. Once a limit is reached the
+        molecule is returned as found so far and ``report`` says which limit
+        stopped it and which schema components were satisfied.
 
         .. note::
 
@@ -880,6 +2235,21 @@ class Client(Elasticsearch):
                 members requires a join on the organisations they are a member
                 of first before they can find out if they are allowed to see
                 the data).
+            max_rounds (:obj:`int`, optional): Maximum number of expansion
+                rounds.
+            max_ids (:obj:`int`, optional): Stop expanding once the molecule
+                has at least this many ids (the last round can take it over).
+            max_time (:obj:`float`, optional): Maximum seconds for the
+                expansion (the objects for ``objs`` are still fetched).
+            max_requests (:obj:`int`, optional): Maximum number of
+                elasticsearch requests, including the one to fetch the objects
+                for ``objs``.
+            report (:obj:`dict`, optional): Filled in with ``core`` and
+                ``ext`` (whether each schema component was satisfied, in
+                schema order; a single ``core`` component in pivot mode),
+                ``exhausted`` (the limit that stopped the expansion, or
+                ``None`` if it ran to completion), ``rounds``, ``requests``
+                and ``time`` (seconds).
 
         Returns:
             :obj:`list` of :obj:`dict`: List of JSON serializable python
@@ -888,113 +2258,483 @@ class Client(Elasticsearch):
 
         if _md is None:
             _md = True
+        if report is None:
+            report = {}
         if not isinstance(schema_name, str):
             return False
 
-        if pivot:
-            # In pivot mode, just get all objects that could be relevant (core
-            #   and ext)
-            schema_template = self.get_schema(schema_name)
-            should_list = (schema_template['core']['bool']['should'] +
-                           schema_template['ext']['bool']['should'])
-            schemas = {"core": [{"bool": {"should": should_list}}]}
-        else:
-            # In non-pivot, just get core now, but
-            schema_data = self.get_schema(schema_name)
-            schemas = {"core": schema_data['core']['bool']['should'],
-                       "ext": schema_data['ext']['bool']['should']}
-        check_lst = {'core': [], 'ext': []}
-
-        failed = 0
-        ids = stix_ids[:]
-        ext_ids = []
-        while True:
-            old_len = len(ids)
-            q_ids = []
-            q_str = ''
-            for _id in ids:
-                q_ids.append({"match": {"id": _id.split('--')[1]}})
-                q_str += _id.split('--')[1] + " OR "
-            q_str = q_str[:-4]
-
-            q_ids.append({"query_string": {
-                            "fields": ["*_ref", "*_refs"],
-                            "query": q_str}})
-            count = 0
-            for key in schemas:
-                for schema in schemas[key]:
-                    try:
-                        if check_lst[key][count] is True and not pivot:
-                            count += 1
-                            continue
-                    except IndexError:
-                        pass
-                    q = {"query": {"bool": {"should": q_ids}}}
-                    res = self.search(user_id=user_id,
-                                      body=q,
-                                      schema=schema,
-                                      _source_excludes=["created_by_ref",
-                                                        "object_marking_refs"],
-                                      filter_path=['hits.hits._source.id',
-                                                   'hits.hits._source.*_ref',
-                                                   'hits.hits._source.*_refs'],
-                                      _md=_md)
-                    try:
-                        check_lst[key][count] = bool(res)
-                    except IndexError:
-                        check_lst[key].append(bool(res))
-                    count += 1
-                    if res:
-                        for hit in hits_from_res(res):
-                            if not pivot and key == 'ext':
-                                try:
-                                    ext_ids.append(hit['id'])
-                                    continue
-                                except KeyError:
-                                    pass
-                            for value in list(hit.values()):
-                                if isinstance(value, list):
-                                    for sub_value in value:
-                                        if not sub_value:
-                                            continue
-                                        ids.append(sub_value)
-                                    continue
-                                ids.append(value)
-            ids = list(set(ids))
-            new_len = len(ids)
-            if not any(check_lst['core']):
-                print('No hits for that schema and seed combination.')
-                return False
-            if new_len == old_len and all(check_lst['core']) is True:
-                # No more growth and hits on all core schema components
-                break
-            if new_len == old_len and all(check_lst['core']) is False:
-                # No more results and still some gaps - worth a rerun...
-                failed += 1
-            if failed > 2:
-                print('Partial molecule matches found, but no full molecules.')
-                break
-        if new_len == 1:
+        if objs and max_requests is not None:
+            max_requests -= 1
+        budget = Budget(max_rounds=max_rounds, max_ids=max_ids,
+                        max_time=max_time, max_requests=max_requests)
+        components = {}
+        ids, satisfied = self.__expand_molecules(user_id=user_id,
+                                                 seeds={None: stix_ids},
+                                                 schema_name=schema_name,
+                                                 pivot=pivot,
+                                                 _md=_md,
+                                                 budget=budget,
+                                                 report=components)[None]
+        report.update(components[None])
+        report.update(budget.report())
+        if budget.exhausted:
+            print('Molecule expansion stopped (' + budget.exhausted +
+                  '), returning what was found so far.')
+        if not ids:
+            print('No hits for that schema and seed combination.')
+            return False
+        if not satisfied:
+            print('Partial molecule matches found, but no full molecules.')
+        if len(set(ids)) == 1:
             print('Only found the seed object.')
             # return False
-        if not pivot:
-            ids += ext_ids
         if not objs:
             return ids
-        q_objs = []
-        for _id in ids:
-            q_objs.append({"match": {"id": _id.split('--')[1]}})
-        if query:
-            q = {"query": {"bool": {"must": [query['query'],
-                                             {"bool": {"should": q_objs}}]}}}
-        else:
-            q = {"query": {"bool": {"should": q_objs}}}
+        q = {"query": self.__molecule_objs_query(ids, query)}
+        report['requests'] += 1
         return self.search(user_id=user_id,
                            body=q,
                            schema=schema_name,
                            filter_path=['hits.hits._source'],
                            _md=_md)
 
+    def get_molecules(self, user_id, seeds, schema_name, objs=None,
+                      query=None, _md=None, max_rounds=None, max_ids=None,
+                      max_time=None, max_requests=None, report=None):
+        """Batch version of ``get_molecule()`` (with pivot set to ``False``)
+        for many seed ids at once.
+
+        All of the seeds are expanded together: each round sends the searches
+        for every seed and every schema component that still needs one in a
+        single ``msearch`` request, rather than one search per seed per
+        component. Each seed still gets its own molecule - ids found from one
+        seed are never used to expand another.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            seeds (:obj:`list` of :obj:`str`): STIX2 object reference ids,
+                one per molecule.
+            schema_name (:obj:`str`): Name of the molecule schema.
+            objs (:obj:`bool`, optional): ``True`` to return full objects;
+                ``False`` to return id references only (faster).
+            query (:obj:`dict`, optional): Elasticsearch compliant query that
+                will be applied as an *and* for the moleule search.
+            _md (:obj:`bool`, optional): As per ``get_molecule()``.
+            max_rounds (:obj:`int`, optional): As per ``get_molecule()``.
+            max_ids (:obj:`int`, optional): As per ``get_molecule()``, for
+                each molecule.
+            max_time (:obj:`float`, optional): As per ``get_molecule()``, for
+                all of the molecules.
+            max_requests (:obj:`int`, optional): As per ``get_molecule()``,
+                for all of the molecules.
+            report (:obj:`dict`, optional): Filled in with ``rounds``,
+                ``requests``, ``time`` and ``exhausted`` (the first limit
+                reached) for the whole call and ``molecules``: for each seed,
+                ``core``, ``ext`` and ``exhausted`` as per ``get_molecule()``.
+
+        Returns:
+            :obj:`dict`: For each seed, the molecule as per ``get_molecule()``
+            (list of ids, or the search response if ``objs`` is ``True``) or
+            ``False`` where there were no hits for the seed.
+        """
+        if _md is None:
+            _md = True
+        if report is None:
+            report = {}
+        if not isinstance(schema_name, str):
+            return False
+
+        seeds = list(collections.OrderedDict.fromkeys(seeds))
+        if objs and max_requests is not None:
+            max_requests -= 1
+        budget = Budget(max_rounds=max_rounds, max_ids=max_ids,
+                        max_time=max_time, max_requests=max_requests)
+        components = {}
+        expanded = self.__expand_molecules(
+                                user_id=user_id,
+                                seeds={seed: [seed] for seed in seeds},
+                                schema_name=schema_name,
+                                pivot=False,
+                                _md=_md,
+                                budget=budget,
+                                report=components)
+        report.update(budget.report())
+        report['molecules'] = components
+        molecules = {}
+        for seed in seeds:
+            molecules[seed] = expanded[seed][0]
+        if not objs:
+            return molecules
+        if any(molecules.values()):
+            report['requests'] += 1
+        return self.__molecule_objs(user_id=user_id,
+                                    molecules=molecules,
+                                    schema_name=schema_name,
+                                    query=query,
+                                    _md=_md)
+
+    def __molecule_objs(self, user_id, molecules, schema_name, query, _md):
+        """Supporting function to fetch the objects of many molecules with
+        a single ``msearch`` request.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            molecules (:obj:`dict`): Molecule ids (:obj:`list` of
+                :obj:`str`, or ``False``) by seed.
+            schema_name (:obj:`str`): Name of the molecule schema.
+            query (:obj:`dict`): As per ``get_molecule()``.
+            _md (:obj:`bool`): As per ``search()``.
+
+        Returns:
+            :obj:`dict`: For each seed, the search response (``False``
+            where there were no molecule ids).
+        """
+        seeds = [seed for seed in molecules if molecules[seed]]
+        searches = []
+        for seed in seeds:
+            searches.append({
+                "body": {"query": self.__molecule_objs_query(molecules[seed],
+                                                             query),
+                         "_source": True},
+                "schema": schema_name})
+        responses = self.multi_search(user_id=user_id,
+                                      searches=searches,
+                                      _md=_md)
+        molecules = dict(molecules)
+        for seed, res in zip(seeds, responses):
+            hits = [{"_source": hit['_source']}
+                    for hit in res.get('hits', {}).get('hits', [])]
+            # As per search() with filter_path, no hits is an empty response
+            molecules[seed] = {"hits": {"hits": hits}} if hits else {}
+        return molecules
+
+    def __expand_molecules(self, user_id, seeds, schema_name, pivot, _md,
+                           budget=None, report=None):
+        """Supporting function to expand any number of molecules from their
+        seed ids, one ``msearch`` request per round.
+
+        Only the ids discovered in the previous round (the frontier) are
+        searched for: everything already visited has been searched for
+        against every component that still needs to be searched. Each
+        molecule gets a single search per round for any of those components
+        (see ``get_compiled_schema()``) and the hits are sorted in to
+        components locally.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id for the
+                user running the function.
+            seeds (:obj:`dict`): STIX2 object reference ids (:obj:`list` of
+                :obj:`str`) to seed each molecule, by molecule key.
+            schema_name (:obj:`str`): Name of the molecule schema.
+            pivot (:obj:`bool`): As per ``get_molecule()``.
+            _md (:obj:`bool`): As per ``search()``.
+            budget (:obj:`Budget`, optional): Limits for the expansion (see
+                ``git4intel.budget``); molecules that reach one are returned
+                as found so far.
+            report (:obj:`dict`, optional): Filled in with, for each
+                molecule key, which ``core`` and ``ext`` components were
+                satisfied and the limit that stopped it (``exhausted``).
+
+        Returns:
+            :obj:`dict`: For each molecule key, a tuple of the molecule ids
+            (:obj:`list` of :obj:`str`, or ``False`` if there were no hits)
+            and whether every core schema component was satisfied.
+        """
+        if budget is None:
+            budget = Budget()
+        if report is None:
+            report = {}
+        compiled = self.get_compiled_schema(schema_name)
+        if not compiled:
+            for key in seeds:
+                report[key] = {"core": [], "ext": [], "exhausted": None}
+            return {key: (False, False) for key in seeds}
+        if pivot:
+            # In pivot mode, just get all objects that could be relevant (core
+            #   and ext)
+            schemas = {"core": [compiled.union()], "ext": []}
+        else:
+            schemas = {"core": compiled.core, "ext": compiled.ext}
+        if self.graph_snapshot is not None and all(
+                self.graph_snapshot.supports(schema)
+                for part in schemas for schema in schemas[part]):
+            mask = None
+            if _md:
+                mask = self.graph_snapshot.visible(self, user_id)
+            return self.graph_snapshot.expand(seeds, schemas, pivot, mask,
+                                              budget=budget, report=report)
+
+        _source = sorted(set(['id', '*_ref', '*_refs']) | compiled.fields)
+        tags = None
+        if self.schema_hits:
+            # Filter on the components tagged at write time (see
+            #   tag_schema_hits()) rather than the component queries
+            tags = dict((part, [[schema_name + '.' + part + '.' + str(count)]
+                                for count in range(len(getattr(compiled,
+                                                               part)))])
+                        for part in ('core', 'ext'))
+            if pivot:
+                tags = {"core": [[tag for part in ('core', 'ext')
+                                  for component in tags[part]
+                                  for tag in component]],
+                        "ext": []}
+            _source = ['id', '*_ref', '*_refs', 'x_g4i_schema_hits']
+
+        molecules = {}
+        for key, stix_ids in seeds.items():
+            molecules[key] = {"ids": set(stix_ids),
+                              "frontier": set(stix_ids),
+                              "ext_ids": [],
+                              "core": [False] * len(schemas['core']),
+                              "ext": [False] * len(schemas['ext'])}
+        output = {}
+
+        def finish(key, exhausted=None):
+            molecule = molecules[key]
+            if exhausted:
+                budget.stop(exhausted)
+            report[key] = {"core": molecule['core'],
+                           "ext": molecule['ext'],
+                           "exhausted": exhausted}
+            if not any(molecule['core']):
+                output[key] = (False, False)
+                return
+            ids = list(molecule['ids'])
+            if not pivot:
+                ids += molecule['ext_ids']
+            output[key] = (ids, all(molecule['core']))
+
+        active = list(molecules)
+        while active:
+            round_requests = 1 if self.has_edges() else 0
+            round_requests += len(self.__search_groups(len(active)))
+            limit = budget.check(requests=round_requests)
+            if limit:
+                for key in active:
+                    finish(key, limit)
+                break
+            still_active = []
+            for key in active:
+                limit = budget.check(ids=len(molecules[key]['ids']))
+                if limit:
+                    finish(key, limit)
+                else:
+                    still_active.append(key)
+            active = still_active
+            if not active:
+                break
+
+            timeout = {}
+            if budget.max_time is not None:
+                timeout['request_timeout'] = budget.remaining_time()
+            searches = []
+            slots = []
+            try:
+                referrers = self.__referrers(
+                    {key: molecules[key]['frontier'] for key in active},
+                    **timeout)
+                for key in active:
+                    molecule = molecules[key]
+                    molecule['found'] = set()
+                    pending = []
+                    for part in schemas:
+                        for count, schema in enumerate(schemas[part]):
+                            if (part == 'core' and molecule['core'][count]
+                                    and not pivot):
+                                continue
+                            pending.append((part, count, schema))
+                    if not pending:
+                        continue
+                    q_ids = self.__ids_query(molecule['frontier'],
+                                             referrers.get(key))
+                    if tags:
+                        should = [{"terms": {"x_g4i_schema_hits":
+                                             tags[part][count]}}
+                                  for part, count, schema in pending]
+                    else:
+                        should = [schema.to_query()
+                                  for part, count, schema in pending]
+                    searches.append({"body": {"query": q_ids,
+                                              "_source": _source},
+                                     "schema": {"bool": {
+                                         "should": should,
+                                         "minimum_should_match": 1}}})
+                    slots.append((key, pending))
+                responses = self.multi_search(user_id=user_id,
+                                              searches=searches,
+                                              _md=_md,
+                                              **timeout)
+            except exceptions.ConnectionTimeout:
+                for key in active:
+                    finish(key, 'max_time')
+                break
+            budget.spend(requests=(1 if self.has_edges() else 0) +
+                         (len(self.__search_groups(len(searches)))
+                          if searches else 0))
+            for (key, pending), res in zip(slots, responses):
+                molecule = molecules[key]
+                if 'error' in res:
+                    print(res['error'])
+                for hit in res.get('hits', {}).get('hits', []):
+                    hit = hit.get('_source', {})
+                    values = source_values(hit, compiled.kinds)
+                    for part, count, schema in pending:
+                        if tags:
+                            if set(tags[part][count]).isdisjoint(
+                                    hit.get('x_g4i_schema_hits', [])):
+                                continue
+                        elif not schema.test(values):
+                            continue
+                        molecule[part][count] = True
+                        if not pivot and part == 'ext' and 'id' in hit:
+                            molecule['ext_ids'].append(hit['id'])
+                            continue
+                        molecule['found'].update(self.__hit_refs(hit))
+
+            still_active = []
+            for key in active:
+                molecule = molecules[key]
+                molecule['frontier'] = molecule['found'] - molecule['ids']
+                molecule['ids'] |= molecule['found']
+                if not any(molecule['core']):
+                    finish(key)
+                elif molecule['frontier']:
+                    still_active.append(key)
+                else:
+                    # No more growth
+                    finish(key)
+            active = still_active
+        return output
+
+    def __hit_refs(self, hit):
+        """Supporting function to get the id and the (top level) references
+        of a molecule hit, other than ``created_by_ref`` and
+        ``object_marking_refs`` which would join every molecule together.
+
+        Args:
+            hit (:obj:`dict`): ``_source`` of the hit.
+
+        Returns:
+            :obj:`set` of :obj:`str`: STIX2 object reference ids.
+        """
+        refs = set()
+        for field, value in hit.items():
+            if field in ('created_by_ref', 'object_marking_refs'):
+                continue
+            if field == 'id' or field.endswith('_ref'):
+                if value:
+                    refs.add(value)
+            elif field.endswith('_refs') and isinstance(value, list):
+                refs.update(sub_value for sub_value in value if sub_value)
+        return refs
+
+    def __molecule_objs_query(self, stix_ids, query=None):
+        """Supporting function to build the query for the full objects of a
+        molecule.
+
+        Args:
+            stix_ids (:obj:`list` of :obj:`str`): STIX2 object reference ids
+                in the molecule.
+            query (:obj:`dict`, optional): As per ``get_molecule()``.
+
+        Returns:
+            :obj:`dict`: Elasticsearch query.
+        """
+        q_objs = {"terms": {"id": sorted(set(_id.split('--')[1]
+                                             for _id in stix_ids))}}
+        if query:
+            return {"bool": {"must": [query['query'], q_objs]}}
+        return q_objs
+
+    def __referrers(self, frontiers, **kwargs):
+        """Supporting function to look up the objects that reference each
+        of a set of frontiers in the edge index, with one ``msearch``.
+
+        Args:
+            frontiers (:obj:`dict`): STIX2 object reference ids (:obj:`set`
+                of :obj:`str`) by molecule key.
+            **kwargs: As per elasticsearch ``msearch()`` arguments.
+
+        Returns:
+            :obj:`dict`: STIX2 object reference ids (:obj:`set` of
+            :obj:`str`) of the referencing objects by molecule key. Keys are
+            left out where the lookup was too big (more than
+            ``edge_lookup_size`` edges) or failed, or there is no edge index.
+        """
+        if not frontiers or not self.has_edges():
+            return {}
+        keys = list(frontiers)
+        body = []
+        for key in keys:
+            body.append({"index": edges_index})
+            body.append({"query": {"terms": {
+                            "stix_id": sorted(frontiers[key])}},
+                         "_source": ['rel_ref'],
+                         "size": edge_lookup_size})
+        res = super().msearch(body=body, **kwargs)
+        referrers = {}
+        for key, response in zip(keys, res['responses']):
+            if 'error' in response:
+                continue
+            hits = response['hits']
+            if hits['total']['value'] > len(hits['hits']):
+                continue
+            referrers[key] = set(hit['_source']['rel_ref']
+                                 for hit in hits['hits'])
+        return referrers
+
+    def __ids_query(self, stix_ids, referrers=None):
+        """Supporting function to build a query for the objects with any of
+        the given ids or that reference any of them.
+
+        The id and reference fields are analysed in to the object type and
+        uuid parts (see ``stixid_analyzer``) so ``terms`` on the uuids is
+        an exact match without any query parsing.
+
+        Args:
+            stix_ids (:obj:`list` of :obj:`str`): STIX2 object reference ids.
+            referrers (:obj:`set` of :obj:`str`, optional): The ids of the
+                objects that reference ``stix_ids`` (from the edge index), so
+                that only the ``id`` field has to be searched.
+
+        Returns:
+            :obj:`dict`: Elasticsearch query.
+        """
+        if referrers is not None:
+            return {"terms": {"id": sorted(set(
+                stix_id.split('--')[1] for stix_id in
+                set(stix_ids) | referrers))}}
+        uuids = sorted(set(stix_id.split('--')[1] for stix_id in stix_ids))
+        should = [{"terms": {"id": uuids}}]
+        for field in self.get_ref_fields():
+            should.append({"terms": {field: uuids}})
+        return {"bool": {"should": should}}
+
+    def get_ref_fields(self, force_refresh=False):
+        """Get the names of every mapped reference (``*_ref`` and ``*_refs``)
+        field in the repository. Cached for ``ref_fields_ttl`` seconds to
+        pick up new custom properties without a lookup per query.
+
+        Args:
+            force_refresh (:obj:`bool`, optional): Ignore the cached list.
+
+        Returns:
+            :obj:`list` of :obj:`str`: Field names.
+        """
+        if (not force_refresh and self.__ref_fields is not None and
+                time.time() - self.__ref_fields_time < ref_fields_ttl):
+            return self.__ref_fields
+        res = self.indices.get_field_mapping(index='intel',
+                                             fields=['*_ref', '*_refs'])
+        fields = set()
+        for index_mapping in res.values():
+            fields.update(index_mapping['mappings'])
+        self.__ref_fields = sorted(fields)
+        self.__ref_fields_time = time.time()
+        return self.__ref_fields
+
     def get_incidents(self, user_id, focus=None):
         """EXAMPLE IMPLEMENTATION OF g4i. Use the molecule schema method to
         obtain incidents and component phases for a given user and focus.
@@ -1175,13 +2915,25 @@ class Client(Elasticsearch):
             for hit in hits_from_res(res):
                 seeds.append(hit['id'])
 
+        incidents = self.get_molecules(user_id=user_id,
+                                       seeds=seeds,
+                                       schema_name='incident',
+                                       objs=True)
+        phase_seeds = []
+        for inc_objs in incidents.values():
+            if not inc_objs:
+                continue
+            for inc_obj in hits_from_res(inc_objs):
+                if inc_obj.get('relationship_type') == 'phase-of':
+                    phase_seeds.append(inc_obj['source_ref'])
+        phases = self.get_molecules(user_id=user_id,
+                                    seeds=phase_seeds,
+                                    schema_name='phase',
+                                    objs=True)
+
         output = []
         for seed in seeds:
-            inc_objs = self.get_molecule(user_id=user_id,
-                                         stix_ids=[seed],
-                                         schema_name='incident',
-                                         objs=True,
-                                         pivot=False)
+            inc_objs = incidents[seed]
             if not inc_objs:
                 continue
             inc = []
@@ -1190,12 +2942,7 @@ class Client(Elasticsearch):
                 try:
                     if inc_obj['relationship_type'] != 'phase-of':
                         continue
-                    phase_objs = self.get_molecule(
-                                           user_id=user_id,
-                                           stix_ids=[inc_obj['source_ref']],
-                                           schema_name='phase',
-                                           objs=True,
-                                           pivot=False)
+                    phase_objs = phases[inc_obj['source_ref']]
                     if phase_objs:
                         inc.append(list(hits_from_res(phase_objs)))
                 except KeyError:
@@ -1238,11 +2985,11 @@ class Client(Elasticsearch):
         for hit in hits_from_res(res):
             seeds.append(hit['id'])
 
+        events = self.get_molecules(user_id=user_id, seeds=seeds,
+                                    schema_name='event', objs=True)
         output = []
         for seed in seeds:
-            res = self.get_molecule(user_id=user_id, stix_ids=[seed],
-                                    schema_name='event', pivot=False,
-                                    objs=True)
+            res = events[seed]
             if res:
                 output.append(list(hits_from_res(res)))
         return output
@@ -1416,14 +3163,31 @@ class Client(Elasticsearch):
                         print('Created new index for ' + index_name)
                 except KeyError:
                     print('Failed to create new index for ' + index_name)
+        if not self.indices.exists(index=edges_index):
+            self.indices.create(index=edges_index, body=edges_mapping)
+            print('Created new index for ' + edges_index)
+        self.__edges = True
 
-    def data_primer(self):
+    def data_primer(self, filepath=None, chunk_size=500):
         """Simple get for the Mitre Att&ck library in stix2.
 
+        The bundle is parsed incrementally (from a local copy or the
+        download stream) and fed straight into ``bulk_index()``, so memory
+        use does not grow with the size of the bundle. Marking definitions
+        met along the way are added to the OS data markings grouping in a
+        single up-version at the end.
+
         Note: We don't apply commit control on ingest - it runs in the
         background so as not to slow down ingestion. If it's stix2.x - let it
         in.
 
+        Args:
+            filepath (:obj:`str`, optional): Local copy of
+                ``enterprise-attack.json`` to load (eg: for offline use).
+                Defaults to ``None`` to download it from the Mitre cti repo.
+            chunk_size (:obj:`int`, optional): Pass through to
+                ``bulk_index()``.
+
         Returns:
             :obj:`bool`: ``True`` for success; ``False`` if any store action
             failed. (Brutal, I know.)
@@ -1435,88 +3199,119 @@ class Client(Elasticsearch):
         # tc_source = stix2.TAXIICollectionSource(collection)
         # attack = tc_source.query()
 
-        r = requests.get('https://raw.githubusercontent.com/mitre/cti/master/enterprise-attack/enterprise-attack.json')
+        if filepath is not None:
+            with open(filepath, 'rb') as f:
+                return self.__load_bundle(iter(lambda: f.read(65536), b''),
+                                          chunk_size=chunk_size)
+
+        r = requests.get('https://raw.githubusercontent.com/mitre/cti/master/enterprise-attack/enterprise-attack.json',
+                         stream=True)
 
         if r.status_code != requests.codes.ok:
             print('Failed to get Mitre Att&ck data')
             return False
 
-        for obj in r.json()['objects']:
-            try:
-                doc = json.loads(obj.serialize())
-            except AttributeError:
-                doc = obj
-            if obj['type'] == 'marking-definition':
-                res = self.set_new_osdm(user_id=self.identity['id'],
-                                        stix_id=obj['id'])
-                print('Added new Mitre Attack os dm: ' + res)
-            if not self.index(user_id=self.identity['id'], body=doc):
-                return False
-        return True
+        with r:
+            return self.__load_bundle(r.iter_content(chunk_size=65536),
+                                      chunk_size=chunk_size)
+
+    def __load_bundle(self, chunks, chunk_size=500):
+        """Supporting function for ``data_primer()`` to stream a stix2 bundle
+        into the repository.
+
+        Args:
+            chunks (iterable of :obj:`bytes`): The bundle document in pieces.
+            chunk_size (:obj:`int`, optional): Pass through to
+                ``bulk_index()``.
+
+        Returns:
+            :obj:`bool`: ``True`` for success; ``False`` if any store action
+            failed.
+        """
+        md_ids = []
+
+        def objects():
+            for obj in iter_bundle_objects(chunks):
+                if obj['type'] == 'marking-definition':
+                    md_ids.append(obj['id'])
+                yield obj
 
-    def get_tables(self, filepath):
-        tablename_re = r'table_name\("([^"]{1,128})"'
-        desc_re = r'description\("([^"]{1,99999})"'
-        schema_re = r'schema\(\[(.{1,999999})\]\)'
-        extschema_re = r'extended_schema\(.{1,128}, \[(.{1,99999})\]\)'
-        schemas_re = r'Column\("([^"]{1,32})", (\w{1,32}), "([^"]{1,64})"\)'
+        try:
+            id_list, failed = self.bulk_index(user_id=self.identity['id'],
+                                              objects=objects(),
+                                              chunk_size=chunk_size)
+        except ValueError as e:
+            print('Failed to parse Mitre Att&ck data: ' + str(e))
+            self.attack_ids.invalidate()
+            return False
+        self.attack_ids.invalidate()
+        for obj_id, error in failed:
+            print('Failed to index ' + obj_id + ': ' + str(error))
+        if md_ids:
+            res = self.set_new_osdms(user_id=self.identity['id'],
+                                     stix_ids=md_ids)
+            print('Added new Mitre Attack os dms: ' + str(res))
+        return not failed
+
+    def get_tables(self, filepath, workers=None):
+        """Get the osquery table specs (name, description and columns) from
+        a local checkout of the osquery repo.
+
+        Args:
+            filepath (:obj:`str`): Directory to search for ``.table`` files.
+            workers (:obj:`int`, optional): Number of parsing processes, as
+                per ``ingest.parse_files()``.
 
+        Returns:
+            :obj:`dict`: Table specs keyed by table name.
+        """
         filepaths = dir_recurse(filepath, '.table')
         tables = {}
-        for filepath in filepaths:
-            with open(filepath, 'r') as f:
-                data = f.read()
-            data = data.replace('\n', '')
-            tablename = re.findall(tablename_re, data)
-            desc = re.findall(desc_re, data)
-            schema = re.findall(schema_re, data)
-            extschema = re.findall(extschema_re, data)
-            tmp = ''.join(schema)
-            if extschema:
-                tmp_ext = ''.join(extschema)
-                tmp = tmp + tmp_ext
-            columns = re.findall(schemas_re, tmp)
-
-            table = {}
-            if desc:
-                table['description'] = desc[0]
-            if columns:
-                table['columns'] = columns
-
-            if tablename:
-                tables[tablename[0]] = table
-            else:
-                tables[os.path.basename(filepath).split('.')[0]] = table
+        for filepath, res, error in parse_files(parse_table, filepaths,
+                                                workers=workers):
+            if error is not None:
+                print('Failed to parse ' + filepath + ': ' + str(error))
+                continue
+            tablename, table = res
+            tables[tablename] = table
         return tables
 
     def extract_known_atps(self, s):
+        """Find the Mitre Att&ck ids (eg: ``T1059``) in a string and resolve
+        them to stix2 object ids with the ``attack_ids`` resolver.
+
+        Args:
+            s (:obj:`str`): Text to search (tags, descriptions etc.).
+
+        Returns:
+            :obj:`list` of :obj:`str`: Stix2 ids of the Att&ck objects found.
+        """
         atk_patt_re = r'TA\d{4}|ta\d{4}|[T|S|G|M|t|s|g|m]\d{4}'
-        atk_ids = re.findall(atk_patt_re, s)
+        atk_ids = [atk_id.upper() for atk_id in re.findall(atk_patt_re, s)]
+        if not atk_ids:
+            return []
+        resolved = self.attack_ids.resolve(self, atk_ids)
         obj_ids = []
         for atk_id in atk_ids:
-            q = {
-              "query": {
-                "nested": {
-                  "path": "external_references",
-                  "query": {
-                    "bool": {
-                      "must": {"match": {"external_references.external_id": atk_id.upper()}}
-                    }
-                  }
-                }
-              }
-            }
-            res = self.real_search(index='intel', body=q,
-                                   filter_path=['hits.hits._source.id'])
-            if not res:
-                continue
-            for atp_id in hits_from_res(res):
-                obj_ids.append(atp_id['id'])
+            obj_ids += resolved[atk_id]
         return obj_ids
 
-    def get_osquery(self, filepath):
+    def get_osquery(self, filepath, manifest=None, workers=None,
+                    queue_depth=None):
         """Simple get for teoseller's osquery-attack library in stix2.
 
+        Args:
+            filepath (:obj:`str`): Local checkout of the osquery-attck repo.
+            manifest (:obj:`str`, optional): Path of a manifest file (see
+                ``ingest.Manifest``) to make re-runs incremental: only new or
+                changed packs are parsed and indexed and the objects from
+                deleted packs (or dropped from changed ones) are revoked.
+                Defaults to ``None`` to (re)ingest every pack.
+            workers (:obj:`int`, optional): Number of parsing processes.
+                Defaults to the number of cores; ``0`` parses in process.
+            queue_depth (:obj:`int`, optional): Maximum number of parsed
+                files waiting to be indexed. Defaults to four per worker.
+
         Returns:
             :obj:`bool`: ``True`` for success; ``False`` if any store action
             failed. (Brutal, I know.)
@@ -1524,7 +3319,8 @@ class Client(Elasticsearch):
         # objs = []
         author_id = get_deterministic_uuid(prefix='identity--',
                                            seed='teoseller')
-        if not self.exists(index='identity', id=author_id):
+        if not self.id_exists(index='identity',
+                              doc_id=author_id.split('--')[1]):
             author = stix2.v21.Identity(
                             id=author_id,
                             name='Filippo Mottini',
@@ -1539,101 +3335,36 @@ class Client(Elasticsearch):
             # stix2.v21.common.TLP_GREEN.id
         ]
         filepaths = dir_recurse(filepath, '.conf')
-        for filepath in filepaths:
-            name = os.path.basename(filepath).split('.')[0]
-            with open(filepath, 'r') as f:
-                fd = f.read()
-                data = json.loads(fd)
-                data['name'] = name
-                top_data = json.dumps(data)
-            top_ind = stix2.v21.Indicator(
-                                  id=get_deterministic_uuid(
-                                        prefix='indicator--',
-                                        seed=name + 'osquery-pack'),
-                                  created_by_ref=author_id,
-                                  name=name,
-                                  pattern=top_data,
-                                  pattern_type='osquery-pack',
-                                  valid_from=datetime.now(),
-                                  indicator_types=['malicious-activity'],
-                                  object_marking_refs=obj_md_refs)
-            # objs.append(top_ind)
-            print(self.index(user_id=self.identity['id'],
-                             body=json.loads(top_ind.serialize())))
-            try:
-                desc = data['description']
-                ref_atp_ids = self.extract_known_atps(desc)
-                for atp_id in ref_atp_ids:
-                    indicates = stix2.v21.Relationship(
-                                   created_by_ref=author_id,
-                                   source_ref=top_ind.id,
-                                   target_ref=atp_id,
-                                   relationship_type='indicates',
-                                   object_marking_refs=obj_md_refs)
-                    # objs.append(indicates)
-                    print(self.index(user_id=self.identity['id'],
-                                     body=json.loads(indicates.serialize())))
-            except KeyError:
-                pass
+        return self.__ingest_rule_files(root=filepath,
+                                        filepaths=filepaths,
+                                        parse=parse_osquery_pack,
+                                        args=(author_id, obj_md_refs),
+                                        author_id=author_id,
+                                        obj_md_refs=obj_md_refs,
+                                        manifest=manifest,
+                                        workers=workers,
+                                        queue_depth=queue_depth)
+
+    def get_sigma(self, filepath, manifest=None, workers=None,
+                  queue_depth=None):
+        """Simple get for the Sigma rules library in stix2.
 
-            try:
-                queries = data['queries']
-            except KeyError:
-                continue
-
-            for query in queries:
-                ind = stix2.v21.Indicator(
-                              id=get_deterministic_uuid(
-                                        prefix='indicator--',
-                                        seed=query),
-                              created_by_ref=author_id,
-                              name=query,
-                              pattern=json.dumps(data['queries'][query]),
-                              pattern_type='osquery',
-                              valid_from=datetime.now(),
-                              indicator_types=['malicious-activity'],
-                              object_marking_refs=obj_md_refs)
-                # objs.append(ind)
-                print(self.index(user_id=self.identity['id'],
-                                 body=json.loads(ind.serialize())))
-                derived = stix2.v21.Relationship(
-                                   created_by_ref=author_id,
-                                   source_ref=ind.id,
-                                   target_ref=top_ind.id,
-                                   relationship_type='derived-from',
-                                   object_marking_refs=obj_md_refs)
-                # objs.append(derived)
-                print(self.index(user_id=self.identity['id'],
-                                 body=json.loads(derived.serialize())))
-                try:
-                    q_desc = data['description']
-                    ref_atp_ids = self.extract_known_atps(q_desc)
-                    for atp_id in ref_atp_ids:
-                        indicates = stix2.v21.Relationship(
-                                       created_by_ref=author_id,
-                                       source_ref=top_ind.id,
-                                       target_ref=atp_id,
-                                       relationship_type='indicates',
-                                       object_marking_refs=obj_md_refs)
-                        # objs.append(indicates)
-                        print(self.index(user_id=self.identity['id'],
-                                         body=json.loads(indicates.serialize())))
-                except KeyError:
-                    pass
-        # bundle = json.loads(stix2.v21.Bundle(objects=objs).serialize())
-        # bundle = {"type": "bundle",
-        #           "id": get_deterministic_uuid(prefix='bundle--',
-        #                                        seed='fuck-bundles'),
-        #           "objects": objs}
-        # print(json.dumps(bundle))
-        # with open('teoseller.json', 'w') as outfile:
-        #     json.dump(bundle, outfile)
-        return True
+        Args:
+            filepath (:obj:`str`): Local checkout of the sigma rules
+                directory.
+            manifest (:obj:`str`, optional): Path of a manifest file, as per
+                ``get_osquery()``.
+            workers (:obj:`int`, optional): As per ``get_osquery()``.
+            queue_depth (:obj:`int`, optional): As per ``get_osquery()``.
 
-    def get_sigma(self, filepath):
+        Returns:
+            :obj:`bool`: ``True`` for success; ``False`` if any store action
+            failed.
+        """
         author_id = get_deterministic_uuid(prefix='identity--',
                                            seed='Neo23x0')
-        if not self.exists(index='identity', id=author_id):
+        if not self.id_exists(index='identity',
+                              doc_id=author_id.split('--')[1]):
             author = stix2.v21.Identity(
                             id=author_id,
                             name='Florian Roth',
@@ -1648,86 +3379,320 @@ class Client(Elasticsearch):
             # stix2.v21.common.TLP_GREEN.id
         ]
         filepaths = dir_recurse(filepath, '.yml')
-        for filepath in filepaths:
-            with open(filepath, 'r') as f:
-                file_content = f.read()
-            for yml in file_content.split('---'):
-                if not yml:
+        return self.__ingest_rule_files(root=filepath,
+                                        filepaths=filepaths,
+                                        parse=parse_sigma_rules,
+                                        args=(author_id, obj_md_refs),
+                                        author_id=author_id,
+                                        obj_md_refs=obj_md_refs,
+                                        manifest=manifest,
+                                        workers=workers,
+                                        queue_depth=queue_depth)
+
+    def __ingest_rule_files(self, root, filepaths, parse, args, author_id,
+                            obj_md_refs, manifest=None, workers=None,
+                            queue_depth=None, chunk_size=500):
+        """Supporting function for the rule library ingests. Files are parsed
+        in a process pool (see ``ingest.parse_files()``) while the rules that
+        come out of it have their Att&ck references resolved and are bulk
+        indexed, gathered across files in to batches of about
+        ``chunk_size`` objects. If a manifest is given, only files that are
+        new or have changed since the last run are ingested and the objects
+        that no longer have a file behind them are revoked.
+
+        Args:
+            root (:obj:`str`): Top level directory of the library.
+            filepaths (:obj:`list` of :obj:`str`): Rule files in the library.
+            parse (:obj:`function`): ``ingest`` parse function for the rule
+                files.
+            args (:obj:`tuple`): Extra arguments for ``parse``.
+            author_id (:obj:`str`): Identity reference for created_by_ref.
+            obj_md_refs (:obj:`list` of :obj:`str`): Marking definitions to
+                apply to the ``indicates`` relationships.
+            manifest (:obj:`str`, optional): Path of the manifest file.
+            workers (:obj:`int`, optional): Number of parsing processes.
+            queue_depth (:obj:`int`, optional): Maximum number of parsed
+                files waiting to be indexed.
+            chunk_size (:obj:`int`, optional): Number of objects to gather
+                before a ``bulk_index()`` call.
+
+        Returns:
+            :obj:`bool`: ``True`` for success; ``False`` if any parse or store
+            action failed.
+        """
+        def flush(batch):
+            success = True
+            objs = [obj for filepath, file_objs in batch for obj in file_objs]
+            id_list, failed = self.bulk_index(user_id=self.identity['id'],
+                                              objects=objs,
+                                              chunk_size=chunk_size)
+            failed_ids = collections.Counter()
+            for obj_id, error in failed:
+                print('Failed to index ' + obj_id + ': ' + str(error))
+                failed_ids[obj_id] += 1
+                success = False
+            if manifest is None:
+                return success
+            # One id_list entry per object that did not fail, in order: new
+            # objects come back as bare uuids, up-versions as stix ids
+            results = iter(id_list)
+            for filepath, file_objs in batch:
+                stix_ids = []
+                file_failed = False
+                for obj in file_objs:
+                    if failed_ids[obj['id']]:
+                        failed_ids[obj['id']] -= 1
+                        file_failed = True
+                        continue
+                    res = next(results)
+                    if isinstance(res, list):
+                        stix_ids += res
+                    else:
+                        stix_ids.append(obj['id'])
+                if file_failed:
+                    # Leave it out of the manifest so it is retried next time
                     continue
-                data = yaml.safe_load(yml)
-                try:
-                    tags = data['tags']
-                except KeyError:
+                old_ids = set(manifest.ids(filepath)) - set(stix_ids)
+                if old_ids and not self.revoke_objects(
+                        user_id=self.identity['id'],
+                        stix_ids=sorted(old_ids)):
+                    success = False
                     continue
-                created = datetime.strptime(data['date'], '%Y/%m/%d').isoformat()
-                try:
-                    modified = datetime.strptime(data['modified'], '%Y/%m/%d').isoformat()
-                    ind = stix2.v21.Indicator(
-                        name=data['title'],
-                        description=data['description'],
-                        created=created,
-                        modified=modified,
-                        valid_from=created,
-                        indicator_types=['malicious-activity'],
-                        pattern_type='sigma',
-                        pattern=yml,
-                        object_marking_refs=obj_md_refs,
-                        created_by_ref=author_id)
-                except KeyError:
-                    ind = stix2.v21.Indicator(
-                        name=data['title'],
-                        description=data['description'],
-                        created=created,
-                        valid_from=created,
-                        indicator_types=['malicious-activity'],
-                        pattern_type='sigma',
-                        pattern=yml,
-                        object_marking_refs=obj_md_refs,
-                        created_by_ref=author_id)
+                manifest.update(filepath, stix_ids)
+            return success
+
+        success = True
+        deleted = []
+        batch = []
+        batch_size = 0
+        if manifest is not None:
+            manifest = Manifest(manifest)
+            filepaths, deleted = manifest.changes(filepaths, root=root)
+            print(str(len(filepaths)) + ' new or changed files, ' +
+                  str(len(deleted)) + ' deleted files.')
+
+        for filepath, rules, error in parse_files(parse, filepaths, args=args,
+                                                  workers=workers,
+                                                  queue_depth=queue_depth):
+            if error is not None:
+                print('Failed to parse ' + filepath + ': ' + str(error))
+                success = False
+                continue
+            objs = []
+            for rule in rules:
                 rels = []
-                for tag in tags:
-                    atp_ids = self.extract_known_atps(tag)
-                    if atp_ids:
-                        for atp_id in atp_ids:
-                            if atp_id.startswith('course-of-action--'):
-                                continue
-                            rels.append(stix2.v21.Relationship(
-                                    source_ref=ind.id,
-                                    target_ref=atp_id,
-                                    relationship_type='indicates',
-                                    object_marking_refs=obj_md_refs,
-                                    created_by_ref=author_id))
-                if not rels:
+                for link in rule['links']:
+                    for atp_id in self.extract_known_atps(link['text']):
+                        if atp_id.startswith(tuple(link.get('exclude', []))):
+                            continue
+                        rels.append(stix2.v21.Relationship(
+                                created_by_ref=author_id,
+                                source_ref=link['source_ref'],
+                                target_ref=atp_id,
+                                relationship_type='indicates',
+                                object_marking_refs=obj_md_refs))
+                if rule['required'] and not rels:
                     continue
-                print(self.index(user_id=self.identity['id'],
-                                 body=json.loads(ind.serialize())))
-                for rel in rels:
-                    print(self.index(user_id=self.identity['id'],
-                                     body=json.loads(rel.serialize())))
-        return True
+                objs += rule['objects']
+                objs += [json.loads(rel.serialize()) for rel in rels]
+
+            batch.append((filepath, objs))
+            batch_size += len(objs)
+            if batch_size >= chunk_size:
+                if not flush(batch):
+                    success = False
+                batch = []
+                batch_size = 0
+        if batch and not flush(batch):
+            success = False
+
+        if manifest is None:
+            return success
+        for filepath in deleted:
+            if not self.revoke_objects(user_id=self.identity['id'],
+                                       stix_ids=manifest.ids(filepath)):
+                success = False
+                continue
+            manifest.remove(filepath)
+        manifest.save()
+        return success
+
+    def data_dump(self, path='cti-data.json', shard=False, compression=None,
+                  size=1000, slices=1, workers=None, revoked=True):
+        """Export the repository (as seen by the system identity) to disk.
 
-    def data_dump(self):
+        Each stix2 object type index is scrolled separately, split into
+        ``slices`` slices per index, with the scrolls spread over a pool of
+        threads. Objects are written out as they are returned, either as a
+        single stix2 bundle or sharded by object type.
+
+        Args:
+            path (:obj:`str`, optional): Bundle file to write or, if
+                ``shard`` is set, the directory to write to.
+            shard (:obj:`bool` or :obj:`str`, optional): ``'ndjson'`` (or
+                ``True``) to write one ``<type>.ndjson`` file per object
+                type; ``'files'`` to write one ``<type>/<id>.json`` file per
+                object. Defaults to ``False`` for a single bundle.
+            compression (:obj:`str`, optional): ``'gzip'`` or ``'zstd'``
+                (requires the ``zstandard`` package) compression for the
+                output. Shard files get a ``.gz``/``.zst`` suffix.
+            size (:obj:`int`, optional): Hits per scroll page.
+            slices (:obj:`int`, optional): Number of slices to split the
+                scroll of each index into.
+            workers (:obj:`int`, optional): Number of threads fetching
+                slices. Defaults to one per slice, up to the number of cores.
+            revoked (:obj:`bool`, optional): Pass through to ``search()``.
+                Defaults to ``True`` to include revoked objects, so that the
+                dump holds the version history that ``restore()`` relies
+                on; ``False`` to export the current objects only.
+
+        Returns:
+            :obj:`dict`: Number of objects exported per type.
+        """
         stats = {}
         count = 0
         q = {"query": {"match_all": {}}}
-        objects = []
-        for hit in helpers.scan(client=self, index='intel', query=q,
-                                user_id=self.identity['id']):
-            objects.append(hit['_source'])
-            try:
-                stats[hit['_source']['type']] += 1
-            except KeyError:
-                stats[hit['_source']['type']] = 1
-            count += 1
-        bundle = {"type": "bundle",
-                  "id": get_deterministic_uuid(prefix='bundle--',
-                                               seed='fuck-bundles'),
-                  "objects": objects}
-        with open('cti-data.json', 'w') as outfile:
-            json.dump(bundle, outfile)
+        indices = sorted(set(index_name.split('--')[0] for index_name in
+                             self.indices.get_alias(name='intel')))
+        if self.query_markings:
+            # Resolved up front so that the threads share it
+            self.get_marking_filter(user_id=self.identity['id'])
+            md_aliases = indices
+        else:
+            md_aliases = [self.get_id_markings(user_id=self.identity['id'],
+                                               index_alias=index_alias)
+                          for index_alias in indices]
+        if shard == 'files':
+            writer = FilesWriter(path, compression=compression)
+        elif shard:
+            writer = ShardWriter(path, compression=compression)
+        else:
+            writer = BundleWriter(path,
+                                  bundle_id=get_deterministic_uuid(
+                                      prefix='bundle--',
+                                      seed='fuck-bundles'),
+                                  compression=compression)
+        with writer:
+            for hit in scan_slices(self, body=q, indices=md_aliases,
+                                   slices=slices, size=size,
+                                   workers=workers,
+                                   user_id=self.identity['id'],
+                                   _md=self.query_markings,
+                                   revoked=revoked):
+                writer.write(hit['_source'])
+                try:
+                    stats[hit['_source']['type']] += 1
+                except KeyError:
+                    stats[hit['_source']['type']] = 1
+                count += 1
         print(count)
         pprint(stats)
-        return True
+        return stats
+
+    def restore(self, path, chunk_size=500, max_chunk_bytes=10485760,
+                thread_count=None):
+        """Bulk load a ``data_dump()`` export (bundle file or dump directory,
+        compressed or not) back into the repository.
+
+        Objects are streamed from disk and routed to their type index by
+        their id prefix. Up-versioning is skipped and objects overwrite any
+        existing copy, so the dump must hold the version history: take it
+        with revoked objects included (the ``data_dump()`` default). Schema
+        hit tags are not restored; run ``tag_schema_hits()`` afterwards for
+        a client with ``schema_hits`` set. Index
+        refresh and replicas are switched off for the load and put back
+        afterwards. The repository indices must already exist (eg: via
+        ``store_core_data()``). The edges of the current (not revoked)
+        objects are written to the edge index as they go.
+
+        Args:
+            path (:obj:`str`): Bundle file or dump directory to load.
+            chunk_size (:obj:`int`, optional): Number of objects per bulk
+                request.
+            max_chunk_bytes (:obj:`int`, optional): Maximum size of a bulk
+                request in bytes.
+            thread_count (:obj:`int`, optional): Number of threads to send
+                bulk requests with. Defaults to ``None`` (single, streaming
+                connection).
+
+        Returns:
+            :obj:`dict`: Number of objects restored per type.
+        """
+        stats = {}
+        aliases = self.indices.get_alias(name='intel')
+        types = set(index_name.split('--')[0] for index_name in aliases)
+        settings = self.indices.get_settings(
+            index=list(aliases),
+            name=['index.refresh_interval', 'index.number_of_replicas'])
+        edges = self.has_edges()
+
+        def actions():
+            for obj in iter_dump_objects(path):
+                obj_id_parts = obj['id'].split('--')
+                if obj_id_parts[0] not in types:
+                    print('No index for ' + obj['id'] + ', skipping.')
+                    continue
+                # Tags in older dumps may be stale
+                obj.pop('x_g4i_schema_hits', None)
+                yield {"_op_type": "index",
+                       "_index": obj_id_parts[0],
+                       "_id": obj_id_parts[1],
+                       "_source": obj}
+                if edges and not obj.get('revoked', False):
+                    for action in edge_actions(obj):
+                        yield action
+
+        self.indices.put_settings(index=list(aliases),
+                                  body={"index": {
+                                      "refresh_interval": "-1",
+                                      "number_of_replicas": 0}})
+        try:
+            if thread_count:
+                results = helpers.parallel_bulk(
+                    self, actions(), thread_count=thread_count,
+                    chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                    raise_on_error=False, raise_on_exception=False)
+            else:
+                results = helpers.streaming_bulk(
+                    self, actions(), chunk_size=chunk_size,
+                    max_chunk_bytes=max_chunk_bytes, raise_on_error=False,
+                    raise_on_exception=False)
+            for ok, item in results:
+                res = next(iter(item.values()))
+                if not ok:
+                    print('Failed to restore object: ' +
+                          str(res.get('error', item)))
+                    continue
+                if res['_index'] == edges_index:
+                    continue
+                stix_type = res['_index'].split('--')[0]
+                self.known_ids.add((stix_type, res['_id']))
+                try:
+                    stats[stix_type] += 1
+                except KeyError:
+                    stats[stix_type] = 1
+        finally:
+            for index_name, index_settings in settings.items():
+                current = index_settings['settings'].get('index', {})
+                self.indices.put_settings(index=index_name,
+                                          body={"index": {
+                                              "refresh_interval":
+                                                  current.get(
+                                                      'refresh_interval'),
+                                              "number_of_replicas":
+                                                  current.get(
+                                                      'number_of_replicas',
+                                                      1)}})
+            self.indices.refresh(index=list(aliases))
+            if edges:
+                self.indices.refresh(index=edges_index)
+
+        self.attack_ids.invalidate()
+        if self.graph_snapshot is not None:
+            self.load_graph()
+        self.__set_os_group_id()
+        pprint(stats)
+        return stats
 
     def get_yara(self):
 
@@ -0,0 +1,402 @@
+"""Supporting classes and functions for exporting the repository to disk
+(``Client.data_dump()``) and loading it back (``Client.restore()``).
+
+Exports and restores are streamed: hits are written out as they come back
+from the scroll and objects are read back one at a time, so memory use does
+not grow with the size of the repository.
+
+Attributes:
+    compression_suffixes (:obj:`dict`): File name suffix for each supported
+        compression type.
+"""
+import gzip
+import io
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from .utils import iter_bundle_objects
+
+
+compression_suffixes = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def open_output(path, compression=None):
+    """Open a text file for writing, optionally compressed.
+
+    Args:
+        path (:obj:`str`): File to write.
+        compression (:obj:`str`, optional): ``'gzip'``, ``'zstd'`` (requires
+            the ``zstandard`` package) or ``None``.
+
+    Returns:
+        File object open for writing text.
+    """
+    if compression is None:
+        return open(path, 'w', encoding='utf-8')
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression requires the zstandard '
+                              'package')
+        writer = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(writer, encoding='utf-8')
+    raise ValueError('Unsupported compression: ' + str(compression))
+
+
+def open_input(path):
+    """Open a (possibly compressed) file for reading as bytes; compression
+    is taken from the ``.gz``/``.zst`` suffix.
+
+    Args:
+        path (:obj:`str`): File to read.
+
+    Returns:
+        File object open for reading bytes.
+    """
+    if path.endswith(compression_suffixes['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(compression_suffixes['zstd']):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression requires the zstandard '
+                              'package')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                         closefd=True)
+    return open(path, 'rb')
+
+
+def iter_dump_objects(path):
+    """Read back the stix2 objects written by ``Client.data_dump()`` in any
+    of its layouts: a bundle file, a directory of ``<type>.ndjson`` shards
+    or a directory of ``<type>/<id>.json`` files (compressed or not).
+
+    Args:
+        path (:obj:`str`): Bundle file or dump directory.
+
+    Yields:
+        :obj:`dict`: Each stix2 object.
+    """
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            # Skip any staging directory left by an interrupted dump
+            dirnames[:] = sorted(dirname for dirname in dirnames
+                                 if not dirname.startswith('.'))
+            for filename in sorted(filenames):
+                for obj in iter_dump_objects(os.path.join(dirpath,
+                                                          filename)):
+                    yield obj
+        return
+
+    name = path
+    for suffix in compression_suffixes.values():
+        if suffix and name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if name.endswith('.ndjson'):
+        with open_input(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    if not name.endswith('.json'):
+        return
+
+    with open_input(path) as f:
+        if os.path.basename(os.path.dirname(path)) == \
+                os.path.basename(name).split('--')[0]:
+            # Single object file (<type>/<id>.json)
+            yield json.load(f)
+            return
+        for obj in iter_bundle_objects(iter(lambda: f.read(65536), b'')):
+            yield obj
+
+
+class BundleWriter(object):
+    """Writes a single stix2 bundle file, emitting the object list
+    incrementally. Used as a context manager, the bundle is only finished
+    if the block completes; on an exception the file is removed rather
+    than left as a valid but truncated bundle.
+
+    Args:
+        path (:obj:`str`): File to write.
+        bundle_id (:obj:`str`): Stix2 id for the bundle.
+        compression (:obj:`str`, optional): As per ``open_output()``.
+    """
+
+    def __init__(self, path, bundle_id, compression=None):
+        self.count = 0
+        self.path = path
+        self._f = open_output(path, compression)
+        self._f.write('{"type": "bundle", "id": ' + json.dumps(bundle_id) +
+                      ', "objects": [')
+
+    def write(self, obj):
+        if self.count:
+            self._f.write(', ')
+        json.dump(obj, self._f)
+        self.count += 1
+
+    def close(self):
+        self._f.write(']}')
+        self._f.close()
+
+    def abort(self):
+        """Close and remove the (unfinished) bundle file."""
+        self._f.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ShardWriter(object):
+    """Writes one newline delimited JSON (NDJSON) file per stix2 object type
+    (``<directory>/<type>.ndjson``). As per ``BundleWriter``, the files are
+    removed if the block exits on an exception.
+
+    Args:
+        directory (:obj:`str`): Output directory (created if needed).
+        compression (:obj:`str`, optional): As per ``open_output()``.
+    """
+
+    def __init__(self, directory, compression=None):
+        self.count = 0
+        self.directory = directory
+        self.compression = compression
+        self._files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, obj):
+        try:
+            f = self._files[obj['type']]
+        except KeyError:
+            f = open_output(self._path(obj['type']), self.compression)
+            self._files[obj['type']] = f
+        f.write(json.dumps(obj) + '\n')
+        self.count += 1
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def abort(self):
+        """Close and remove the (unfinished) shard files."""
+        for obj_type, f in self._files.items():
+            f.close()
+            os.remove(self._path(obj_type))
+        self._files = {}
+
+    def _path(self, obj_type):
+        return os.path.join(self.directory,
+                            obj_type + '.ndjson' +
+                            compression_suffixes[self.compression])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FilesWriter(object):
+    """Writes one JSON file per stix2 object in a directory per object type
+    (``<directory>/<type>/<id>.json``). The files are written to a hidden
+    staging directory and only moved in to place on ``close()``; as per
+    ``BundleWriter``, they are removed if the block exits on an exception.
+
+    Args:
+        directory (:obj:`str`): Output directory (created if needed).
+        compression (:obj:`str`, optional): As per ``open_output()``.
+    """
+
+    def __init__(self, directory, compression=None):
+        self.count = 0
+        self.directory = directory
+        self.compression = compression
+        self._dirs = set()
+        os.makedirs(directory, exist_ok=True)
+        self._staging = tempfile.mkdtemp(prefix='.partial-', dir=directory)
+
+    def write(self, obj):
+        type_dir = os.path.join(self._staging, obj['type'])
+        if obj['type'] not in self._dirs:
+            os.makedirs(type_dir, exist_ok=True)
+            self._dirs.add(obj['type'])
+        filename = obj['id'] + '.json' + compression_suffixes[self.compression]
+        with open_output(os.path.join(type_dir, filename),
+                         self.compression) as f:
+            json.dump(obj, f)
+        self.count += 1
+
+    def close(self):
+        for obj_type in sorted(self._dirs):
+            type_dir = os.path.join(self.directory, obj_type)
+            os.makedirs(type_dir, exist_ok=True)
+            for entry in os.scandir(os.path.join(self._staging, obj_type)):
+                os.replace(entry.path, os.path.join(type_dir, entry.name))
+        shutil.rmtree(self._staging)
+        self._dirs = set()
+
+    def abort(self):
+        """Remove the staging directory and the files written to it."""
+        shutil.rmtree(self._staging, ignore_errors=True)
+        self._dirs = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def scroll_slice(client, body, size=1000, scroll='5m', slice_id=None,
+                 slices=1, **kwargs):
+    """Scroll through all the hits for a query, optionally as one slice of a
+    sliced scroll.
+
+    Args:
+        client (:obj:`Client`): git4intel client to scroll with.
+        body (:obj:`dict`): Search body (``query`` etc.).
+        size (:obj:`int`, optional): Hits per scroll page.
+        scroll (:obj:`str`, optional): Scroll context keep-alive.
+        slice_id (:obj:`int`, optional): Slice to fetch.
+        slices (:obj:`int`, optional): Total number of slices.
+        **kwargs: As per ``Client.search()`` arguments (``user_id``,
+            ``index``, ``_md`` etc.).
+
+    Yields:
+        :obj:`list` of :obj:`dict`: Each page of hits.
+    """
+    body = dict(body)
+    if slices > 1:
+        body['slice'] = {"id": slice_id, "max": slices}
+    res = client.search(body=body, scroll=scroll, size=size, **kwargs)
+    scroll_id = res.get('_scroll_id')
+    try:
+        while res['hits']['hits']:
+            yield res['hits']['hits']
+            if not scroll_id:
+                break
+            res = client.scroll(scroll_id=scroll_id, scroll=scroll)
+            scroll_id = res.get('_scroll_id')
+    finally:
+        if scroll_id:
+            client.clear_scroll(scroll_id=scroll_id, ignore=[404])
+
+
+def scan_slices(client, body, indices, slices=1, size=1000, scroll='5m',
+                workers=None, queue_depth=None, **kwargs):
+    """Sliced scroll over one or more indices with the slices (``slices``
+    per index) fetched in parallel by a pool of threads. Pages are handed
+    back through a bounded queue so a slow consumer holds the scrolls back
+    rather than the hits piling up in memory.
+
+    Args:
+        client (:obj:`Client`): git4intel client to scroll with.
+        body (:obj:`dict`): Search body (``query`` etc.).
+        indices (:obj:`str` or :obj:`list` of :obj:`str`): Indices (or
+            aliases) to scroll.
+        slices (:obj:`int`, optional): Number of slices per index.
+        size (:obj:`int`, optional): Hits per scroll page.
+        scroll (:obj:`str`, optional): Scroll context keep-alive.
+        workers (:obj:`int`, optional): Number of threads. Defaults to one
+            per slice, up to the number of cores.
+        queue_depth (:obj:`int`, optional): Maximum number of pages waiting
+            to be consumed. Defaults to two per worker.
+        **kwargs: As per ``scroll_slice()``; resolve any marking definition
+            aliases up front and pass ``_md=False`` so that the threads do
+            not each try to build them.
+
+    Yields:
+        :obj:`dict`: Each hit (in no particular order across slices).
+    """
+    if isinstance(indices, str):
+        indices = [indices]
+    tasks = queue.Queue()
+    for index in indices:
+        for slice_id in range(slices):
+            tasks.put((index, slice_id))
+    if workers is None:
+        workers = min(tasks.qsize(), os.cpu_count() or 1)
+    workers = min(workers, tasks.qsize())
+    if workers <= 1:
+        while not tasks.empty():
+            index, slice_id = tasks.get()
+            for page in scroll_slice(client, body, size=size, scroll=scroll,
+                                     slice_id=slice_id, slices=slices,
+                                     index=index, **kwargs):
+                for hit in page:
+                    yield hit
+        return
+
+    if queue_depth is None:
+        queue_depth = workers * 2
+    pages = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    done = object()
+
+    def worker():
+        try:
+            while not stop.is_set():
+                try:
+                    index, slice_id = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                for page in scroll_slice(client, body, size=size,
+                                         scroll=scroll, slice_id=slice_id,
+                                         slices=slices, index=index,
+                                         **kwargs):
+                    if stop.is_set():
+                        break
+                    pages.put(page)
+        except Exception as e:
+            pages.put(e)
+        pages.put(done)
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            page = pages.get()
+            if page is done:
+                running -= 1
+                continue
+            if isinstance(page, Exception):
+                raise page
+            for hit in page:
+                yield hit
+    finally:
+        stop.set()
+        # Unblock any worker waiting on a full queue
+        while any(thread.is_alive() for thread in threads):
+            try:
+                pages.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -0,0 +1,129 @@
+"""Adjacency (edge) index of the references between stix2 objects, used by
+the client for graph walks (eg: molecule expansion) in place of full text
+searches over every ``*_ref``/``*_refs`` field of every index.
+
+Each edge document is keyed on a stix2 id (``stix_id``) and holds one
+neighbour (``peer_ref``), the object that carries the reference
+(``rel_ref``) and the direction of the reference:
+
+- a relationship ``R`` (``S`` -> ``T``) gives ``(S, T, R, out)`` and
+  ``(T, S, R, in)`` with the ``relationship_type`` of ``R``
+- any other reference property ``p`` of an object ``O`` to ``X`` gives
+  ``(O, X, O, out)`` and ``(X, O, O, in)`` with ``ref_field`` set to ``p``
+
+so that the objects that reference an id are the ``rel_ref`` values of its
+edges (other than itself). All of the fields are keywords: a walk is a
+``terms`` lookup rather than analysed text matching.
+
+Edges are not filtered by marking definitions: they only give candidate ids
+which are then searched for through the user's marking definition alias.
+
+Attributes:
+    edges_index (:obj:`str`): Name of the edge index.
+    edges_mapping (:obj:`dict`): Elasticsearch mapping for the edge index.
+"""
+
+edges_index = 'relationship-edges'
+
+edges_mapping = {
+    "mappings": {
+        "dynamic": "strict",
+        "properties": {
+            "stix_id": {"type": "keyword"},
+            "peer_ref": {"type": "keyword"},
+            "rel_ref": {"type": "keyword"},
+            "relationship_type": {"type": "keyword"},
+            "ref_field": {"type": "keyword"},
+            "direction": {"type": "keyword"}
+        }
+    }
+}
+
+
+def _iter_refs(obj, prefix=''):
+    """Yields ``(field, stix_id)`` for every reference property of an object
+    (including those of object properties, but not of lists of objects
+    which are mapped as nested).
+    """
+    for key, value in obj.items():
+        field = prefix + key
+        if isinstance(value, dict):
+            for ref in _iter_refs(value, field + '.'):
+                yield ref
+        elif key.endswith('_ref') and isinstance(value, str):
+            yield field, value
+        elif key.endswith('_refs') and isinstance(value, list):
+            for sub_value in value:
+                if isinstance(sub_value, str):
+                    yield field, sub_value
+
+
+def get_edges(obj):
+    """Get the edge documents for a stix2 object.
+
+    Args:
+        obj (:obj:`dict`): JSON serializable stix2 object dictionary.
+
+    Returns:
+        :obj:`list` of :obj:`dict`: Edge documents.
+    """
+    edges = []
+    obj_id = obj['id']
+    is_rel = obj.get('type') == 'relationship'
+    if is_rel:
+        source_ref = obj.get('source_ref')
+        target_ref = obj.get('target_ref')
+        if source_ref and target_ref:
+            for stix_id, peer_ref, direction in (
+                    (source_ref, target_ref, 'out'),
+                    (target_ref, source_ref, 'in')):
+                edges.append({"stix_id": stix_id,
+                              "peer_ref": peer_ref,
+                              "rel_ref": obj_id,
+                              "relationship_type": obj.get(
+                                  'relationship_type'),
+                              "direction": direction})
+    for field, ref in _iter_refs(obj):
+        if is_rel and field in ('source_ref', 'target_ref'):
+            continue
+        edges.append({"stix_id": obj_id,
+                      "peer_ref": ref,
+                      "rel_ref": obj_id,
+                      "ref_field": field,
+                      "direction": "out"})
+        edges.append({"stix_id": ref,
+                      "peer_ref": obj_id,
+                      "rel_ref": obj_id,
+                      "ref_field": field,
+                      "direction": "in"})
+    return edges
+
+
+def edge_id(edge):
+    """Deterministic document id for an edge so that re-indexing an object
+    overwrites rather than duplicates its edges.
+
+    Args:
+        edge (:obj:`dict`): Edge document.
+
+    Returns:
+        :obj:`str`: Document id.
+    """
+    return '|'.join([edge['stix_id'], edge['direction'], edge['rel_ref'],
+                     edge.get('relationship_type') or edge['ref_field'],
+                     edge['peer_ref']])
+
+
+def edge_actions(obj):
+    """Bulk index actions for the edges of a stix2 object.
+
+    Args:
+        obj (:obj:`dict`): JSON serializable stix2 object dictionary.
+
+    Returns:
+        :obj:`list` of :obj:`dict`: Actions for ``helpers.bulk()``.
+    """
+    return [{"_op_type": "index",
+             "_index": edges_index,
+             "_id": edge_id(edge),
+             "_source": edge} for edge in get_edges(obj)]
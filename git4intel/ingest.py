@@ -0,0 +1,400 @@
+"""Supporting classes and functions for ingesting rule libraries (sigma,
+osquery etc.) from a local checkout into the repository.
+
+The ``parse_*`` functions are the CPU-bound half of an ingest: they turn a
+single file into plain (JSON serializable) stix2 dictionaries without
+touching elasticsearch, so that ``parse_files()`` can run them in a process
+pool while the client indexes the results.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import collections
+import hashlib
+import json
+import os
+import re
+import stix2
+import yaml
+
+from .utils import get_deterministic_uuid
+
+
+def parse_files(parse, filepaths, args=(), workers=None, queue_depth=None):
+    """Run a parse function over a list of files in a process pool.
+
+    At most ``queue_depth`` files are in flight at any time, so a slow
+    consumer (eg: indexing the results) holds back the parsing rather than
+    the results piling up in memory.
+
+    Args:
+        parse (:obj:`function`): Module level (picklable) function taking a
+            file path followed by ``args``.
+        filepaths (:obj:`list` of :obj:`str`): Files to parse.
+        args (:obj:`tuple`, optional): Extra arguments for ``parse``.
+        workers (:obj:`int`, optional): Number of worker processes. Defaults
+            to the number of cores; ``0`` parses in the calling process.
+        queue_depth (:obj:`int`, optional): Maximum number of parsed or
+            in-progress files waiting to be consumed. Defaults to four per
+            worker.
+
+    Yields:
+        :obj:`tuple`: ``(filepath, result, error)`` in the order of
+        ``filepaths``, where ``error`` is the exception raised by ``parse``
+        (and ``result`` is ``None``) if it failed.
+    """
+    if workers == 0:
+        for filepath in filepaths:
+            try:
+                yield filepath, parse(filepath, *args), None
+            except Exception as e:
+                yield filepath, None, e
+        return
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if queue_depth is None:
+        queue_depth = workers * 4
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for filepath in filepaths:
+            pending.append((filepath, pool.submit(parse, filepath, *args)))
+            if len(pending) < queue_depth:
+                continue
+            yield _parse_result(*pending.popleft())
+        while pending:
+            yield _parse_result(*pending.popleft())
+
+
+def _parse_result(filepath, future):
+    try:
+        return filepath, future.result(), None
+    except Exception as e:
+        return filepath, None, e
+
+
+def parse_osquery_pack(filepath, author_id, obj_md_refs):
+    """Turn an osquery pack (.conf) file into stix2 indicators.
+
+    Args:
+        filepath (:obj:`str`): Pack file.
+        author_id (:obj:`str`): Identity reference for created_by_ref.
+        obj_md_refs (:obj:`list` of :obj:`str`): Marking definitions to
+            apply.
+
+    Returns:
+        :obj:`list` of :obj:`dict`: One rule per pack with ``objects`` (the
+        pack and query indicators and their ``derived-from``
+        relationships), ``links`` (source reference and text to resolve
+        Att&ck ids from for ``indicates`` relationships) and ``required``
+        (whether the rule is dropped if no links resolve).
+    """
+    objs = []
+    links = []
+    name = os.path.basename(filepath).split('.')[0]
+    with open(filepath, 'r') as f:
+        fd = f.read()
+        data = json.loads(fd)
+        data['name'] = name
+        top_data = json.dumps(data)
+    top_ind = stix2.v21.Indicator(
+                          id=get_deterministic_uuid(
+                                prefix='indicator--',
+                                seed=name + 'osquery-pack'),
+                          created_by_ref=author_id,
+                          name=name,
+                          pattern=top_data,
+                          pattern_type='osquery-pack',
+                          valid_from=datetime.now(),
+                          indicator_types=['malicious-activity'],
+                          object_marking_refs=obj_md_refs)
+    objs.append(json.loads(top_ind.serialize()))
+    if 'description' in data:
+        links.append({"source_ref": top_ind.id,
+                      "text": data['description']})
+
+    for query in data.get('queries', {}):
+        ind = stix2.v21.Indicator(
+                      id=get_deterministic_uuid(
+                                prefix='indicator--',
+                                seed=query),
+                      created_by_ref=author_id,
+                      name=query,
+                      pattern=json.dumps(data['queries'][query]),
+                      pattern_type='osquery',
+                      valid_from=datetime.now(),
+                      indicator_types=['malicious-activity'],
+                      object_marking_refs=obj_md_refs)
+        objs.append(json.loads(ind.serialize()))
+        derived = stix2.v21.Relationship(
+                           created_by_ref=author_id,
+                           source_ref=ind.id,
+                           target_ref=top_ind.id,
+                           relationship_type='derived-from',
+                           object_marking_refs=obj_md_refs)
+        objs.append(json.loads(derived.serialize()))
+        if 'description' in data:
+            links.append({"source_ref": top_ind.id,
+                          "text": data['description']})
+    return [{"objects": objs, "links": links, "required": False}]
+
+
+def parse_sigma_rules(filepath, author_id, obj_md_refs):
+    """Turn a sigma rule (.yml) file into stix2 indicators.
+
+    Args:
+        filepath (:obj:`str`): Rule file (which may hold several ``---``
+            separated rules).
+        author_id (:obj:`str`): Identity reference for created_by_ref.
+        obj_md_refs (:obj:`list` of :obj:`str`): Marking definitions to
+            apply.
+
+    Returns:
+        :obj:`list` of :obj:`dict`: One rule per tagged sigma rule, as per
+        ``parse_osquery_pack()``; rules are only kept if one of their tags
+        resolves to an Att&ck object.
+    """
+    rules = []
+    with open(filepath, 'r') as f:
+        file_content = f.read()
+    for yml in file_content.split('---'):
+        if not yml:
+            continue
+        data = yaml.safe_load(yml)
+        try:
+            tags = data['tags']
+        except KeyError:
+            continue
+        created = datetime.strptime(data['date'], '%Y/%m/%d').isoformat()
+        try:
+            modified = datetime.strptime(data['modified'], '%Y/%m/%d').isoformat()
+            ind = stix2.v21.Indicator(
+                name=data['title'],
+                description=data['description'],
+                created=created,
+                modified=modified,
+                valid_from=created,
+                indicator_types=['malicious-activity'],
+                pattern_type='sigma',
+                pattern=yml,
+                object_marking_refs=obj_md_refs,
+                created_by_ref=author_id)
+        except KeyError:
+            ind = stix2.v21.Indicator(
+                name=data['title'],
+                description=data['description'],
+                created=created,
+                valid_from=created,
+                indicator_types=['malicious-activity'],
+                pattern_type='sigma',
+                pattern=yml,
+                object_marking_refs=obj_md_refs,
+                created_by_ref=author_id)
+        links = [{"source_ref": ind.id,
+                  "text": tag,
+                  "exclude": ['course-of-action--']} for tag in tags]
+        rules.append({"objects": [json.loads(ind.serialize())],
+                      "links": links,
+                      "required": True})
+    return rules
+
+
+_tablename_re = re.compile(r'table_name\("([^"]{1,128})"')
+_desc_re = re.compile(r'description\("([^"]{1,99999})"')
+_schema_re = re.compile(r'schema\(\[(.{1,999999})\]\)')
+_extschema_re = re.compile(r'extended_schema\(.{1,128}, \[(.{1,99999})\]\)')
+_schemas_re = re.compile(
+    r'Column\("([^"]{1,32})", (\w{1,32}), "([^"]{1,64})"\)')
+
+
+def parse_table(filepath):
+    """Pull the table name, description and columns out of an osquery
+    ``.table`` spec file.
+
+    Args:
+        filepath (:obj:`str`): Table spec file.
+
+    Returns:
+        :obj:`tuple`: ``(tablename, table)`` where ``table`` holds the
+        ``description`` and ``columns`` found.
+    """
+    with open(filepath, 'r') as f:
+        data = f.read()
+    data = data.replace('\n', '')
+    tablename = re.findall(_tablename_re, data)
+    desc = re.findall(_desc_re, data)
+    schema = re.findall(_schema_re, data)
+    extschema = re.findall(_extschema_re, data)
+    tmp = ''.join(schema)
+    if extschema:
+        tmp_ext = ''.join(extschema)
+        tmp = tmp + tmp_ext
+    columns = re.findall(_schemas_re, tmp)
+
+    table = {}
+    if desc:
+        table['description'] = desc[0]
+    if columns:
+        table['columns'] = columns
+
+    if tablename:
+        return tablename[0], table
+    return os.path.basename(filepath).split('.')[0], table
+
+
+def file_digest(filepath, block_size=65536):
+    """sha256 hex digest of a file's content.
+
+    Args:
+        filepath (:obj:`str`): Path of the file to hash.
+        block_size (:obj:`int`, optional): Read size in bytes.
+
+    Returns:
+        :obj:`str`: Hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """Persistent record of the rule files that have been ingested and the
+    stix2 object ids that each of them produced, so that re-runs only need to
+    deal with files that were added, changed or deleted.
+
+    The manifest is a JSON-lines file with one entry per line (``path``,
+    ``mtime``, ``size``, ``sha256`` and ``ids``). Updates are appended as they
+    happen (the last line for a path wins, ``"deleted": true`` drops it) so an
+    interrupted run loses nothing; ``save()`` compacts the file. Use one
+    manifest per rule source.
+
+    Args:
+        filepath (:obj:`str`): Location of the manifest file. Created on the
+            first ``update()`` if it does not exist.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = {}
+        self._pending = {}
+        try:
+            with open(filepath, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry.get('deleted'):
+                        self.entries.pop(entry['path'], None)
+                    else:
+                        self.entries[entry['path']] = entry
+        except FileNotFoundError:
+            pass
+
+    def changes(self, filepaths, root=None):
+        """Compare a listing of rule files against the manifest.
+
+        A file is unchanged if its mtime and size match the manifest or, if
+        not, its content hash does.
+
+        Args:
+            filepaths (:obj:`list` of :obj:`str`): Current rule files.
+            root (:obj:`str`, optional): Top level directory of the listing;
+                only manifest entries under it can be reported as deleted.
+
+        Returns:
+            :obj:`tuple`: ``(changed, deleted)`` lists of paths, where
+            ``changed`` are new or modified files that need to be
+            (re)ingested and ``deleted`` are files in the manifest that no
+            longer exist.
+        """
+        changed = []
+        current = set()
+        for filepath in filepaths:
+            path = os.path.abspath(filepath)
+            current.add(path)
+            stat = os.stat(path)
+            entry = self.entries.get(path)
+            if (entry and entry['mtime'] == stat.st_mtime and
+                    entry['size'] == stat.st_size):
+                continue
+            sha256 = file_digest(path)
+            if entry and entry['sha256'] == sha256:
+                # Touched but not changed - just record the new stat
+                self._write(dict(entry, mtime=stat.st_mtime,
+                                 size=stat.st_size))
+                continue
+            self._pending[path] = {"path": path,
+                                   "mtime": stat.st_mtime,
+                                   "size": stat.st_size,
+                                   "sha256": sha256}
+            changed.append(filepath)
+
+        deleted = []
+        if root is not None:
+            root = os.path.join(os.path.abspath(root), '')
+        for path in self.entries:
+            if path in current:
+                continue
+            if root is None or path.startswith(root):
+                deleted.append(path)
+        return changed, deleted
+
+    def ids(self, filepath):
+        """Stix2 object ids recorded for a file.
+
+        Args:
+            filepath (:obj:`str`): Rule file path.
+
+        Returns:
+            :obj:`list` of :obj:`str`: Ids produced by the last ingest of the
+            file (empty if it has not been ingested).
+        """
+        entry = self.entries.get(os.path.abspath(filepath))
+        if not entry:
+            return []
+        return entry['ids']
+
+    def update(self, filepath, ids):
+        """Record the ids produced by ingesting a (changed) file.
+
+        Args:
+            filepath (:obj:`str`): Rule file path as passed to ``changes()``.
+            ids (:obj:`list` of :obj:`str`): Stix2 object ids produced.
+        """
+        path = os.path.abspath(filepath)
+        entry = self._pending.pop(path, None)
+        if entry is None:
+            stat = os.stat(path)
+            entry = {"path": path,
+                     "mtime": stat.st_mtime,
+                     "size": stat.st_size,
+                     "sha256": file_digest(path)}
+        entry['ids'] = list(ids)
+        self._write(entry)
+
+    def remove(self, filepath):
+        """Drop a (deleted) file from the manifest.
+
+        Args:
+            filepath (:obj:`str`): Rule file path.
+        """
+        path = os.path.abspath(filepath)
+        if path not in self.entries:
+            return
+        del self.entries[path]
+        with open(self.filepath, 'a') as f:
+            f.write(json.dumps({"path": path, "deleted": True}) + '\n')
+
+    def save(self):
+        """Compact the manifest file down to one line per ingested file."""
+        tmp_path = self.filepath + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for path in sorted(self.entries):
+                f.write(json.dumps(self.entries[path]) + '\n')
+        os.replace(tmp_path, self.filepath)
+
+    def _write(self, entry):
+        self.entries[entry['path']] = entry
+        with open(self.filepath, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
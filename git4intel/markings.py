@@ -0,0 +1,171 @@
+"""Marking definition access filters (``Client.get_id_markings()``).
+
+What a user is allowed to see is resolved into a ``MarkingFilter``:
+
+- objects with no marking references
+- objects marked with any of ``marking_refs`` (the OS marking definitions,
+  eg: TLP WHITE/GREEN, and those with the user or one of their orgs in the
+  distribution list, eg: tlp+)
+- PII marked objects with an id in ``pii_refs`` (the user's org chart)
+
+The filter is held as sets of ids with a version (a digest of the sorted
+ids) rather than as a query, so that two resolutions can be compared
+without comparing query bodies and so that the user's aliases are only
+rewritten when what they can see has changed.
+
+It is applied to the user's aliases in one of two ways:
+
+- ``to_query()``: one clause per marking definition and per PII id, so the
+  size of the alias filter grows with the user's access
+- ``to_lookup_query()``: the ids are written to a document per user in the
+  access list index (``access_doc()``) and the alias filter is two
+  ``terms`` lookups against it on the ``keyword`` copies of ``id`` and
+  ``object_marking_refs``. The filter is the same size for every user and
+  changing a user's access only rewrites their document (see
+  ``Client(..., access_lists=True)``)
+
+or, with ``Client(..., query_markings=True)``, it is not put on aliases at
+all: ``to_query()`` is added to each query. ``test()`` evaluates the filter
+against an object that has already been fetched.
+
+Attributes:
+    access_lists_index (:obj:`str`): Name of the access list index.
+    access_lists_mapping (:obj:`dict`): Elasticsearch mapping for the access
+        list index.
+"""
+import hashlib
+import json
+
+from .matchers import compile_query, source_values
+
+access_lists_index = 'access-lists'
+
+access_lists_mapping = {
+    "mappings": {
+        "dynamic": "strict",
+        "properties": {
+            "marking_refs": {"type": "keyword"},
+            "pii_refs": {"type": "keyword"},
+            "version": {"type": "keyword"}
+        }
+    }
+}
+
+
+def _uuid(stix_id):
+    # id fields are analysed on '--' so the uuid on its own matches
+    return stix_id.split('--')[-1]
+
+
+class MarkingFilter(object):
+    """Resolved marking definition access of a user.
+
+    Args:
+        marking_refs (:obj:`list` of :obj:`str`): STIX2 marking definition
+            reference ids that the user can see objects under.
+        pii_refs (:obj:`list` of :obj:`str`): STIX2 object reference ids
+            whose PII marked objects the user can see.
+        pii_marking_ref (:obj:`str`): STIX2 marking definition reference id
+            of the PII marking.
+
+    Attributes:
+        version (:obj:`str`): Digest of the filter; equal filters have
+            equal versions.
+    """
+
+    def __init__(self, marking_refs, pii_refs, pii_marking_ref):
+        self.marking_refs = frozenset(marking_refs)
+        self.pii_refs = frozenset(pii_refs)
+        self.pii_marking_ref = pii_marking_ref
+        content = json.dumps([sorted(self.marking_refs),
+                              sorted(self.pii_refs),
+                              pii_marking_ref])
+        self.version = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        self._query = None
+        self._matcher = None
+
+    def __eq__(self, other):
+        return (isinstance(other, MarkingFilter) and
+                self.version == other.version)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.version)
+
+    def clauses(self):
+        """Query clauses of the filter (any one of which lets an object
+        through), in a stable order.
+
+        Returns:
+            :obj:`list` of :obj:`dict`: Elasticsearch queries.
+        """
+        clauses = [{"bool": {"must_not": {"exists": {
+                                        "field": "object_marking_refs"}}}}]
+        for ref in sorted(self.marking_refs):
+            clauses.append({"match": {"object_marking_refs": _uuid(ref)}})
+        for ref in sorted(self.pii_refs):
+            clauses.append({"bool": {"must": [
+                {"match": {"id": _uuid(ref)}},
+                {"match": {"object_marking_refs":
+                           _uuid(self.pii_marking_ref)}}]}})
+        return clauses
+
+    def to_query(self):
+        """Elasticsearch filter for the objects that the user can see. The
+        query is built once and shared, so it must not be modified.
+
+        Returns:
+            :obj:`dict`: Elasticsearch query.
+        """
+        if self._query is None:
+            self._query = {"bool": {"should": self.clauses()}}
+        return self._query
+
+    def test(self, source):
+        """Check whether the user can see an object that has already been
+        fetched (as per ``to_query()``).
+
+        Args:
+            source (:obj:`dict`): JSON serializable stix2 object dictionary.
+
+        Returns:
+            :obj:`bool`: ``True`` if the object is visible.
+        """
+        if self._matcher is None:
+            self._matcher = compile_query(self.to_query())
+        return self._matcher.test(source_values(source, {}))
+
+    def access_doc(self):
+        """Access list document for ``to_lookup_query()``.
+
+        Returns:
+            :obj:`dict`: Document for the access list index.
+        """
+        return {"marking_refs": sorted(self.marking_refs),
+                "pii_refs": sorted(self.pii_refs),
+                "version": self.version}
+
+    def to_lookup_query(self, user_id):
+        """Elasticsearch filter for the objects that the user can see, as
+        ``terms`` lookups against their access list document.
+
+        Args:
+            user_id (:obj:`str`): STIX2 identity object reference id of the
+                user (the access list document id).
+
+        Returns:
+            :obj:`dict`: Elasticsearch query.
+        """
+        def lookup(path):
+            return {"index": access_lists_index, "id": user_id, "path": path}
+
+        return {"bool": {"should": [
+            {"bool": {"must_not": {"exists": {
+                                    "field": "object_marking_refs"}}}},
+            {"terms": {"object_marking_refs.keyword": lookup('marking_refs')}},
+            {"bool": {"must": [
+                {"terms": {"id.keyword": lookup('pii_refs')}},
+                {"match": {"object_marking_refs":
+                           _uuid(self.pii_marking_ref)}}]}}]}}
@@ -0,0 +1,384 @@
+"""Compiled molecule schemas.
+
+The ``core`` and ``ext`` components of a molecule schema (see
+``git4intel/schemas``) are compiled once into a small tree of matchers that
+can be used two ways:
+
+- ``to_query()`` gives an equivalent elasticsearch filter built from
+  ``term``/``terms``/``prefix``/``exists`` clauses on the already analysed
+  tokens (no query time analysis or scoring)
+- ``test()`` evaluates the component in python against the tokens of an
+  object that has already been fetched (``source_values()``) or against
+  the in-memory graph snapshot (``git4intel.graph``)
+
+so that molecule expansion can fetch the candidates for every component in
+one search and sort them into components locally.
+
+Supported queries are ``match_all``, ``bool`` (``must``, ``filter``,
+``should``, ``must_not``), ``match``, ``term``, ``terms``, ``prefix`` and
+``exists``; compiling anything else raises ``ValueError``.
+
+Fields are analysed as per the repository mappings (``field_kind()``): stix
+ids and references are split on ``--`` (``stixid_analyzer``), ``text``
+fields are lower-cased words and everything else is an exact keyword.
+"""
+import re
+
+
+def field_kind(field, mapping_type=None):
+    """Get how a field is analysed.
+
+    Args:
+        field (:obj:`str`): Field name.
+        mapping_type (:obj:`str`, optional): Elasticsearch mapping type of
+            the field, if known.
+
+    Returns:
+        :obj:`str`: ``'id'``, ``'text'`` or ``'keyword'``.
+    """
+    if field == 'id' or field.endswith('_ref') or field.endswith('_refs'):
+        return 'id'
+    if mapping_type == 'text':
+        return 'text'
+    return 'keyword'
+
+
+def analyze(kind, value):
+    """Tokens of a value for a kind of field (see ``field_kind()``).
+
+    Args:
+        kind (:obj:`str`): ``'id'``, ``'text'`` or ``'keyword'``.
+        value: Field value.
+
+    Returns:
+        :obj:`list` of :obj:`str`: Tokens.
+    """
+    if kind == 'id':
+        return [token for token in str(value).split('--') if token]
+    if kind == 'text':
+        return re.findall(r'\w+', str(value).lower())
+    if isinstance(value, bool):
+        return ['true' if value else 'false']
+    return [str(value)]
+
+
+def get_path(source, field):
+    """Values of a (dotted) field in an object, with lists flattened.
+
+    Args:
+        source (:obj:`dict`): JSON serializable object dictionary.
+        field (:obj:`str`): Field name.
+
+    Returns:
+        :obj:`list`: Values (``None`` left out).
+    """
+    values = [source]
+    for key in field.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+                if isinstance(value, list):
+                    next_values.extend(value)
+                else:
+                    next_values.append(value)
+        values = next_values
+    return [value for value in values if value is not None]
+
+
+def source_values(source, kinds):
+    """Token lookup for an already fetched object, for ``Matcher.test()``.
+
+    Args:
+        source (:obj:`dict`): JSON serializable stix2 object dictionary.
+        kinds (:obj:`dict`): Field kinds (see ``field_kind()``) by name.
+
+    Returns:
+        callable: Function of a field name returning its tokens.
+    """
+    cache = {}
+
+    def values(field):
+        try:
+            return cache[field]
+        except KeyError:
+            kind = kinds.get(field) or field_kind(field)
+            tokens = []
+            for value in get_path(source, field):
+                tokens.extend(analyze(kind, value))
+            cache[field] = tokens
+            return tokens
+    return values
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+class Matcher(object):
+    """Base class of a compiled query.
+
+    Attributes:
+        fields (:obj:`set` of :obj:`str`): Fields that the query uses.
+    """
+    fields = frozenset()
+
+    def to_query(self):
+        """Equivalent elasticsearch filter.
+
+        Returns:
+            :obj:`dict`: Elasticsearch query.
+        """
+        raise NotImplementedError
+
+    def test(self, values):
+        """Evaluate the query.
+
+        Args:
+            values (callable): Function of a field name returning the
+                tokens of that field.
+
+        Returns:
+            :obj:`bool`: ``True`` if it matches.
+        """
+        raise NotImplementedError
+
+
+class _MatchAll(Matcher):
+
+    def to_query(self):
+        return {"match_all": {}}
+
+    def test(self, values):
+        return True
+
+
+class _Bool(Matcher):
+
+    def __init__(self, must, should, must_not):
+        self.must = must
+        self.should = should
+        self.must_not = must_not
+        self.fields = frozenset().union(*[clause.fields for clause in
+                                          must + should + must_not])
+
+    def to_query(self):
+        body = {}
+        if self.must:
+            body['filter'] = [clause.to_query() for clause in self.must]
+        if self.should:
+            body['should'] = [clause.to_query() for clause in self.should]
+            if not self.must:
+                body['minimum_should_match'] = 1
+        if self.must_not:
+            body['must_not'] = [clause.to_query()
+                                for clause in self.must_not]
+        return {"bool": body}
+
+    def test(self, values):
+        for clause in self.must:
+            if not clause.test(values):
+                return False
+        for clause in self.must_not:
+            if clause.test(values):
+                return False
+        if self.should and not self.must:
+            for clause in self.should:
+                if clause.test(values):
+                    return True
+            return False
+        return True
+
+
+class _Terms(Matcher):
+    """Any of a set of (analysed) tokens; ``match``, ``term`` and
+    ``terms`` all compile to this."""
+
+    def __init__(self, field, tokens, kind, query=None):
+        self.field = field
+        self.tokens = frozenset(tokens)
+        self.kind = kind
+        self.query = query
+        self.fields = frozenset([field])
+
+    def to_query(self):
+        if self.query is not None:
+            # Text analysis is left to elasticsearch
+            return {"match": {self.field: self.query}}
+        tokens = sorted(self.tokens)
+        if len(tokens) == 1:
+            return {"term": {self.field: tokens[0]}}
+        return {"terms": {self.field: tokens}}
+
+    def test(self, values):
+        return not self.tokens.isdisjoint(values(self.field))
+
+
+class _Prefix(Matcher):
+
+    def __init__(self, field, prefix):
+        self.field = field
+        self.prefix = prefix
+        self.fields = frozenset([field])
+
+    def to_query(self):
+        return {"prefix": {self.field: self.prefix}}
+
+    def test(self, values):
+        for token in values(self.field):
+            if token.startswith(self.prefix):
+                return True
+        return False
+
+
+class _Exists(Matcher):
+
+    def __init__(self, field):
+        self.field = field
+        self.fields = frozenset([field])
+
+    def to_query(self):
+        return {"exists": {"field": self.field}}
+
+    def test(self, values):
+        return bool(values(self.field))
+
+
+def compile_query(query, kinds=None):
+    """Compile an elasticsearch query (eg: a molecule schema component).
+
+    Args:
+        query (:obj:`dict`): Elasticsearch query.
+        kinds (:obj:`dict`, optional): Field kinds (see ``field_kind()``) by
+            name. Fields that are not listed are worked out from their name.
+
+    Returns:
+        :obj:`Matcher`: Compiled query.
+
+    Raises:
+        ValueError: If the query uses anything that is not supported.
+    """
+    if kinds is None:
+        kinds = {}
+    if not isinstance(query, dict) or len(query) != 1:
+        raise ValueError('Cannot compile query: ' + str(query))
+    name, body = next(iter(query.items()))
+    if name == 'match_all':
+        return _MatchAll()
+    if name == 'bool':
+        unknown = set(body) - set(['must', 'filter', 'should', 'must_not'])
+        if unknown:
+            raise ValueError('Cannot compile bool options: ' + str(unknown))
+        must = [compile_query(clause, kinds) for clause in
+                _as_list(body.get('must')) + _as_list(body.get('filter'))]
+        should = [compile_query(clause, kinds)
+                  for clause in _as_list(body.get('should'))]
+        must_not = [compile_query(clause, kinds)
+                    for clause in _as_list(body.get('must_not'))]
+        return _Bool(must, should, must_not)
+    if name == 'exists':
+        return _Exists(body['field'])
+    if name not in ('match', 'term', 'terms', 'prefix') or len(body) != 1:
+        raise ValueError('Cannot compile query: ' + str(query))
+    field, value = next(iter(body.items()))
+    kind = kinds.get(field) or field_kind(field)
+    if name == 'prefix':
+        if isinstance(value, dict):
+            if set(value) != set(['value']):
+                raise ValueError('Cannot compile query: ' + str(query))
+            value = value['value']
+        return _Prefix(field, str(value))
+    if isinstance(value, dict):
+        if name != 'match' or set(value) != set(['query']):
+            raise ValueError('Cannot compile query: ' + str(query))
+        value = value['query']
+    if name == 'match':
+        return _Terms(field, analyze(kind, value), kind,
+                      query=value if kind == 'text' else None)
+    if name == 'term':
+        return _Terms(field, analyze('keyword', value), kind)
+    return _Terms(field, [token for item in value
+                          for token in analyze('keyword', item)], kind)
+
+
+class CompiledSchema(object):
+    """A molecule schema compiled for use by the client (see
+    ``Client.get_compiled_schema()``).
+
+    Args:
+        schema (:obj:`dict`): Molecule schema (``name``, ``core`` and
+            ``ext``).
+        kinds (:obj:`dict`, optional): Field kinds (see ``field_kind()``)
+            by name.
+
+    Attributes:
+        name (:obj:`str`): Schema name.
+        core (:obj:`list` of :obj:`Matcher`): Core components.
+        ext (:obj:`list` of :obj:`Matcher`): Extension components.
+        fields (:obj:`set` of :obj:`str`): Fields that the components use.
+        kinds (:obj:`dict`): Kinds of those fields, for ``source_values()``.
+    """
+
+    def __init__(self, schema, kinds=None):
+        if kinds is None:
+            kinds = {}
+        self.name = schema.get('name')
+        self.core = [compile_query(component, kinds) for component in
+                     schema['core']['bool']['should']]
+        self.ext = [compile_query(component, kinds) for component in
+                    schema['ext']['bool']['should']]
+        self.fields = frozenset().union(*[component.fields for component in
+                                          self.core + self.ext])
+        self.kinds = dict((field, kinds.get(field) or field_kind(field))
+                          for field in self.fields)
+
+    def union(self):
+        """Single component for any object in the schema (core or ext).
+
+        Returns:
+            :obj:`Matcher`: Compiled query.
+        """
+        return _Bool([], self.core + self.ext, [])
+
+    def to_query(self):
+        """Elasticsearch filter for any object in the schema.
+
+        Returns:
+            :obj:`dict`: Elasticsearch query.
+        """
+        return self.union().to_query()
+
+
+def schema_fields(schema):
+    """Fields used by the components of a (not yet compiled) molecule
+    schema, to work out their kinds before compiling.
+
+    Args:
+        schema (:obj:`dict`): Molecule schema.
+
+    Returns:
+        :obj:`set` of :obj:`str`: Field names.
+    """
+    fields = set()
+    stack = [schema.get('core', {}), schema.get('ext', {})]
+    while stack:
+        query = stack.pop()
+        if isinstance(query, list):
+            stack.extend(query)
+            continue
+        if not isinstance(query, dict):
+            continue
+        for name, body in query.items():
+            if name == 'bool' and isinstance(body, dict):
+                stack.extend(body.values())
+            elif name == 'exists' and isinstance(body, dict):
+                fields.add(body.get('field'))
+            elif name in ('match', 'term', 'terms', 'prefix') and \
+                    isinstance(body, dict):
+                fields.update(body)
+    fields.discard(None)
+    return fields
@@ -0,0 +1,1303 @@
+"""An in-process storage backend for the git4intel client.
+
+The :class:`MemoryTransport` plugs in underneath ``elasticsearch.Elasticsearch``
+(and therefore underneath :class:`git4intel.Client`) in place of the default
+HTTP transport, so every client method, helper (``helpers.scan``,
+``helpers.streaming_bulk``) and index namespace call is served from python
+dictionaries instead of a live cluster::
+
+    g4i = git4intel.Client('memory', transport_class=MemoryTransport)
+
+Only the subset of the elasticsearch REST API and query DSL that git4intel
+actually uses is implemented:
+
+- document APIs: index/create, get/exists, update, delete, mget, bulk
+- search APIs: search (with scroll and sliced scroll), msearch, count,
+  reindex, delete by query
+- index APIs: create/exists/delete, mappings, settings, refresh, aliases
+  (including filtered aliases) and the ``_cat`` alias/count endpoints
+- queries: ``match_all``, ``bool``, ``match``, ``multi_match``, ``term``,
+  ``terms`` (including terms lookup), ``ids``, ``prefix``, ``exists``,
+  ``range`` (with basic date math), ``nested``, ``query_string`` (simple
+  ``OR``/``AND`` term lists) and ``percolate``.
+
+Analysis follows the mappings that git4intel creates: fields analysed with
+the ``stixid_analyzer`` are split on ``--``, other ``text`` fields are
+lower-cased word tokens and everything else is matched as an exact keyword.
+Relevance scoring is not implemented (every hit scores ``1.0``).
+
+Attributes:
+    es_version (:obj:`str`): The elasticsearch version that the backend
+        reports itself as.
+"""
+from elasticsearch import Transport, exceptions
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote
+import copy
+import fnmatch
+import json
+import re
+import threading
+import uuid
+import zlib
+
+es_version = '7.17.0'
+
+_status_errors = {
+    400: exceptions.RequestError,
+    404: exceptions.NotFoundError,
+    409: exceptions.ConflictError,
+}
+
+_date_re = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?'
+                      r'(Z|[+-]\d{2}:?\d{2})?)?$')
+_math_re = re.compile(r'([+-])(\d+)([yMwdhHms])')
+
+
+class BackendError(Exception):
+    """Raised internally to turn into an elasticsearch style error response.
+
+    Args:
+        status (:obj:`int`): HTTP status code of the error.
+        error_type (:obj:`str`): Elasticsearch error type string.
+        reason (:obj:`str`): Human readable reason.
+    """
+
+    def __init__(self, status, error_type, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.info = {"error": {"type": error_type, "reason": reason},
+                     "status": status}
+
+
+class MemoryStore(object):
+    """Container for the indices, aliases and scroll contexts of one
+    in-process "cluster". A store can be shared between several transports
+    (and therefore several clients) to emulate them all talking to the same
+    cluster.
+    """
+
+    def __init__(self):
+        self.indices = {}
+        self.aliases = {}
+        self.scrolls = {}
+        self.seq_no = 0
+        self.lock = threading.RLock()
+
+
+# ANALYSIS:
+def _stixid_tokens(value):
+    return [token for token in str(value).split('--') if token]
+
+
+def _text_tokens(value):
+    return re.findall(r'\w+', str(value).lower())
+
+
+def _keyword_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _flatten(values):
+    for value in values:
+        if isinstance(value, list):
+            for sub_value in _flatten(value):
+                yield sub_value
+        elif value is not None:
+            yield value
+
+
+def _get_values(source, field):
+    """Gets all values of a (dotted) field from a document, walking through
+    lists of objects the way elasticsearch flattens them."""
+    values = [source]
+    for part in field.split('.'):
+        next_values = []
+        for value in _flatten(values):
+            if isinstance(value, dict) and part in value:
+                next_values.append(value[part])
+        values = next_values
+        if not values:
+            return []
+    return list(_flatten(values))
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        date = value
+    else:
+        value = str(value).replace('Z', '+00:00')
+        try:
+            date = datetime.fromisoformat(value)
+        except ValueError:
+            date = datetime.strptime(value[:10], '%Y-%m-%d')
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def _date_math(expr):
+    """Resolves the subset of elasticsearch date math used by git4intel
+    (eg: ``now-30d/d``)."""
+    if not isinstance(expr, str) or not expr.startswith('now'):
+        return _parse_date(expr)
+    date = datetime.now(timezone.utc)
+    rest = expr[3:]
+    rounding = None
+    if '/' in rest:
+        rest, rounding = rest.split('/', 1)
+    units = {'d': 'days', 'h': 'hours', 'H': 'hours', 'm': 'minutes',
+             's': 'seconds', 'w': 'weeks'}
+    for sign, num, unit in _math_re.findall(rest):
+        num = int(num) if sign == '+' else -int(num)
+        if unit == 'y':
+            date = date.replace(year=date.year + num)
+        elif unit == 'M':
+            month = date.month - 1 + num
+            date = date.replace(year=date.year + month // 12,
+                                month=month % 12 + 1)
+        else:
+            date += timedelta(**{units[unit]: num})
+    if rounding == 'd':
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif rounding in ('h', 'H'):
+        date = date.replace(minute=0, second=0, microsecond=0)
+    return date
+
+
+def filter_path(obj, paths):
+    """Applies an elasticsearch ``filter_path`` expression to a response.
+
+    Args:
+        obj (:obj:`dict`): Response body.
+        paths (:obj:`list` of :obj:`str`): Dotted paths (with ``*``
+            wildcards per path segment).
+
+    Returns:
+        :obj:`dict`: Filtered response (``{}`` if nothing matched).
+    """
+    res = _filter_path(obj, [path.split('.') for path in paths])
+    if res is None:
+        return {}
+    return res
+
+
+def _filter_path(obj, patterns):
+    if isinstance(obj, list):
+        out = []
+        for item in obj:
+            res = _filter_path(item, patterns)
+            if res is not None:
+                out.append(res)
+        return out or None
+    if not isinstance(obj, dict):
+        return None
+    out = {}
+    for key, value in obj.items():
+        keep = False
+        sub_patterns = []
+        for pattern in patterns:
+            if not fnmatch.fnmatchcase(key, pattern[0]):
+                continue
+            if len(pattern) == 1:
+                keep = True
+            else:
+                sub_patterns.append(pattern[1:])
+        if keep:
+            out[key] = value
+        elif sub_patterns:
+            res = _filter_path(value, sub_patterns)
+            if res is not None:
+                out[key] = res
+    return out or None
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _split_param(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value]
+    return [item for item in str(value).split(',') if item]
+
+
+def _bool_param(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == 'true'
+
+
+def _dynamic_mapping(value):
+    if isinstance(value, list):
+        for item in _flatten(value):
+            return _dynamic_mapping(item)
+        return None
+    if isinstance(value, bool):
+        return {"type": "boolean"}
+    if isinstance(value, int):
+        return {"type": "long"}
+    if isinstance(value, float):
+        return {"type": "float"}
+    if isinstance(value, dict):
+        props = {}
+        for key, sub_value in value.items():
+            sub_mapping = _dynamic_mapping(sub_value)
+            if sub_mapping:
+                props[key] = sub_mapping
+        return {"properties": props}
+    if isinstance(value, str) and _date_re.match(value):
+        return {"type": "date"}
+    return {"type": "text",
+            "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}}
+
+
+class _Index(object):
+    """A single in-memory index: mappings, settings and documents."""
+
+    def __init__(self, name, body=None):
+        body = body or {}
+        self.name = name
+        self.settings = copy.deepcopy(body.get('settings', {}))
+        self.mappings = copy.deepcopy(body.get('mappings', {}))
+        self.mappings.setdefault('properties', {})
+        self.docs = {}
+        self._field_cache = {}
+
+    def update_mapping(self, source):
+        props = self.mappings['properties']
+        changed = self._merge_dynamic(props, source)
+        if changed:
+            self._field_cache = {}
+
+    def _merge_dynamic(self, props, source):
+        changed = False
+        for key, value in source.items():
+            if key in props:
+                existing = props[key]
+                if isinstance(value, dict) and 'properties' in existing:
+                    changed |= self._merge_dynamic(existing['properties'],
+                                                   value)
+                elif (isinstance(value, list) and 'properties' in existing):
+                    for item in value:
+                        if isinstance(item, dict):
+                            changed |= self._merge_dynamic(
+                                existing['properties'], item)
+                continue
+            mapping = _dynamic_mapping(value)
+            if mapping is None:
+                continue
+            if (isinstance(value, list) and 'properties' in mapping):
+                for item in value[1:]:
+                    if isinstance(item, dict):
+                        self._merge_dynamic(mapping['properties'], item)
+            props[key] = mapping
+            changed = True
+        return changed
+
+    def field_mapping(self, field):
+        """Gets the mapping definition for a dotted field name (including
+        multi-fields such as ``name.keyword``)."""
+        try:
+            return self._field_cache[field]
+        except KeyError:
+            pass
+        props = self.mappings.get('properties', {})
+        mapping = None
+        parts = field.split('.')
+        for i, part in enumerate(parts):
+            if part in props:
+                mapping = props[part]
+                props = mapping.get('properties', {})
+                continue
+            if mapping and part in mapping.get('fields', {}):
+                mapping = dict(mapping['fields'][part])
+                mapping['_parent_depth'] = i
+                break
+            mapping = None
+            break
+        self._field_cache[field] = mapping
+        return mapping
+
+    def analyzer(self, field):
+        """Returns ``(kind, field_path)`` where kind is one of ``stixid``,
+        ``text``, ``keyword``, ``date``, ``boolean``, ``number``,
+        ``percolator``."""
+        mapping = self.field_mapping(field)
+        path = field
+        if mapping is None:
+            return 'text', path
+        if '_parent_depth' in mapping:
+            path = '.'.join(field.split('.')[:mapping['_parent_depth']])
+        es_type = mapping.get('type', 'object')
+        if es_type == 'text':
+            if mapping.get('analyzer') == 'stixid_analyzer':
+                return 'stixid', path
+            return 'text', path
+        if es_type == 'date':
+            return 'date', path
+        if es_type == 'boolean':
+            return 'boolean', path
+        if es_type in ('long', 'integer', 'short', 'byte', 'float', 'double',
+                       'half_float', 'scaled_float'):
+            return 'number', path
+        if es_type == 'percolator':
+            return 'percolator', path
+        return 'keyword', path
+
+
+class _Matcher(object):
+    """Evaluates elasticsearch queries against documents of one index.
+
+    Documents are the stored records (``{"_id": ..., "_source": ...}``);
+    analysed field tokens are cached on the record as they are computed.
+    """
+
+    def __init__(self, transport, index):
+        self.transport = transport
+        self.index = index
+        self._tokens = {}
+        # Matching document slots of percolate queries, by stored doc id
+        self.slots = {}
+
+    def tokens(self, kind, value):
+        key = (kind, value if not isinstance(value, bool) else str(value))
+        try:
+            return self._tokens[key]
+        except (KeyError, TypeError):
+            pass
+        if kind == 'stixid':
+            tokens = _stixid_tokens(value)
+        elif kind == 'text':
+            tokens = _text_tokens(value)
+        else:
+            tokens = [_keyword_value(value)]
+        try:
+            self._tokens[key] = tokens
+        except TypeError:
+            pass
+        return tokens
+
+    def doc_tokens(self, doc, field):
+        try:
+            return doc['_tokens'][field]
+        except KeyError:
+            pass
+        kind, path = self.index.analyzer(field)
+        out = set()
+        for value in _get_values(doc['_source'], path):
+            if isinstance(value, dict):
+                continue
+            out.update(self.tokens(kind, value))
+        doc.setdefault('_tokens', {})[field] = (kind, out)
+        return kind, out
+
+    def matches(self, query, doc):
+        if not query:
+            return True
+        if not isinstance(query, dict) or len(query) != 1:
+            raise BackendError(400, 'parsing_exception',
+                               'Malformed query: ' + json.dumps(query))
+        name, body = next(iter(query.items()))
+        try:
+            func = getattr(self, 'q_' + name)
+        except AttributeError:
+            raise BackendError(400, 'parsing_exception',
+                               'Unsupported query [' + name + ']')
+        return func(body, doc)
+
+    def q_match_all(self, body, doc):
+        return True
+
+    def q_match_none(self, body, doc):
+        return False
+
+    def q_bool(self, body, doc):
+        # Filters first: they are typically the more selective clauses
+        must = _as_list(body.get('filter')) + _as_list(body.get('must'))
+        for clause in must:
+            if not self.matches(clause, doc):
+                return False
+        for clause in _as_list(body.get('must_not')):
+            if self.matches(clause, doc):
+                return False
+        should = _as_list(body.get('should'))
+        if not should:
+            return True
+        if 'minimum_should_match' in body:
+            minimum = int(body['minimum_should_match'])
+        elif must:
+            minimum = 0
+        else:
+            minimum = 1
+        if minimum == 0:
+            return True
+        count = 0
+        for clause in should:
+            if self.matches(clause, doc):
+                count += 1
+                if count >= minimum:
+                    return True
+        return False
+
+    def q_match(self, body, doc):
+        field, value = next(iter(body.items()))
+        operator = 'or'
+        if isinstance(value, dict):
+            operator = value.get('operator', 'or').lower()
+            value = value['query']
+        kind, tokens = self.doc_tokens(doc, field)
+        if kind in ('keyword', 'boolean', 'number'):
+            return _keyword_value(value) in tokens
+        if kind == 'date':
+            return any(_parse_date(doc_value) == _parse_date(value)
+                       for doc_value in _get_values(doc['_source'], field))
+        wanted = self.tokens(kind, value)
+        if not wanted:
+            return False
+        if operator == 'and':
+            return all(token in tokens for token in wanted)
+        return any(token in tokens for token in wanted)
+
+    def q_match_phrase(self, body, doc):
+        field, value = next(iter(body.items()))
+        if isinstance(value, dict):
+            value = value['query']
+        return self.q_match({field: {"query": value, "operator": "and"}},
+                            doc)
+
+    def q_multi_match(self, body, doc):
+        fields = body.get('fields', ['*'])
+        for field in self._expand_fields(fields, doc):
+            if self.q_match({field: body['query']}, doc):
+                return True
+        return False
+
+    def q_term(self, body, doc):
+        field, value = next(iter(body.items()))
+        if isinstance(value, dict):
+            value = value['value']
+        kind, tokens = self.doc_tokens(doc, field)
+        return _keyword_value(value) in tokens
+
+    def q_terms(self, body, doc):
+        field, values = next((key, value) for key, value in body.items()
+                             if key != 'boost')
+        if isinstance(values, dict):
+            values = self.transport.terms_lookup(values)
+        kind, tokens = self.doc_tokens(doc, field)
+        if not tokens:
+            return False
+        return not tokens.isdisjoint(_keyword_value(value)
+                                     for value in values)
+
+    def q_ids(self, body, doc):
+        return doc.get('_id') in body.get('values', [])
+
+    def q_prefix(self, body, doc):
+        field, value = next(iter(body.items()))
+        if isinstance(value, dict):
+            value = value['value']
+        kind, tokens = self.doc_tokens(doc, field)
+        return any(token.startswith(value) for token in tokens)
+
+    def q_exists(self, body, doc):
+        for value in _get_values(doc['_source'], body['field']):
+            if value is not None:
+                return True
+        return False
+
+    def q_range(self, body, doc):
+        field, bounds = next(iter(body.items()))
+        kind, path = self.index.analyzer(field)
+        values = _get_values(doc['_source'], path)
+        if not values:
+            return False
+        if kind == 'date':
+            conv = _date_math
+            values = [_parse_date(value) for value in values]
+        elif kind == 'number':
+            conv = float
+            values = [float(value) for value in values]
+        else:
+            conv = str
+            values = [str(value) for value in values]
+        for value in values:
+            ok = True
+            if 'gte' in bounds and not value >= conv(bounds['gte']):
+                ok = False
+            if 'gt' in bounds and not value > conv(bounds['gt']):
+                ok = False
+            if 'lte' in bounds and not value <= conv(bounds['lte']):
+                ok = False
+            if 'lt' in bounds and not value < conv(bounds['lt']):
+                ok = False
+            if ok:
+                return True
+        return False
+
+    def q_nested(self, body, doc):
+        path = body['path']
+        for item in _get_values(doc['_source'], path):
+            if not isinstance(item, dict):
+                continue
+            nested_source = {}
+            node = nested_source
+            parts = path.split('.')
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = item
+            if self.matches(body['query'], {"_id": doc.get('_id'),
+                                            "_source": nested_source}):
+                return True
+        return False
+
+    def q_query_string(self, body, doc):
+        query = body['query']
+        operator = body.get('default_operator', 'or').lower()
+        if ' AND ' in query:
+            terms = query.split(' AND ')
+            operator = 'and'
+        else:
+            terms = query.split(' OR ')
+        terms = [term.strip().strip('()"') for term in terms if term.strip()]
+        fields = self._expand_fields(body.get('fields', ['*']), doc)
+        doc_tokens = [self.doc_tokens(doc, field) for field in fields]
+        found = []
+        for term in terms:
+            hit = False
+            for kind, tokens in doc_tokens:
+                if any(token in tokens for token in self.tokens(kind, term)):
+                    hit = True
+                    break
+            found.append(hit)
+        if not found:
+            return False
+        if operator == 'and':
+            return all(found)
+        return any(found)
+
+    def q_percolate(self, body, doc):
+        documents = body.get('documents')
+        if documents is None:
+            documents = [body['document']]
+        query = doc['_source'].get(body['field'])
+        if not query:
+            return False
+        slots = []
+        for slot, document in enumerate(documents):
+            doc_index = self.transport.percolate_index(self.index, document)
+            if _Matcher(self.transport, doc_index).matches(
+                    query, {"_source": document}):
+                slots.append(slot)
+        if not slots:
+            return False
+        field = '_percolator_document_slot'
+        if 'name' in body:
+            field += '_' + body['name']
+        self.slots.setdefault(doc.get('_id'), {})[field] = slots
+        return True
+
+    def _expand_fields(self, fields, doc):
+        out = []
+        cache = doc.setdefault('_fields', {})
+        for field in fields:
+            field = field.split('^')[0]
+            if '*' not in field:
+                out.append(field)
+                continue
+            try:
+                out += cache[field]
+            except KeyError:
+                cache[field] = [key for key in doc['_source']
+                                if fnmatch.fnmatchcase(key, field)]
+                out += cache[field]
+        return out
+
+
+class MemoryTransport(Transport):
+    """Drop-in replacement for ``elasticsearch.Transport`` that serves all
+    requests from an in-process :class:`MemoryStore`.
+
+    Args:
+        hosts: As per ``elasticsearch.Transport`` (ignored).
+        store (:obj:`MemoryStore`, optional): Store to serve requests from.
+            Defaults to a new, empty store.
+        **kwargs: As per ``elasticsearch.Transport``.
+    """
+
+    def __init__(self, hosts, store=None, **kwargs):
+        Transport.__init__(self, hosts, **kwargs)
+        if store is None:
+            store = MemoryStore()
+        self.store = store
+        self.request_count = 0
+
+    def perform_request(self, method, url, headers=None, params=None,
+                        body=None):
+        params = {key: value.decode('utf-8') if isinstance(value, bytes)
+                  else value for key, value in (params or {}).items()}
+        ignore = params.pop('ignore', ())
+        if isinstance(ignore, int):
+            ignore = (ignore, )
+        params.pop('request_timeout', None)
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if isinstance(body, str) and not url.endswith(('_bulk', '_msearch')):
+            body = json.loads(body) if body else None
+        parts = [unquote(part) for part in url.split('?')[0].split('/')
+                 if part]
+        with self.store.lock:
+            self.request_count += 1
+            try:
+                status, data = self._route(method, parts, params, body)
+            except BackendError as e:
+                status, data = e.status, e.info
+        if method == 'HEAD':
+            return 200 <= status < 300
+        if status >= 300 and status not in ignore:
+            error_type = data.get('error', {})
+            if isinstance(error_type, dict):
+                error_type = error_type.get('type', str(status))
+            raise _status_errors.get(status, exceptions.TransportError)(
+                status, error_type, data)
+        if isinstance(data, dict) and 'filter_path' in params:
+            data = filter_path(data, _split_param(params['filter_path']))
+        return data
+
+    # ROUTING:
+    def _route(self, method, parts, params, body):
+        if not parts:
+            return 200, {"name": "memory",
+                         "cluster_name": "git4intel-memory",
+                         "version": {"number": es_version},
+                         "tagline": "You Know, for Search"}
+        head = parts[0]
+        if head == '_cat':
+            return self._cat(parts[1:], params)
+        if head == '_search' and len(parts) > 1 and parts[1] == 'scroll':
+            return self._scroll(method, body, params)
+        if head == '_aliases':
+            return self._update_aliases(body)
+        if head == '_alias':
+            return self._alias(method, None, parts[1:], body)
+        if head in ('_search', '_msearch', '_mget', '_bulk', '_count',
+                    '_refresh', '_mapping', '_settings'):
+            parts = ['_all'] + parts
+            if head in ('_mget', '_bulk', '_msearch'):
+                parts[0] = None
+        if parts[0] == '_reindex':
+            return self._reindex(body)
+
+        target = parts[0]
+        if len(parts) == 1:
+            return self._index_admin(method, target, body, params)
+        action = parts[1]
+        if action == '_search':
+            return 200, self.search(target, body or {}, params)
+        if action == '_msearch':
+            return self._msearch(target, body, params)
+        if action == '_count':
+            return self._count(target, body or {}, params)
+        if action == '_delete_by_query':
+            return self._delete_by_query(target, body or {}, params)
+        if action == '_mget':
+            return self._mget(target, body, params)
+        if action == '_bulk':
+            return self._bulk(target, body, params)
+        if action == '_doc':
+            doc_id = parts[2] if len(parts) > 2 else None
+            return self._doc(method, target, doc_id, body, params)
+        if action == '_create':
+            params['op_type'] = 'create'
+            return self._doc('PUT', target, parts[2], body, params)
+        if action == '_update':
+            return self._update(target, parts[2], body)
+        if action in ('_alias', '_aliases'):
+            return self._alias(method, target, parts[2:], body)
+        if action == '_mapping':
+            if len(parts) > 3 and parts[2] == 'field':
+                return self._get_field_mapping(target, parts[3], params)
+            return self._get_mapping(target, params)
+        if action == '_settings':
+            return self._settings(method, target, body, params)
+        if action == '_refresh':
+            return 200, {"_shards": {"total": 1, "successful": 1,
+                                     "failed": 0}}
+        raise BackendError(400, 'invalid_request',
+                          'Unsupported endpoint: ' + '/'.join(parts))
+
+    # INDEX RESOLUTION:
+    def resolve(self, expression, ignore_unavailable=False, writing=False):
+        """Resolves an index expression to a list of ``(index, filter)``
+        tuples, where filter is the alias filter that applies (if any)."""
+        store = self.store
+        out = {}
+        for name in _split_param(expression) or ['_all']:
+            if name in ('_all', '*'):
+                for index_name in store.indices:
+                    out[index_name] = None
+                continue
+            if '*' in name:
+                for index_name in store.indices:
+                    if fnmatch.fnmatchcase(index_name, name):
+                        out[index_name] = None
+                for alias, members in store.aliases.items():
+                    if fnmatch.fnmatchcase(alias, name):
+                        for index_name in members:
+                            out.setdefault(index_name, None)
+                continue
+            if name in store.indices:
+                out[name] = None
+                continue
+            if name in store.aliases:
+                members = store.aliases[name]
+                if writing and len(members) > 1:
+                    raise BackendError(
+                        400, 'illegal_argument_exception',
+                        'no write index is defined for alias [' + name + ']')
+                for index_name, meta in members.items():
+                    if index_name in out and out[index_name] is None:
+                        continue
+                    out[index_name] = meta.get('filter')
+                continue
+            if ignore_unavailable:
+                continue
+            raise BackendError(404, 'index_not_found_exception',
+                              'no such index [' + name + ']')
+        return [(store.indices[name], _filter) for name, _filter in
+                sorted(out.items())]
+
+    def write_index(self, name):
+        """Resolves (and auto-creates if necessary) the single concrete index
+        that a write to ``name`` goes to."""
+        if name not in self.store.indices and name not in self.store.aliases:
+            self.store.indices[name] = _Index(name)
+        return self.resolve(name, writing=True)[0][0]
+
+    def terms_lookup(self, lookup):
+        """Fetches the values for a ``terms`` lookup query."""
+        try:
+            index = self.resolve(lookup['index'])[0][0]
+        except (BackendError, IndexError):
+            return []
+        doc = index.docs.get(str(lookup['id']))
+        if not doc:
+            return []
+        return _get_values(doc['_source'], lookup['path'])
+
+    def percolate_index(self, perc_index, document):
+        """Gets the index whose mapping should be used to analyse a document
+        that is being percolated (the percolator index mapping by default)."""
+        return perc_index
+
+    # DOCUMENT APIS:
+    def _store_doc(self, index, doc_id, source, op_type='index'):
+        store = self.store
+        existing = index.docs.get(doc_id)
+        if existing and op_type == 'create':
+            raise BackendError(409, 'version_conflict_engine_exception',
+                              '[' + doc_id + ']: version conflict, document '
+                              'already exists')
+        source = json.loads(json.dumps(source, default=str))
+        index.update_mapping(source)
+        store.seq_no += 1
+        version = existing['_version'] + 1 if existing else 1
+        index.docs[doc_id] = {"_id": doc_id, "_source": source,
+                              "_version": version, "_seq_no": store.seq_no}
+        return {"_index": index.name, "_type": "_doc", "_id": doc_id,
+                "_version": version,
+                "result": "updated" if existing else "created",
+                "_shards": {"total": 1, "successful": 1, "failed": 0},
+                "_seq_no": store.seq_no, "_primary_term": 1}, (
+                    200 if existing else 201)
+
+    def _doc(self, method, target, doc_id, body, params):
+        if method in ('PUT', 'POST'):
+            index = self.write_index(target)
+            if doc_id is None:
+                doc_id = uuid.uuid4().hex
+            res, status = self._store_doc(index, doc_id, body,
+                                          params.get('op_type', 'index'))
+            return status, res
+        index = self.resolve(target)[0][0]
+        doc = index.docs.get(doc_id)
+        if method == 'DELETE':
+            if doc is None:
+                return 404, {"_index": index.name, "_id": doc_id,
+                             "result": "not_found"}
+            del index.docs[doc_id]
+            return 200, {"_index": index.name, "_id": doc_id,
+                         "result": "deleted"}
+        if doc is None:
+            return 404, {"_index": index.name, "_type": "_doc",
+                         "_id": doc_id, "found": False}
+        res = {"_index": index.name, "_type": "_doc", "_id": doc_id,
+               "_version": doc['_version'], "_seq_no": doc['_seq_no'],
+               "_primary_term": 1, "found": True}
+        source = self._source_filter(doc['_source'], params)
+        if source is not None:
+            res['_source'] = source
+        return 200, res
+
+    def _update(self, target, doc_id, body):
+        index = self.resolve(target, writing=True)[0][0]
+        doc = index.docs.get(doc_id)
+        if doc is None:
+            if body.get('doc_as_upsert') or 'upsert' in body:
+                source = body.get('upsert', body.get('doc'))
+                res, status = self._store_doc(index, doc_id, source)
+                return status, res
+            raise BackendError(404, 'document_missing_exception',
+                              '[_doc][' + doc_id + ']: document missing')
+        source = copy.deepcopy(doc['_source'])
+        _merge(source, body.get('doc', {}))
+        if source == doc['_source']:
+            return 200, {"_index": index.name, "_type": "_doc",
+                         "_id": doc_id, "_version": doc['_version'],
+                         "result": "noop"}
+        res, status = self._store_doc(index, doc_id, source)
+        return 200, res
+
+    def _mget(self, target, body, params):
+        docs = []
+        if 'ids' in body:
+            body = {"docs": [{"_id": _id} for _id in body['ids']]}
+        for spec in body['docs']:
+            name = spec.get('_index', target)
+            doc_id = str(spec['_id'])
+            try:
+                index = self.resolve(name)[0][0]
+            except (BackendError, IndexError):
+                docs.append({"_index": name, "_type": "_doc", "_id": doc_id,
+                             "error": {"type": "index_not_found_exception",
+                                       "reason": "no such index [" + str(name)
+                                       + "]", "index": name}})
+                continue
+            doc_params = dict(params)
+            if '_source' in spec:
+                doc_params['_source'] = spec['_source']
+            status, res = self._doc('GET', index.name, doc_id, None,
+                                    doc_params)
+            docs.append(res)
+        return 200, {"docs": docs}
+
+    def _bulk(self, target, body, params):
+        lines = [line for line in body.split('\n') if line.strip()]
+        items = []
+        errors = False
+        i = 0
+        while i < len(lines):
+            action = json.loads(lines[i])
+            op_type, meta = next(iter(action.items()))
+            i += 1
+            source = None
+            if op_type != 'delete':
+                source = json.loads(lines[i])
+                i += 1
+            name = meta.get('_index', target)
+            doc_id = meta.get('_id')
+            if doc_id is not None:
+                doc_id = str(doc_id)
+            try:
+                if op_type in ('index', 'create'):
+                    index = self.write_index(name)
+                    if doc_id is None:
+                        doc_id = uuid.uuid4().hex
+                    res, status = self._store_doc(index, doc_id, source,
+                                                  op_type)
+                elif op_type == 'update':
+                    status, res = self._update(name, doc_id, source)
+                else:
+                    status, res = self._doc('DELETE', name, doc_id, None, {})
+                res['status'] = status
+            except BackendError as e:
+                errors = True
+                res = {"_index": name, "_type": "_doc", "_id": doc_id,
+                       "status": e.status, "error": e.info['error']}
+            items.append({op_type: res})
+        return 200, {"took": 1, "errors": errors, "items": items}
+
+    # SEARCH APIS:
+    def _hits(self, target, body, params):
+        ignore_unavailable = _bool_param(params.get('ignore_unavailable',
+                                                    False))
+        query = body.get('query')
+        hits = []
+        for index, alias_filter in self.resolve(target, ignore_unavailable):
+            matcher = _Matcher(self, index)
+            for doc_id, doc in index.docs.items():
+                if query and not matcher.matches(query, doc):
+                    continue
+                if alias_filter and not matcher.matches(alias_filter, doc):
+                    continue
+                slots = matcher.slots.pop(doc.get('_id'), None)
+                if slots:
+                    doc = dict(doc, _slots=slots)
+                hits.append((index, doc_id, doc))
+        if 'slice' in body:
+            _slice = body['slice']
+            hits = [hit for hit in hits
+                    if zlib.crc32(hit[1].encode()) % int(_slice['max']) ==
+                    int(_slice['id'])]
+        sort = body.get('sort')
+        if sort:
+            for spec in reversed(_as_list(sort)):
+                if isinstance(spec, str):
+                    field, order = spec, 'asc'
+                else:
+                    field, order = next(iter(spec.items()))
+                    if isinstance(order, dict):
+                        order = order.get('order', 'asc')
+                if field == '_doc':
+                    continue
+                present = [hit for hit in hits
+                           if _get_values(hit[2]['_source'], field)]
+                missing = [hit for hit in hits
+                           if not _get_values(hit[2]['_source'], field)]
+                present.sort(key=lambda hit: min(
+                                 str(value) for value in
+                                 _get_values(hit[2]['_source'], field)),
+                             reverse=(order == 'desc'))
+                hits = present + missing
+        return hits
+
+    def _format_hit(self, hit, params, body):
+        index, doc_id, doc = hit
+        out = {"_index": index.name, "_type": "_doc", "_id": doc_id,
+               "_score": 1.0}
+        source_params = dict(params)
+        if '_source' in body and '_source' not in source_params:
+            source_params['_source'] = body['_source']
+        source = self._source_filter(doc['_source'], source_params)
+        if source is not None:
+            out['_source'] = source
+        if '_slots' in doc:
+            out['fields'] = dict(doc['_slots'])
+        return out
+
+    def search(self, target, body, params):
+        """Runs a search request against the store and returns the response
+        body (before ``filter_path`` is applied)."""
+        hits = self._hits(target, body, params)
+        size = int(params.get('size', body.get('size', 10)))
+        start = int(params.get('from', body.get('from', 0)))
+        res = {"took": 1, "timed_out": False,
+               "_shards": {"total": 1, "successful": 1, "skipped": 0,
+                           "failed": 0},
+               "hits": {"total": {"value": len(hits), "relation": "eq"},
+                        "max_score": 1.0 if hits else None}}
+        page = hits[start:start + size]
+        res['hits']['hits'] = [self._format_hit(hit, params, body)
+                               for hit in page]
+        if 'scroll' in params:
+            scroll_id = uuid.uuid4().hex
+            self.store.scrolls[scroll_id] = {
+                "hits": hits[start + size:], "size": size,
+                "params": dict(params), "body": body}
+            res['_scroll_id'] = scroll_id
+        return res
+
+    def _scroll(self, method, body, params):
+        body = body or {}
+        scroll_ids = _as_list(body.get('scroll_id', params.get('scroll_id')))
+        if method == 'DELETE':
+            for scroll_id in scroll_ids:
+                self.store.scrolls.pop(scroll_id, None)
+            return 200, {"succeeded": True, "num_freed": len(scroll_ids)}
+        scroll_id = scroll_ids[0]
+        try:
+            context = self.store.scrolls[scroll_id]
+        except KeyError:
+            raise BackendError(404, 'search_context_missing_exception',
+                              'No search context found for id [' +
+                              str(scroll_id) + ']')
+        page = context['hits'][:context['size']]
+        context['hits'] = context['hits'][context['size']:]
+        return 200, {"_scroll_id": scroll_id, "took": 1, "timed_out": False,
+                     "_shards": {"total": 1, "successful": 1, "skipped": 0,
+                                 "failed": 0},
+                     "hits": {"hits": [
+                         self._format_hit(hit, context['params'],
+                                          context['body'])
+                         for hit in page]}}
+
+    def _msearch(self, target, body, params):
+        lines = [line for line in body.split('\n') if line.strip()]
+        responses = []
+        for i in range(0, len(lines), 2):
+            header = json.loads(lines[i])
+            search_body = json.loads(lines[i + 1])
+            search_params = {}
+            for key in ('ignore_unavailable', ):
+                if key in header:
+                    search_params[key] = header[key]
+            try:
+                res = self.search(header.get('index', target), search_body,
+                                  search_params)
+                res['status'] = 200
+            except BackendError as e:
+                res = e.info
+            responses.append(res)
+        return 200, {"took": 1, "responses": responses}
+
+    def _count(self, target, body, params):
+        return 200, {"count": len(self._hits(target, body, params)),
+                     "_shards": {"total": 1, "successful": 1, "skipped": 0,
+                                 "failed": 0}}
+
+    def _delete_by_query(self, target, body, params):
+        hits = self._hits(target, body, params)
+        for index, doc_id, doc in hits:
+            index.docs.pop(doc_id, None)
+        return 200, {"took": 1, "timed_out": False, "total": len(hits),
+                     "deleted": len(hits), "failures": []}
+
+    def _reindex(self, body):
+        hits = self._hits(body['source']['index'],
+                          {"query": body['source'].get('query')}, {})
+        dest = self.write_index(body['dest']['index'])
+        for index, doc_id, doc in hits:
+            self._store_doc(dest, doc_id, doc['_source'])
+        return 200, {"took": 1, "total": len(hits), "created": len(hits),
+                     "updated": 0, "failures": []}
+
+    def _source_filter(self, source, params):
+        _source = params.get('_source')
+        if _source is not None and not isinstance(_source, (list, dict)):
+            if str(_source).lower() == 'false':
+                return None
+            if str(_source).lower() != 'true':
+                params = dict(params)
+                params['_source_includes'] = _source
+        elif isinstance(_source, list):
+            params = dict(params)
+            params['_source_includes'] = _source
+        elif isinstance(_source, dict):
+            params = dict(params)
+            params['_source_includes'] = _source.get('includes', [])
+            params['_source_excludes'] = _source.get('excludes', [])
+        includes = _split_param(params.get('_source_includes'))
+        excludes = _split_param(params.get('_source_excludes'))
+        out = json.loads(json.dumps(source))
+        if includes:
+            out = filter_path(out, includes)
+        for pattern in excludes:
+            for key in list(out):
+                if fnmatch.fnmatchcase(key, pattern):
+                    del out[key]
+        return out
+
+    # INDEX APIS:
+    def _index_admin(self, method, target, body, params):
+        store = self.store
+        if method == 'PUT':
+            if target in store.indices or target in store.aliases:
+                raise BackendError(400, 'resource_already_exists_exception',
+                                  'index [' + target + '] already exists')
+            store.indices[target] = _Index(target, body)
+            for alias, meta in (body or {}).get('aliases', {}).items():
+                store.aliases.setdefault(alias, {})[target] = {
+                    "filter": meta.get('filter')}
+            return 200, {"acknowledged": True, "shards_acknowledged": True,
+                         "index": target}
+        indices = self.resolve(target, _bool_param(
+            params.get('ignore_unavailable', False)))
+        if method == 'HEAD':
+            return 200, {}
+        if method == 'DELETE':
+            for index, _filter in indices:
+                del store.indices[index.name]
+                for alias in list(store.aliases):
+                    store.aliases[alias].pop(index.name, None)
+                    if not store.aliases[alias]:
+                        del store.aliases[alias]
+            return 200, {"acknowledged": True}
+        out = {}
+        for index, _filter in indices:
+            out[index.name] = {"aliases": self._index_aliases(index.name),
+                               "mappings": copy.deepcopy(index.mappings),
+                               "settings": {"index": copy.deepcopy(
+                                   index.settings.get('index',
+                                                      index.settings))}}
+        return 200, out
+
+    def _index_aliases(self, index_name):
+        out = {}
+        for alias, members in self.store.aliases.items():
+            if index_name in members:
+                meta = {}
+                if members[index_name].get('filter'):
+                    meta['filter'] = copy.deepcopy(
+                        members[index_name]['filter'])
+                out[alias] = meta
+        return out
+
+    def _get_mapping(self, target, params):
+        indices = self.resolve(target, _bool_param(
+            params.get('ignore_unavailable', False)))
+        return 200, {index.name: {"mappings": copy.deepcopy(index.mappings)}
+                     for index, _filter in indices}
+
+    def _get_field_mapping(self, target, fields, params):
+        patterns = _split_param(fields)
+        indices = self.resolve(target, _bool_param(
+            params.get('ignore_unavailable', False)))
+        out = {}
+        for index, _filter in indices:
+            found = {}
+            for path, mapping in _leaf_mappings(index.mappings.get(
+                    'properties', {})):
+                if not any(fnmatch.fnmatchcase(path, pattern)
+                           for pattern in patterns):
+                    continue
+                found[path] = {"full_name": path,
+                               "mapping": {path.split('.')[-1]:
+                                           copy.deepcopy(mapping)}}
+            out[index.name] = {"mappings": found}
+        return 200, out
+
+    def _settings(self, method, target, body, params):
+        indices = self.resolve(target)
+        if method == 'PUT':
+            new = body.get('index', body)
+            for index, _filter in indices:
+                settings = index.settings.setdefault('index', {})
+                for key, value in new.items():
+                    settings[key.replace('index.', '')] = value
+            return 200, {"acknowledged": True}
+        out = {}
+        for index, _filter in indices:
+            settings = copy.deepcopy(index.settings.get('index', {}))
+            settings.setdefault('number_of_replicas', '1')
+            settings.setdefault('refresh_interval', '1s')
+            out[index.name] = {"settings": {"index": settings}}
+        return 200, out
+
+    def _alias(self, method, target, parts, body):
+        store = self.store
+        names = _split_param(parts[0]) if parts else ['*']
+        if method in ('PUT', 'POST'):
+            for index, _filter in self.resolve(target):
+                for name in names:
+                    store.aliases.setdefault(name, {})[index.name] = {
+                        "filter": (body or {}).get('filter')}
+            return 200, {"acknowledged": True}
+        index_names = None
+        if target is not None:
+            index_names = [index.name for index, _filter in
+                           self.resolve(target, True)]
+        matched = []
+        for alias, members in store.aliases.items():
+            if not any(fnmatch.fnmatchcase(alias, name) for name in names):
+                continue
+            for index_name in members:
+                if index_names is None or index_name in index_names:
+                    matched.append((alias, index_name))
+        if method == 'DELETE':
+            if not matched:
+                raise BackendError(404, 'aliases_not_found_exception',
+                                  'aliases ' + str(names) + ' missing')
+            for alias, index_name in matched:
+                del store.aliases[alias][index_name]
+                if not store.aliases[alias]:
+                    del store.aliases[alias]
+            return 200, {"acknowledged": True}
+        if not matched:
+            return 404, {"error": "alias " + str(names) + " missing",
+                         "status": 404}
+        out = {}
+        for alias, index_name in matched:
+            meta = {}
+            _filter = store.aliases[alias][index_name].get('filter')
+            if _filter:
+                meta['filter'] = copy.deepcopy(_filter)
+            out.setdefault(index_name, {"aliases": {}})['aliases'][alias] = \
+                meta
+        return 200, out
+
+    def _update_aliases(self, body):
+        store = self.store
+        for action in body.get('actions', []):
+            op, spec = next(iter(action.items()))
+            index_names = _as_list(spec.get('index')) + _as_list(
+                spec.get('indices'))
+            alias_names = _as_list(spec.get('alias')) + _as_list(
+                spec.get('aliases'))
+            indices = []
+            for name in index_names:
+                indices += [index.name for index, _filter in
+                            self.resolve(name, op == 'remove')]
+            for alias in alias_names:
+                if op == 'add':
+                    for index_name in indices:
+                        store.aliases.setdefault(alias, {})[index_name] = {
+                            "filter": spec.get('filter')}
+                elif op == 'remove':
+                    for existing in list(store.aliases):
+                        if not fnmatch.fnmatchcase(existing, alias):
+                            continue
+                        for index_name in indices:
+                            store.aliases[existing].pop(index_name, None)
+                        if not store.aliases[existing]:
+                            del store.aliases[existing]
+        return 200, {"acknowledged": True}
+
+    def _cat(self, parts, params):
+        store = self.store
+        if parts and parts[0] == 'aliases':
+            names = _split_param(parts[1]) if len(parts) > 1 else ['*']
+            rows = []
+            for alias in sorted(store.aliases):
+                if not any(fnmatch.fnmatchcase(alias, name)
+                           for name in names):
+                    continue
+                for index_name, meta in sorted(store.aliases[alias].items()):
+                    rows.append({"alias": alias, "index": index_name,
+                                 "filter": '*' if meta.get('filter')
+                                 else '-',
+                                 "routing.index": '-',
+                                 "routing.search": '-',
+                                 "is_write_index": '-'})
+            if params.get('format') == 'json':
+                return 200, rows
+            return 200, ''.join(' '.join(row.values()) + '\n'
+                                for row in rows)
+        if parts and parts[0] == 'count':
+            target = parts[1] if len(parts) > 1 else '_all'
+            count = len(self._hits(target, {}, {}))
+            now = datetime.now()
+            if params.get('format') == 'json':
+                return 200, [{"epoch": str(int(now.timestamp())),
+                              "timestamp": now.strftime('%H:%M:%S'),
+                              "count": str(count)}]
+            return 200, '%d %s %d\n' % (int(now.timestamp()),
+                                        now.strftime('%H:%M:%S'), count)
+        raise BackendError(400, 'invalid_request',
+                          'Unsupported _cat endpoint: ' + '/'.join(parts))
+
+
+def _leaf_mappings(props, prefix=''):
+    for key, mapping in props.items():
+        path = prefix + key
+        if 'properties' in mapping:
+            for item in _leaf_mappings(mapping['properties'], path + '.'):
+                yield item
+            continue
+        yield path, mapping
+
+
+def _merge(source, doc):
+    for key, value in doc.items():
+        if isinstance(value, dict) and isinstance(source.get(key), dict):
+            _merge(source[key], value)
+        else:
+            source[key] = value
@@ -0,0 +1,73 @@
+"""Materialized molecule store (``Client.materialize_molecules()``).
+
+Resolved molecules are kept in their own index, one document per seed id and
+molecule schema, so that reads (eg: dashboards listing every incident) are a
+single search rather than a fresh expansion per seed. Each document holds the
+ids of the molecule (``member_refs``), which doubles as the list of ids whose
+writes can change it: when the client writes or revokes an object, the
+molecules that hold its id or any of its references are flagged ``stale``
+and are recomputed (only those) the next time they are read.
+
+Molecules are resolved as the system identity without marking definitions
+(as per ``get_molecule()`` with ``_md`` set to ``False``). The objects are
+still fetched through the reader's marking definition alias, but membership
+can take in paths through objects that the reader cannot see.
+
+Attributes:
+    molecules_index (:obj:`str`): Name of the molecule index.
+    molecules_mapping (:obj:`dict`): Elasticsearch mapping for the molecule
+        index.
+"""
+
+molecules_index = 'molecules'
+
+molecules_mapping = {
+    "mappings": {
+        "dynamic": "strict",
+        "properties": {
+            "seed_ref": {"type": "keyword"},
+            "schema": {"type": "keyword"},
+            "member_refs": {"type": "keyword"},
+            "found": {"type": "boolean"},
+            "satisfied": {"type": "boolean"},
+            "stale": {"type": "boolean"},
+            "created": {"type": "date"}
+        }
+    }
+}
+
+
+def molecule_id(seed, schema_name):
+    """Deterministic document id for a materialized molecule.
+
+    Args:
+        seed (:obj:`str`): STIX2 object reference id of the seed.
+        schema_name (:obj:`str`): Name of the molecule schema.
+
+    Returns:
+        :obj:`str`: Document id.
+    """
+    return schema_name + '|' + seed
+
+
+def molecule_doc(seed, schema_name, ids, satisfied, created):
+    """Molecule document for a resolved molecule.
+
+    Args:
+        seed (:obj:`str`): STIX2 object reference id of the seed.
+        schema_name (:obj:`str`): Name of the molecule schema.
+        ids (:obj:`list` of :obj:`str`): Molecule ids (``False`` if there
+            were no hits).
+        satisfied (:obj:`bool`): Whether every core component was satisfied.
+        created (:obj:`str`): Timestamp of the resolution.
+
+    Returns:
+        :obj:`dict`: Molecule document.
+    """
+    return {"seed_ref": seed,
+            "schema": schema_name,
+            "member_refs": sorted(set(ids or []) | set([seed])),
+            "found": bool(ids),
+            "satisfied": bool(satisfied),
+            "stale": False,
+            "created": created}
@@ -1,7 +1,9 @@
+import codecs
 import json
 import stix2
 import sys
 import collections
+import collections.abc
 from datetime import datetime
 import random
 import uuid
@@ -47,7 +49,7 @@ def hits_from_res(es_res):
 
 def update(d, u):
     for k, v in u.items():
-        if isinstance(v, collections.Mapping):
+        if isinstance(v, collections.abc.Mapping):
             d[k] = update(d.get(k, {}), v)
         else:
             d[k] = v
@@ -63,8 +65,12 @@ def ordered(obj):
         return obj
 
 
+def md_time_slice():
+    return datetime.now().strftime("%y%m%d%H")
+
+
 def md_time_index(user_id, old_alias):
-    time_slice = datetime.now().strftime("%y%m%d%H")
+    time_slice = md_time_slice()
     _id = user_id.split('--')[1]
     return old_alias + '--' + _id, time_slice
 
@@ -85,7 +91,20 @@ def new_obj_version(user_id, stix_object):
     return [ver_rel, stix_object]
 
 
-def dir_recurse(top_level_dir, file_ext, file_list=[]):
+def chunk_list(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def dir_recurse(top_level_dir, file_ext, file_list=None):
+    if file_list is None:
+        file_list = []
     for item in os.listdir(top_level_dir):
         if item.endswith(file_ext):
             file_list.append(os.path.join(top_level_dir, item))
@@ -95,6 +114,98 @@ def dir_recurse(top_level_dir, file_ext, file_list=[]):
     return file_list
 
 
+def iter_bundle_objects(chunks, key='objects'):
+    """Incrementally parse the objects out of a (potentially huge) stix2
+    bundle without loading the whole document, so memory use is bounded by
+    the size of the largest single object.
+
+    Args:
+        chunks (iterable of :obj:`bytes` or :obj:`str`): The bundle in
+            pieces, eg: ``iter(lambda: f.read(65536), b'')`` for a file or
+            ``response.iter_content(65536)`` for a streamed download.
+        key (:obj:`str`, optional): Top level key holding the object list.
+
+    Yields:
+        :obj:`dict`: Each object in the list, in document order.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    state = {"buf": '', "pos": 0, "eof": False}
+
+    def read_more():
+        if state['eof']:
+            raise ValueError('Unexpected end of bundle')
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            chunk = b''
+            state['eof'] = True
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk, final=state['eof'])
+        state['buf'] = state['buf'][state['pos']:] + chunk
+        state['pos'] = 0
+
+    def peek():
+        while True:
+            buf = state['buf']
+            pos = state['pos']
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if state['eof']:
+                return ''
+            read_more()
+
+    def expect(char):
+        if peek() != char:
+            raise ValueError('Expected ' + char + ' in bundle')
+        state['pos'] += 1
+
+    def value():
+        peek()
+        while True:
+            try:
+                buf = state['buf']
+                val, end = decoder.raw_decode(buf, state['pos'])
+                # Strings, objects and lists are self-delimiting but a
+                # number may have been cut short by the end of the buffer
+                if (isinstance(val, (dict, list, str)) or state['eof'] or
+                        (end < len(buf) and buf[end] in ' \t\r\n,]}')):
+                    state['pos'] = end
+                    return val
+            except json.JSONDecodeError:
+                if state['eof']:
+                    raise
+            read_more()
+
+    expect('{')
+    while True:
+        char = peek()
+        if char == '}' or char == '':
+            return
+        if char == ',':
+            state['pos'] += 1
+            continue
+        name = value()
+        expect(':')
+        if name != key:
+            value()
+            continue
+        expect('[')
+        while True:
+            char = peek()
+            if char == ']':
+                state['pos'] += 1
+                break
+            if char == ',':
+                state['pos'] += 1
+                continue
+            yield value()
+
+
 # SYSTEM INFO:
 def get_system_id(id_only=False):
     system_id = stix2.v21.Identity(
@@ -279,6 +390,14 @@ def stix_to_elk(obj, stix_ver):
         if prop_type not in unsupported_props:
             update(mapping['mappings']['properties'], stixprop_to_field(
                 prop, prop_list[prop]))
+    # Molecule schema components satisfied (see Client.tag_schema_hits())
+    mapping['mappings']['properties']['x_g4i_schema_hits'] = {
+        'type': 'keyword'}
+    # Exact copies for terms lookup marking filters (see git4intel.markings)
+    for field in ('id', 'object_marking_refs'):
+        if field in mapping['mappings']['properties']:
+            mapping['mappings']['properties'][field]['fields'] = {
+                'keyword': {'type': 'keyword'}}
     if obj._type == 'attack-pattern':
         mapping['mappings']['properties']['x_eiq_assigned_to_ref'] = {'type': 'text', "analyzer": "stixid_analyzer"}
         mapping['mappings']['properties']['x_eiq_priority'] = {'type': 'keyword'}
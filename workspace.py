@@ -1,6 +1,5 @@
 import git4intel
 from git4intel.utils import hits_from_res
-from elasticsearch import helpers
 import stix2
 import json
 from slugify import slugify
@@ -13,7 +12,6 @@ import sys
 import requests
 import base64
 import re
-import os
 
 from polylogyx_apis.api import PolylogyxApi
 
@@ -281,23 +279,10 @@ def make_attribution(user_id, actor_name, iset_id):
 
 
 def get_rels(stix_id):
-    q_id = stix_id.split('--')[1]
-
-    q = {"query": {"bool": {"should": [
-                                {"match": {"source_ref": q_id}},
-                                {"match": {"target_ref": q_id}}
-    ]}}}
-
-    res = g4i.search(user_id=g4i.identity['id'], index='relationship',
-                     _md=False, body=q)
-
     id_list = []
-    for obj in res['hits']['hits']:
-        id_list.append(obj['_source']['id'])
-        if obj['_source']['source_ref'] == stix_id:
-            id_list.append(obj['_source']['target_ref'])
-        elif obj['_source']['target_ref'] == stix_id:
-            id_list.append(obj['_source']['source_ref'])
+    for edge in g4i.get_edges(stix_ids=[stix_id], relationships=True):
+        id_list.append(edge['rel_ref'])
+        id_list.append(edge['peer_ref'])
 
     return list(set(id_list))
 
@@ -436,27 +421,8 @@ def deploy_packs(threat_id, tags):
     return out
 
 
-def data_dump():
-    stats = {}
-    count = 0
-    q = {"query": {"match_all": {}}}
-    for hit in helpers.scan(client=g4i, index='intel', query=q, user_id=g4i.identity['id']):
-        try:
-            with open('./cti-data/' + hit['_source']['type'] + '/' + hit['_source']['id'] + '.json', 'w') as outfile:
-                json.dump(hit['_source'], outfile)
-        except FileNotFoundError:
-            os.mkdir('./cti-data/' + hit['_source']['type'])
-            with open('./cti-data/' + hit['_source']['type'] + '/' + hit['_source']['id'] + '.json', 'w') as outfile:
-                json.dump(hit['_source'], outfile)
-        try:
-            stats[hit['_source']['type']] += 1
-        except KeyError:
-            stats[hit['_source']['type']] = 1
-        count += 1
-
-    print(count)
-    pprint(stats)
-    return True
+def data_dump(slices=4):
+    return g4i.data_dump(path='./cti-data', shard='files', slices=slices)
 
 
 def jacek_search(s):